@@ -1,21 +1,59 @@
-import tkinter as tk
-from tkinter import filedialog, messagebox, ttk
-from tkinterdnd2 import DND_FILES, TkinterDnD
-from PIL import Image
-import pillow_heif
-import os
+import time
+
+# Taken before any other import so --measure-startup includes module loading
+_STARTED = time.perf_counter()
+
+import tkinter as tk  # noqa: E402
+from tkinter import filedialog, messagebox, ttk  # noqa: E402
+from tkinterdnd2 import DND_FILES, TkinterDnD  # noqa: E402
+import importlib.util  # noqa: E402
+import json  # noqa: E402
+import os  # noqa: E402
+import queue  # noqa: E402
+import sys  # noqa: E402
+import threading  # noqa: E402
+from concurrent.futures import ThreadPoolExecutor  # noqa: E402
+
+from metrics import FileMetrics, MetricsCollector  # noqa: E402
 
 __version__ = "0.1.0"
 __author__ = "Adam Rogers"
 
+POLL_INTERVAL_MS = 50
+
+# The watch folder is checked less often than a running batch; files settle for longer anyway
+WATCH_POLL_MS = 200
+
+# Output formats offered next to JPG and PNG: (label, converter format name)
+OPTIONAL_FORMATS = [("WebP", "WEBP"), ("AVIF", "AVIF")]
+if importlib.util.find_spec('pillow_jxl') is not None:
+    OPTIONAL_FORMATS.append(("JPEG XL", "JXL"))
+
+# File dialog patterns for sniff.HEIF_EXTENSIONS; other files are accepted by content
+HEIF_PATTERNS = " ".join(f"*{ext} *{ext.upper()}" for ext in ('.heic', '.heif', '.hif', '.avif'))
+
+# Set by a launcher (for example build.py) to the time.time() at which it
+# started the executable, so the report includes the bootloader's unpack time
+LAUNCH_TIME_ENV = "HEIC2IMG_LAUNCH_TIME"
+
+
+def load_engine():
+    """Import the conversion engine (Pillow and libheif) and register the HEIF opener"""
+    import converter
+    converter.register_opener()
+    return converter
+
+
 class HEICConverter:
     def __init__(self, root):
         self.root = root
         self.root.title("HEIC to JPG/PNG Converter")
-        self.root.geometry("500x400")
+        self.root.geometry("520x540")
         self.root.resizable(False, False)
         
-        pillow_heif.register_heif_opener()
+        # Pillow and libheif are loaded once the window is up, not before it
+        self.engine = None
+        self.root.after_idle(self.start_engine_load)
         
         main_frame = tk.Frame(root, padx=20, pady=20)
         main_frame.pack(fill=tk.BOTH, expand=True)
@@ -29,9 +67,9 @@ class HEICConverter:
         self.drop_frame.pack(fill=tk.BOTH, expand=True, pady=(0, 20))
         self.drop_frame.pack_propagate(False)
         
-        drop_label = tk.Label(self.drop_frame, 
-                             text="Drag & Drop HEIC file here\nor click Browse below",
-                             bg="#f0f0f0", font=("Arial", 11))
+        drop_label = tk.Label(self.drop_frame,
+                              text="Drag & Drop HEIC files here\nor click Browse below",
+                              bg="#f0f0f0", font=("Arial", 11))
         drop_label.place(relx=0.5, rely=0.5, anchor=tk.CENTER)
         
         self.drop_frame.drop_target_register(DND_FILES)
@@ -42,9 +80,18 @@ class HEICConverter:
                              wraplength=460, justify=tk.LEFT)
         file_label.pack(pady=(0, 10))
         
-        browse_btn = tk.Button(main_frame, text="Browse File", 
-                              command=self.browse_file, width=20, height=2)
-        browse_btn.pack(pady=(0, 15))
+        button_frame = tk.Frame(main_frame)
+        button_frame.pack(pady=(0, 5))
+        browse_btn = tk.Button(button_frame, text="Browse Files",
+                               command=self.browse_file, width=20, height=2)
+        browse_btn.pack(side=tk.LEFT, padx=5)
+        self.watch_btn = tk.Button(button_frame, text="Watch Folder...",
+                                   command=self.toggle_watch, width=20, height=2)
+        self.watch_btn.pack(side=tk.LEFT, padx=5)
+
+        self.watch_status_var = tk.StringVar(value="")
+        tk.Label(main_frame, textvariable=self.watch_status_var, fg="#555555",
+                 wraplength=460, justify=tk.LEFT).pack(pady=(0, 10))
         
         format_frame = tk.Frame(main_frame)
         format_frame.pack(pady=(0, 15))
@@ -59,80 +106,377 @@ class HEICConverter:
         png_radio = tk.Radiobutton(format_frame, text="PNG", 
                                    variable=self.format_var, value="PNG")
         png_radio.pack(side=tk.LEFT, padx=5)
+
+        # Listed without importing Pillow; unavailable encoders are reported on Convert
+        for label, value in OPTIONAL_FORMATS:
+            tk.Radiobutton(format_frame, text=label, variable=self.format_var,
+                           value=value).pack(side=tk.LEFT, padx=5)
+
+        preset_frame = tk.Frame(main_frame)
+        preset_frame.pack(pady=(0, 15))
+        tk.Label(preset_frame, text="Optimize for:").pack(side=tk.LEFT, padx=(0, 10))
+        self.preset_var = tk.StringVar(value="balanced")
+        for label, value in (("Speed", "fast"), ("Balanced", "balanced"),
+                             ("Smallest file", "smallest")):
+            tk.Radiobutton(preset_frame, text=label, variable=self.preset_var,
+                           value=value).pack(side=tk.LEFT, padx=5)
         
         self.convert_btn = tk.Button(main_frame, text="Convert", 
-                                     command=self.convert_file, 
+                                     command=self.convert_files,
                                      state=tk.DISABLED, width=20, height=2,
                                      bg="#4CAF50", fg="white", font=("Arial", 10, "bold"))
         self.convert_btn.pack()
         
-        self.current_file = None
+        self.progress = ttk.Progressbar(main_frame, orient=tk.HORIZONTAL,
+                                        mode='determinate', length=460)
+        self.progress.pack(pady=(15, 0))
+
+        self.pending_files = []
+        # Header facts of queued files, from the pre-flight scan
+        self.file_infos = {}
+        self.executor = None
+        self.results = queue.Queue()
+        self.batch_results = []
+        self.batch_total = 0
+        self.batch_metrics = None
+        self.batch_scheduler = None
+        self.batch_options = None
+
+        self.watcher = None
+        self.watch_folder = None
+        self.watch_stop = None
+        self.watch_found = queue.Queue()
+        self.watch_done = queue.Queue()
+        self.watch_outputs = set()
+        self.watch_converted = 0
+        self.watch_failed = 0
     
+    def start_engine_load(self):
+        """Load the conversion engine on a background thread"""
+        if self.engine is None:
+            loader = ThreadPoolExecutor(max_workers=1)
+            self.engine = loader.submit(load_engine)
+            loader.shutdown(wait=False)
+
     def browse_file(self):
-        filename = filedialog.askopenfilename(
-            title="Select HEIC file",
-            filetypes=[("HEIC files", "*.heic *.HEIC")]
+        filenames = filedialog.askopenfilenames(
+            title="Select HEIC files",
+            filetypes=[("HEIF images", HEIF_PATTERNS), ("All files", "*")]
         )
-        if filename:
-            self.load_file(filename)
+        if filenames:
+            self.load_files(filenames)
     
     def drop_file(self, event):
-        file_path = event.data
-        file_path = file_path.strip('{}') # Needed for Windows
-        self.load_file(file_path)
+        # splitlist handles the {braced paths} tkdnd uses for names with spaces
+        self.load_files(self.root.tk.splitlist(event.data))
     
     def load_file(self, file_path):
-        if not file_path.lower().endswith('.heic'):
-            messagebox.showerror("Invalid File", 
-                               "Please select a .heic file!")
+        self.load_files([file_path])
+
+    def load_files(self, file_paths):
+        if self.batch_total:
+            messagebox.showwarning("Conversion Running",
+                                   "Please wait for the current conversion to finish.")
             return
         
-        if not os.path.exists(file_path):
-            messagebox.showerror("File Not Found", 
-                               "The selected file does not exist!")
+        missing = [p for p in file_paths if not os.path.exists(p)]
+        new_files = [p for p in dict.fromkeys(file_paths)
+                     if p not in missing and p not in self.pending_files]
+        invalid = dict(self.inspect_files(new_files))
+
+        if invalid:
+            messagebox.showerror("Invalid File",
+                                 "These files are not readable HEIC images!\n\nSkipped:\n"
+                                 + "\n".join(f"{os.path.basename(p)}: {e}"
+                                             for p, e in invalid.items()))
+        if missing:
+            messagebox.showerror("File Not Found",
+                                 "The selected file does not exist!\n\nSkipped:\n"
+                                 + "\n".join(os.path.basename(p) for p in missing))
+
+        self.pending_files.extend(p for p in new_files if p not in invalid)
+
+        if not self.pending_files:
             return
         
-        self.current_file = file_path
-        self.file_path_var.set(f"Selected: {os.path.basename(file_path)}")
+        if len(self.pending_files) == 1:
+            self.file_path_var.set(f"Selected: {os.path.basename(self.pending_files[0])}")
+        else:
+            self.file_path_var.set(f"Selected: {len(self.pending_files)} files")
         self.convert_btn.config(state=tk.NORMAL)
-    
-    def convert_file(self):
-        if not self.current_file:
+
+    def inspect_files(self, file_paths):
+        """
+        Read the headers of file_paths and remember what they say.
+
+        Until the engine has loaded, the check is left to convert_files().
+
+        Returns:
+            list: (path, error message) for the files that are not readable HEIC images
+        """
+        if not file_paths or not self.engine or not self.engine.done() \
+                or self.engine.exception() is not None:
+            return []
+        import preflight
+        infos, rejected = preflight.scan(file_paths)
+        self.file_infos.update(infos)
+        return rejected
+
+    def convert_files(self):
+        if not self.pending_files or self.batch_total:
             return
         
+        self.start_engine_load()
+        if not self.engine.done():
+            # Only reachable when Convert is clicked within the first moments
+            self.file_path_var.set("Loading converter...")
+            self.root.after(POLL_INTERVAL_MS, self.convert_files)
+            return
+        try:
+            converter = self.engine.result()
+        except ImportError as e:
+            messagebox.showerror("Missing Dependency",
+                                 f"The image libraries could not be loaded:\n{e}")
+            return
+
+        options = converter.ConversionOptions(format=self.format_var.get(),
+                                              preset=self.preset_var.get())
+        try:
+            converter.check_options(options)
+        except converter.ConversionError as e:
+            messagebox.showerror("Format Not Available", str(e))
+            return
+
+        if self.executor is None:
+            # Pillow and libheif release the GIL while decoding and encoding,
+            # so threads keep every core busy without blocking the Tk loop
+            self.executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+
+        import preflight
+
+        files, self.pending_files = self.pending_files, []
+        # Files queued before the engine loaded have not been inspected yet
+        rejected = self.inspect_files([p for p in files if p not in self.file_infos])
+        infos = {p: self.file_infos.pop(p) for p in files if p in self.file_infos}
+        self.batch_results = []
+        self.batch_total = len(files)
+        self.batch_metrics = MetricsCollector()
+        for file_path, error in rejected:
+            file_metrics = FileMetrics(file_path)
+            file_metrics.error = error
+            self.batch_metrics.add(file_metrics)
+            self.batch_results.append((file_path, None, error))
+        self.convert_btn.config(state=tk.DISABLED)
+        self.progress.config(maximum=self.batch_total, value=len(self.batch_results))
+        self.file_path_var.set(f"Converting {len(self.batch_results)} of {self.batch_total}...")
+
+        # Largest first, so the longest conversions overlap with the rest of
+        # the batch, and never more at once than memory allows
+        self.batch_options = options
+        self.batch_scheduler = preflight.MemoryScheduler(
+            preflight.largest_first([(p, None) for p in infos], infos),
+            cost=lambda pair: infos[pair[0]].memory(options), budget=preflight.default_budget())
+        self.submit_ready(converter)
+
+        self.root.after(POLL_INTERVAL_MS, self.poll_progress)
+
+    def submit_ready(self, converter):
+        """Hand the executor every file of the batch the memory budget lets start now"""
+        while self.batch_scheduler:
+            pair = self.batch_scheduler.next()
+            if pair is None:
+                break
+            file_metrics = FileMetrics(pair[0])
+            future = self.executor.submit(converter.convert, *pair, self.batch_options,
+                                          file_metrics)
+            future.add_done_callback(
+                lambda f, m=file_metrics, p=pair: self.results.put((m, f, p)))
+
+    def poll_progress(self):
+        # Worker threads never touch Tk; results are drained here on the main thread
+        while True:
+            try:
+                file_metrics, future, pair = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.batch_scheduler.finished(pair)
+            file_path = file_metrics.src
+            error = future.exception()
+            file_metrics.error = str(error) if error else None
+            self.batch_metrics.add(file_metrics)
+            self.batch_results.append((file_path, None if error else future.result(), error))
+            self.progress.config(value=len(self.batch_results))
+            self.file_path_var.set(f"Converting {len(self.batch_results)} of "
+                                   f"{self.batch_total}: {os.path.basename(file_path)}")
+
+        if self.batch_scheduler:
+            self.submit_ready(self.engine.result())
+        if len(self.batch_results) < self.batch_total:
+            self.root.after(POLL_INTERVAL_MS, self.poll_progress)
+        else:
+            self.finish_batch()
+
+    def toggle_watch(self):
+        if self.watcher is not None:
+            self.stop_watch()
+            return
+        folder = filedialog.askdirectory(title="Select a folder to watch for HEIC files")
+        if folder:
+            self.start_watch(folder)
+
+    def start_watch(self, folder):
+        """Convert HEIC files that appear anywhere below folder until stop_watch()"""
+        from watcher import FolderWatcher
+
+        self.start_engine_load()
+        try:
+            # Outputs land in the watched folder; an AVIF output must not be converted again
+            self.watcher = FolderWatcher(folder, accept=lambda p: p not in self.watch_outputs)
+        except OSError as e:
+            messagebox.showerror("Cannot Watch Folder", str(e))
+            return
+        self.watch_folder = folder
+        self.watch_converted = self.watch_failed = 0
+        self.watch_stop = threading.Event()
+        threading.Thread(target=self.watch_loop, args=(self.watcher, self.watch_stop),
+                         daemon=True).start()
+        self.watch_btn.config(text="Stop Watching")
+        self.update_watch_status()
+        self.root.after(WATCH_POLL_MS, self.poll_watch)
+
+    def stop_watch(self):
+        if self.watcher is None:
+            return
+        self.watch_stop.set()
+        self.watcher = None
+        self.watch_btn.config(text="Watch Folder...")
+        self.watch_status_var.set("")
+
+    def watch_loop(self, watcher, stop):
+        # Runs on its own thread and only hands paths to the Tk thread through a queue
+        import sniff
+
         try:
-            image = Image.open(self.current_file)
-            
-            output_format = self.format_var.get()
-            extension = ".jpg" if output_format == "JPG" else ".png"
-            
-            base_name = os.path.splitext(self.current_file)[0]
-            output_file = base_name + extension
-            
-            if output_format == "JPG":
-                if image.mode in ('RGBA', 'LA', 'P'):
-                    background = Image.new('RGB', image.size, (255, 255, 255))
-                    if image.mode == 'P':
-                        image = image.convert('RGBA')
-                    background.paste(image, mask=image.split()[-1] if image.mode == 'RGBA' else None)
-                    image = background
-                image.save(output_file, "JPEG", quality=95)
+            while not stop.is_set():
+                for path in watcher.wait(timeout=0.5):
+                    # Settled files are complete, so their first bytes tell what they are
+                    if path not in self.watch_outputs and sniff.is_heif_input(path):
+                        self.watch_found.put(path)
+        finally:
+            watcher.close()
+
+    def poll_watch(self):
+        if self.watcher is None:
+            return
+        if self.engine.done() and not self.watch_found.empty():
+            converter = self.engine.result()
+            options = converter.ConversionOptions(format=self.format_var.get(),
+                                                  preset=self.preset_var.get())
+            try:
+                converter.check_options(options)
+            except converter.ConversionError as e:
+                self.stop_watch()
+                messagebox.showerror("Format Not Available", str(e))
+                return
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+            while not self.watch_found.empty():
+                future = self.executor.submit(converter.convert, self.watch_found.get(),
+                                              None, options)
+                # Noted on the worker thread, before the watcher sees the output settle
+                future.add_done_callback(self.note_watch_output)
+                future.add_done_callback(self.watch_done.put)
+
+        while not self.watch_done.empty():
+            if self.watch_done.get().exception() is None:
+                self.watch_converted += 1
             else:
-                image.save(output_file, "PNG")
-            
-            messagebox.showinfo("Success", 
-                              f"File converted successfully!\nSaved as: {os.path.basename(output_file)}")
-            
-            # Reset
-            self.current_file = None
-            self.file_path_var.set("No file selected")
-            self.convert_btn.config(state=tk.DISABLED)
-            
-        except Exception as e:
-            messagebox.showerror("Conversion Error", 
-                               f"Failed to convert file:\n{str(e)}")
+                self.watch_failed += 1
+            self.update_watch_status()
+        self.root.after(WATCH_POLL_MS, self.poll_watch)
 
-if __name__ == "__main__":
+    def note_watch_output(self, future):
+        if future.exception() is None:
+            self.watch_outputs.add(os.path.abspath(future.result().dst))
+
+    def update_watch_status(self):
+        status = f"Watching {self.watch_folder}: {self.watch_converted} converted"
+        if self.watch_failed:
+            status += f", {self.watch_failed} failed"
+        self.watch_status_var.set(status)
+
+    def finish_batch(self):
+        failed = [(p, e) for p, _, e in self.batch_results if e is not None]
+        converted = len(self.batch_results) - len(failed)
+
+        # Reset
+        self.batch_total = 0
+        self.file_path_var.set("No file selected")
+        self.convert_btn.config(state=tk.DISABLED)
+
+        if failed:
+            details = "\n".join(f"{os.path.basename(p)}: {e}" for p, e in failed[:10])
+            if len(failed) > 10:
+                details += f"\n...and {len(failed) - 10} more"
+            messagebox.showerror("Conversion Error",
+                                 f"Converted {converted} of {len(self.batch_results)} files.\n"
+                                 f"Failed to convert:\n{details}\n\n"
+                                 f"{self.batch_metrics.summary()}")
+        elif converted == 1:
+            output_file = self.batch_results[0][1].dst
+            messagebox.showinfo("Success",
+                                f"File converted successfully!\nSaved as: {os.path.basename(output_file)}")
+        else:
+            messagebox.showinfo("Success",
+                                f"{converted} files converted successfully!\n\n"
+                                f"{self.batch_metrics.summary()}")
+
+
+def measure_startup(root, app, log_path=None):
+    """
+    Report how long the window took to appear and the engine took to load, then quit.
+
+    Args:
+        root (tk.Tk): The application window, before mainloop
+        app (HEICConverter): The application driving root
+        log_path (str): If given, the JSON report is appended here as one line
+            instead of printed; windowed builds have no console to print to
+    """
+    root.wait_visibility(root)
+    root.update_idletasks()
+    first_paint = time.perf_counter()
+    first_paint_wall = time.time()
+    app.start_engine_load()
+    app.engine.result()
+    engine_ready = time.perf_counter()
+
+    report = {
+        'frozen': bool(getattr(sys, 'frozen', False)),
+        'first_paint_s': round(first_paint - _STARTED, 4),
+        'engine_ready_s': round(engine_ready - _STARTED, 4),
+    }
+    launched = os.environ.get(LAUNCH_TIME_ENV)
+    if launched:
+        report['launch_to_first_paint_s'] = round(first_paint_wall - float(launched), 4)
+
+    line = json.dumps(report)
+    if log_path:
+        with open(log_path, 'a') as f:
+            f.write(line + '\n')
+    else:
+        print(line)
+    root.destroy()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
     root = TkinterDnD.Tk()
     app = HEICConverter(root)
-    root.mainloop()
\ No newline at end of file
+    if argv and argv[0] == '--measure-startup':
+        measure_startup(root, app, argv[1] if len(argv) > 1 else None)
+        return
+    root.mainloop()
+
+
+if __name__ == "__main__":
+    main()
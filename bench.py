@@ -0,0 +1,485 @@
+"""
+Benchmark suite for HEIC to JPG/PNG Converter
+Times each stage of the conversion hot path on synthetic HEIC fixtures
+
+Usage:
+    python bench.py [--suite convert|flatten|bounded|presets|resize|hdr] [--sizes 1,12,48]
+                    [--modes RGB,RGBA] [--repeat 5] [--output FILE] [--compare FILE]
+
+Fixtures are generated locally on first use and cached in .bench_fixtures/.
+Every fixture is generated and measured in its own fresh Python process, so
+peak RSS figures are per fixture rather than cumulative. Linux carries the
+peak RSS across exec, so a child of a parent that had built a 48 MP fixture
+would otherwise report the parent's peak as its own. Results are written as JSON (by default
+to bench_results/<commit>-<suite>.json) and can be compared with an earlier run.
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+FIXTURE_DIR = '.bench_fixtures'
+RESULTS_DIR = 'bench_results'
+
+# Megapixels -> (width, height), 4:3 like phone photos
+RESOLUTIONS = {
+    1: (1152, 864),
+    12: (4032, 3024),
+    48: (8064, 6048),
+}
+
+REGRESSION_THRESHOLD = 1.10
+
+# Long edges the resize suite scales to
+RESIZE_EDGES = (2048, 512, 128)
+
+# Fixture modes with 10 bits per sample: an SDR image and a PQ (HDR) one
+HDR_MODES = ('RGB10', 'PQ10')
+
+# nclx profile of the PQ fixture: BT.2020 primaries and matrix, PQ transfer
+PQ_NCLX = {'color_primaries': 9, 'transfer_characteristics': 16, 'matrix_coefficients': 9,
+           'full_range_flag': 1}
+
+
+def resolution_for(megapixels):
+    """Return a 4:3 (width, height) with roughly the given megapixels"""
+    if megapixels in RESOLUTIONS:
+        return RESOLUTIONS[megapixels]
+    height = max(16, int((megapixels * 1e6 * 3 / 4) ** 0.5))
+    return height * 4 // 3, height
+
+
+def fixture_path(megapixels, mode, fixture_dir=FIXTURE_DIR):
+    return os.path.join(fixture_dir, f"{megapixels:g}mp_{mode.lower()}.heic")
+
+
+def make_fixture(megapixels, mode, fixture_dir=FIXTURE_DIR):
+    """Create (or reuse) a deterministic synthetic HEIC with photo-like detail"""
+    from PIL import Image
+    import pillow_heif
+
+    path = fixture_path(megapixels, mode, fixture_dir)
+    if os.path.exists(path):
+        return path
+    os.makedirs(fixture_dir, exist_ok=True)
+
+    size = resolution_for(megapixels)
+    base = (1024, 768)
+    detail = Image.effect_mandelbrot(base, (-2.2, -1.2, 1.0, 1.2), 100)
+    red = Image.linear_gradient('L').resize(base)
+    blue = Image.radial_gradient('L').resize(base)
+    image = Image.merge('RGB', (red, detail, blue)).resize(size, Image.BICUBIC)
+    if mode == 'RGBA':
+        alpha = Image.radial_gradient('L').resize(size, Image.BILINEAR)
+        image.putalpha(alpha)
+    if mode in HDR_MODES:
+        import numpy as np
+
+        # 10-bit samples, with a fine ramp in the two low bits so they carry detail
+        samples = np.asarray(image, np.uint16) << 8
+        samples |= (np.arange(size[0], dtype=np.uint16) % 4 << 6)[None, :, None]
+        heif_file = pillow_heif.from_bytes(mode='RGB;16', size=size, data=samples.tobytes())
+        nclx = PQ_NCLX if mode == 'PQ10' else None
+        heif_file.save(path, quality=85, nclx_profile=nclx)
+        return path
+
+    pillow_heif.from_pillow(image).save(path, quality=85)
+    return path
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, or None where unsupported"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def time_stage(func, repeat):
+    """Run func repeat times and return (median seconds, last return value)"""
+    timings = []
+    value = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), value
+
+
+def suite_convert(path, repeat):
+    """Decode, alpha flatten, JPEG q95 encode and PNG encode, timed separately"""
+    from PIL import Image
+    import converter
+
+    converter.register_opener()
+
+    def decode():
+        image = Image.open(path)
+        image.load()
+        return image
+
+    stages = []
+    decode_s, image = time_stage(decode, repeat)
+    stages.append({'stage': 'decode', 'seconds': decode_s, 'bytes': os.path.getsize(path)})
+
+    flat = image
+    if image.mode in ('RGBA', 'LA', 'P'):
+        flatten_s, flat = time_stage(lambda: converter.flatten_alpha(image), repeat)
+        stages.append({'stage': 'flatten', 'seconds': flatten_s})
+
+    jpg = converter.ConversionOptions(format='JPG', quality=95)
+    png = converter.ConversionOptions(format='PNG')
+    jpeg_s, jpeg_bytes = time_stage(lambda: converter.encode_bytes(flat, jpg), repeat)
+    png_s, png_bytes = time_stage(lambda: converter.encode_bytes(image, png), repeat)
+    stages.append({'stage': 'encode_jpeg_q95', 'seconds': jpeg_s, 'bytes': len(jpeg_bytes)})
+    stages.append({'stage': 'encode_png', 'seconds': png_s, 'bytes': len(png_bytes)})
+    return image.size, stages
+
+
+def legacy_flatten(image, background=(255, 255, 255)):
+    """The original split()-based flattening from app.py, kept as a reference"""
+    from PIL import Image
+
+    flattened = Image.new('RGB', image.size, background)
+    if image.mode == 'P':
+        image = image.convert('RGBA')
+    flattened.paste(image, mask=image.split()[-1] if image.mode == 'RGBA' else None)
+    return flattened
+
+
+def count_allocations(func):
+    """Return how many Pillow image buffers func allocates"""
+    from PIL import Image
+
+    Image.core.reset_stats()
+    func()
+    return Image.core.get_stats()['new_count']
+
+
+def suite_flatten(path, repeat):
+    """Legacy split()/paste flattening against the single-pass path"""
+    from PIL import Image
+    import converter
+
+    converter.register_opener()
+    image = Image.open(path)
+    image.load()
+    if image.mode != 'RGBA':
+        image.putalpha(Image.linear_gradient('L').resize(image.size))
+
+    stages = []
+    for name, func in (('flatten_legacy', legacy_flatten),
+                       ('flatten', converter.flatten_alpha)):
+        seconds, _ = time_stage(lambda: func(image), repeat)
+        stages.append({'stage': name, 'seconds': seconds,
+                       'allocations': count_allocations(lambda: func(image))})
+    return image.size, stages
+
+
+def suite_bounded(path, repeat):
+    """End-to-end JPEG conversion in memory-limited mode, with the header estimate"""
+    import tempfile
+    from PIL import Image
+    import converter
+
+    converter.register_opener()
+    with Image.open(path) as image:
+        size, mode = image.size, image.mode
+    # A limit just above the estimate, so nothing is downscaled or refused
+    decode_bytes, needed = converter.estimate_memory(size, mode)
+    options = converter.ConversionOptions(memory_limit=needed + 1)
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        dst = os.path.join(out_dir, 'out.jpg')
+        seconds, _ = time_stage(lambda: converter.convert(path, dst, options), repeat)
+    return size, [{'stage': 'convert_bounded', 'seconds': seconds,
+                   'estimated_decode_mb': decode_bytes / 2**20,
+                   'estimated_peak_mb': needed / 2**20}]
+
+
+def suite_presets(path, repeat):
+    """Encode time and output size for every format and encoder preset"""
+    from PIL import Image
+    import converter
+
+    converter.register_opener()
+    image = Image.open(path)
+    image.load()
+    formats = converter.available_formats()
+
+    stages = []
+    for format in formats:
+        for preset in converter.PRESETS:
+            options = converter.ConversionOptions(format=format, preset=preset)
+            prepared = converter.prepare_image(image, options)
+            seconds, data = time_stage(lambda: converter.encode_bytes(prepared, options), repeat)
+            stages.append({'stage': f"{format.lower()}_{preset}", 'seconds': seconds,
+                           'bytes': len(data)})
+    return image.size, stages
+
+
+def suite_resize(path, repeat):
+    """The reduce-then-LANCZOS fast path against a plain LANCZOS resize, in time and PSNR"""
+    from PIL import Image
+    import converter
+
+    converter.register_opener()
+    image = Image.open(path)
+    image.load()
+
+    stages = []
+    for edge in RESIZE_EDGES:
+        options = converter.ConversionOptions(max_edge=edge)
+        plan = converter.resize_plan(image.size, options)
+        if plan is None:
+            continue
+        size = plan[0]
+        plain_s, reference = time_stage(lambda: image.resize(size, Image.LANCZOS), repeat)
+        fast_s, fast = time_stage(lambda: converter.resize_image(image, options), repeat)
+        score = converter.psnr(fast, reference)
+        stages.append({'stage': f"resize_lanczos_{edge}", 'seconds': plain_s})
+        stages.append({'stage': f"resize_fast_{edge}", 'seconds': fast_s,
+                       'psnr_db': score if math.isfinite(score) else None,
+                       'reduce_factor': converter.reduce_factor(image.size, options)})
+    return image.size, stages
+
+
+def suite_hdr(path, repeat):
+    """
+    10-bit images through libheif's 8-bit output against the high bit depth path.
+
+    The decode stages compare libheif converting to 8 bits while decoding
+    with decoding 16 bits and tone-mapping them; decode_8bit's PSNR is
+    against the tone-mapped image, which for SDR is exact rounding. The
+    convert stages run both paths end to end to JPG and PNG.
+    """
+    import tempfile
+    from PIL import Image
+    import pillow_heif
+    import converter
+    import hdr
+
+    converter.register_opener()
+    info = pillow_heif.open_heif(path, convert_hdr_to_8bit=False).info
+    bit_depth = info['bit_depth']
+    transfer = (info.get('nclx_profile') or {}).get('transfer_characteristics')
+
+    def decode_8bit():
+        image = Image.open(path)
+        image.load()
+        return image
+
+    def decode_16bit():
+        heif_file = pillow_heif.open_heif(path, convert_hdr_to_8bit=False)
+        return hdr.decode(heif_file[heif_file.primary_index])
+
+    eight_s, image = time_stage(decode_8bit, repeat)
+    deep_s, samples = time_stage(decode_16bit, repeat)
+    map_s, mapped = time_stage(lambda: hdr.to_8bit(samples, bit_depth, transfer), repeat)
+    score = converter.psnr(image, mapped)
+    stages = [
+        {'stage': 'decode_8bit', 'seconds': eight_s,
+         'psnr_db': score if math.isfinite(score) else None},
+        {'stage': 'decode_16bit', 'seconds': deep_s},
+        {'stage': 'tonemap', 'seconds': map_s},
+    ]
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        for format in ('JPG', 'PNG'):
+            options = converter.ConversionOptions(format=format)
+            dst = converter.output_path(os.path.join(out_dir, 'out'), options)
+            # libheif's 8-bit output, as the generic path uses for SDR images
+            converter._high_bit_depth = False
+            generic_s, _ = time_stage(lambda: converter.convert(path, dst, options), repeat)
+            generic_bytes = os.path.getsize(dst)
+            converter._high_bit_depth = None
+            deep_s, _ = time_stage(lambda: converter._convert_high_bit_depth(
+                path, dst, options, converter.NullMetrics()), repeat)
+            stages.append({'stage': f"convert_{format.lower()}_libheif", 'seconds': generic_s,
+                           'bytes': generic_bytes})
+            stages.append({'stage': f"convert_{format.lower()}_deep", 'seconds': deep_s,
+                           'bytes': os.path.getsize(dst)})
+    return image.size, stages
+
+
+SUITES = {
+    'bounded': suite_bounded,
+    'convert': suite_convert,
+    'flatten': suite_flatten,
+    'hdr': suite_hdr,
+    'presets': suite_presets,
+    'resize': suite_resize,
+}
+
+
+def run_worker(suite, path, repeat):
+    """Measure one fixture in this process and print the JSON result"""
+    size, stages = SUITES[suite](path, repeat)
+    megapixels = size[0] * size[1] / 1e6
+    for stage in stages:
+        seconds = stage['seconds']
+        stage['images_per_s'] = 1 / seconds if seconds else None
+        stage['mp_per_s'] = megapixels / seconds if seconds else None
+    print(json.dumps({
+        'fixture': os.path.basename(path),
+        'suite': suite,
+        'size': list(size),
+        'megapixels': round(megapixels, 2),
+        'stages': stages,
+        'peak_rss_mb': peak_rss_mb(),
+    }))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def environment():
+    import PIL
+    import pillow_heif
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'pillow': PIL.__version__,
+        'pillow_heif': pillow_heif.__version__,
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def ensure_fixture(megapixels, mode, fixture_dir=FIXTURE_DIR):
+    """Create a fixture in a subprocess so this process's peak RSS stays small"""
+    path = fixture_path(megapixels, mode, fixture_dir)
+    if not os.path.exists(path):
+        subprocess.check_call(
+            [sys.executable, os.path.abspath(__file__), '--make-fixture', f"{megapixels:g}",
+             '--modes', mode, '--fixtures', fixture_dir])
+    return path
+
+
+def run_suite(suite, sizes, modes, repeat, fixture_dir=FIXTURE_DIR):
+    """Measure every fixture in a fresh subprocess and collect the results"""
+    results = []
+    for megapixels in sizes:
+        for mode in modes:
+            path = ensure_fixture(megapixels, mode, fixture_dir)
+            print(f"[{suite}] {os.path.basename(path)}...", file=sys.stderr)
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), '--worker', path,
+                 '--suite', suite, '--repeat', str(repeat)])
+            results.append(json.loads(output.decode().strip().splitlines()[-1]))
+    return results
+
+
+def print_table(results):
+    print(f"{'fixture':<18} {'stage':<22} {'ms':>9} {'img/s':>8} {'MP/s':>8} {'KB':>9} "
+          f"{'RSS MB':>8}")
+    for result in results:
+        for stage in result['stages']:
+            rss = result['peak_rss_mb']
+            size = stage.get('bytes')
+            print(f"{result['fixture']:<18} {stage['stage']:<22} "
+                  f"{stage['seconds'] * 1000:>9.1f} "
+                  f"{stage['images_per_s'] or 0:>8.1f} {stage['mp_per_s'] or 0:>8.1f} "
+                  f"{size / 1024 if size is not None else float('nan'):>9.1f} "
+                  f"{rss if rss is not None else float('nan'):>8.0f}")
+
+
+def compare(current, baseline_path):
+    """Print per-stage time ratios against an earlier run; returns True on regression"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    previous = {(r['suite'], r['fixture'], s['stage']): s['seconds']
+                for r in baseline['results'] for s in r['stages']}
+
+    regressed = False
+    print(f"\nCompared with {baseline_path} (commit {baseline.get('commit', '?')}):")
+    for result in current['results']:
+        for stage in result['stages']:
+            before = previous.get((result['suite'], result['fixture'], stage['stage']))
+            if not before:
+                continue
+            ratio = stage['seconds'] / before
+            flag = ''
+            if ratio > REGRESSION_THRESHOLD:
+                flag = '  REGRESSION'
+                regressed = True
+            print(f"  {result['fixture']:<18} {stage['stage']:<22} x{ratio:.2f}{flag}")
+    return regressed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the HEIC conversion hot path.")
+    parser.add_argument('--suite', default='convert', choices=sorted(SUITES))
+    parser.add_argument('--sizes', default='1,12,48',
+                        help="Comma-separated fixture sizes in megapixels (default: 1,12,48)")
+    parser.add_argument('--modes',
+                        help="Comma-separated fixture modes: RGB, RGBA, RGB10 (10-bit SDR) "
+                             "or PQ10 (10-bit HDR) (default: RGB10,PQ10 for the hdr suite, "
+                             "otherwise RGB,RGBA)")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Timed runs per stage; the median is reported (default: 5)")
+    parser.add_argument('--fixtures', default=FIXTURE_DIR,
+                        help=f"Directory for generated fixtures (default: {FIXTURE_DIR})")
+    parser.add_argument('--output', help="Where to write the JSON results "
+                                         "(default: bench_results/<commit>-<suite>.json)")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="Earlier results to compare against; exits 1 on a regression")
+    parser.add_argument('--worker', metavar='FIXTURE', help=argparse.SUPPRESS)
+    parser.add_argument('--make-fixture', metavar='MP', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def parse_sizes(value):
+    return [float(s) if '.' in s else int(s) for s in value.split(',') if s.strip()]
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    default_modes = ','.join(HDR_MODES) if args.suite == 'hdr' else 'RGB,RGBA'
+    modes = [m.strip().upper() for m in (args.modes or default_modes).split(',') if m.strip()]
+    if args.worker:
+        run_worker(args.suite, args.worker, args.repeat)
+        return 0
+    if args.make_fixture:
+        for megapixels in parse_sizes(args.make_fixture):
+            for mode in modes:
+                make_fixture(megapixels, mode, args.fixtures)
+        return 0
+
+    sizes = parse_sizes(args.sizes)
+    commit = git_commit()
+    report = {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': environment(),
+        'results': run_suite(args.suite, sizes, modes, args.repeat, args.fixtures),
+    }
+    print_table(report['results'])
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{commit}-{args.suite}.json")
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.compare and compare(report, args.compare):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,220 @@
+"""
+Incremental conversion cache for HEIC to JPG/PNG Converter
+Records converted inputs in a SQLite manifest so unchanged files can be skipped
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from dataclasses import asdict
+
+MANIFEST_NAME = '.heic2img-cache.sqlite'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Recorded entries are committed after this many records or seconds, whichever
+# comes first, so an interrupted batch keeps most of its progress
+COMMIT_EVERY = 100
+COMMIT_INTERVAL = 5.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    src TEXT NOT NULL,
+    options TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    dst TEXT NOT NULL,
+    dst_size INTEGER NOT NULL,
+    dst_mtime_ns INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (src, options)
+);
+CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest, options);
+"""
+
+
+def file_digest(path):
+    """Return a streaming BLAKE2b hex digest of the file at path"""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def options_key(options):
+    """Return a stable string identifying the conversion settings"""
+    return json.dumps(asdict(options), sort_keys=True)
+
+
+class ConversionCache:
+    """
+    SQLite manifest of completed conversions, stored in the output directory.
+
+    An input is considered unchanged when its path, size and options match a
+    recorded entry and the output it produced is still in place. The content
+    hash is only computed when the modification time has changed, so a resync
+    of an untouched library costs one stat per file.
+
+    Args:
+        directory (str): Output directory the manifest lives in
+        name (str): Manifest file name
+        commit_every (int): Commit after this many new records
+        commit_interval (float): Commit once this many seconds have passed
+            since the last commit, at the next record
+    """
+
+    def __init__(self, directory, name=MANIFEST_NAME, commit_every=COMMIT_EVERY,
+                 commit_interval=COMMIT_INTERVAL):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, name)
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(_SCHEMA)
+        self.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
+
+    def commit(self):
+        self.conn.commit()
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
+
+    def is_fresh(self, src, dst, options):
+        """Return True if src was already converted to dst with these options"""
+        src, dst = os.path.abspath(src), os.path.abspath(dst)
+        key = options_key(options)
+        row = self.conn.execute(
+            "SELECT size, mtime_ns, digest, dst, dst_size, dst_mtime_ns FROM entries "
+            "WHERE src = ? AND options = ?", (src, key)).fetchone()
+        if row is None:
+            return False
+        size, mtime_ns, digest, recorded_dst, dst_size, dst_mtime_ns = row
+        if recorded_dst != dst:
+            return False
+
+        try:
+            src_stat = os.stat(src)
+            dst_stat = os.stat(dst)
+        except OSError:
+            return False
+        if dst_stat.st_size != dst_size or dst_stat.st_mtime_ns != dst_mtime_ns:
+            return False
+        if src_stat.st_size != size:
+            return False
+
+        if src_stat.st_mtime_ns != mtime_ns:
+            # Touched but possibly unchanged (e.g. re-synced); fall back to the content hash
+            if file_digest(src) != digest:
+                return False
+            self.conn.execute(
+                "UPDATE entries SET mtime_ns = ? WHERE src = ? AND options = ?",
+                (src_stat.st_mtime_ns, src, key))
+
+        self.conn.execute("UPDATE entries SET last_used = ? WHERE src = ? AND options = ?",
+                          (time.time(), src, key))
+        return True
+
+    def recorded_output(self, src, options):
+        """Return the output src was last converted to with these options, or None"""
+        row = self.conn.execute("SELECT dst FROM entries WHERE src = ? AND options = ?",
+                                (os.path.abspath(src), options_key(options))).fetchone()
+        return row[0] if row else None
+
+    def input_sizes(self, options):
+        """Return the sizes of every input recorded with these options"""
+        rows = self.conn.execute("SELECT DISTINCT size FROM entries WHERE options = ?",
+                                 (options_key(options),))
+        return {size for size, in rows}
+
+    def find_output(self, digest, options):
+        """
+        Return an output still in place that was converted from content with this digest.
+
+        Args:
+            digest (str): Content hash of an input, from file_digest()
+            options (ConversionOptions): Settings the output must have been made with
+
+        Returns:
+            str: Path of the output, or None if there is none
+        """
+        rows = self.conn.execute(
+            "SELECT dst, dst_size, dst_mtime_ns FROM entries WHERE digest = ? AND options = ? "
+            "ORDER BY last_used DESC", (digest, options_key(options)))
+        for dst, dst_size, dst_mtime_ns in rows:
+            try:
+                stat = os.stat(dst)
+            except OSError:
+                continue
+            if stat.st_size == dst_size and stat.st_mtime_ns == dst_mtime_ns:
+                return dst
+        return None
+
+    def record(self, src, dst, options, digest=None):
+        """
+        Remember that src was converted to dst with these options.
+
+        Args:
+            src (str): Input file
+            dst (str): Output file it was converted to
+            options (ConversionOptions): Settings used for the conversion
+            digest (str): Content hash of src if the caller already has it
+                (e.g. computed by a worker); otherwise src is hashed here
+        """
+        src, dst = os.path.abspath(src), os.path.abspath(dst)
+        src_stat = os.stat(src)
+        dst_stat = os.stat(dst)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (src, options_key(options), src_stat.st_size, src_stat.st_mtime_ns,
+             digest or file_digest(src), dst, dst_stat.st_size, dst_stat.st_mtime_ns,
+             time.time()))
+        self._uncommitted += 1
+        if (self._uncommitted >= self.commit_every
+                or time.monotonic() - self._last_commit >= self.commit_interval):
+            self.commit()
+
+    def prune(self, max_entries=None):
+        """
+        Drop entries whose source files are gone, least recently used first.
+
+        Args:
+            max_entries (int): If set, also evict the least recently used
+                entries until at most this many remain
+
+        Returns:
+            int: Number of entries removed
+        """
+        rows = self.conn.execute(
+            "SELECT src, options FROM entries ORDER BY last_used").fetchall()
+        gone = [(src, key) for src, key in rows if not os.path.exists(src)]
+        self.conn.executemany("DELETE FROM entries WHERE src = ? AND options = ?", gone)
+        removed = len(gone)
+
+        if max_entries is not None:
+            remaining = len(rows) - removed
+            if remaining > max_entries:
+                cursor = self.conn.execute(
+                    "DELETE FROM entries WHERE rowid IN "
+                    "(SELECT rowid FROM entries ORDER BY last_used LIMIT ?)",
+                    (remaining - max_entries,))
+                removed += cursor.rowcount
+        self.conn.commit()
+        return removed
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
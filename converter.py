@@ -0,0 +1,1239 @@
+"""
+Conversion engine for HEIC to JPG/PNG Converter
+Decodes HEIC images and encodes them to JPG, PNG, WebP, AVIF or JPEG XL without any GUI dependencies
+"""
+
+import importlib.util
+import io
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, replace
+
+from PIL import Image, ImageChops
+import pillow_heif
+
+# Output format name -> (file extension, Pillow format)
+FORMATS = {
+    'JPG': ('.jpg', 'JPEG'),
+    'PNG': ('.png', 'PNG'),
+    'WEBP': ('.webp', 'WEBP'),
+    'AVIF': ('.avif', 'AVIF'),
+    'JXL': ('.jxl', 'JXL'),
+}
+
+# Output formats that can store transparency
+ALPHA_FORMATS = ('PNG', 'WEBP', 'AVIF', 'JXL')
+
+# Pillow formats that take the quality setting
+_LOSSY_FORMATS = ('JPEG', 'WEBP', 'AVIF', 'JXL')
+
+# Optional Pillow plugins that add an output format when installed
+_FORMAT_PLUGINS = {'JXL': 'pillow_jxl'}
+
+# Encoder settings per preset and Pillow format. 'balanced' matches the encoder defaults
+PRESETS = {
+    'fast': {
+        'JPEG': {'optimize': False, 'progressive': False, 'subsampling': '4:2:0'},
+        'PNG': {'compress_level': 1},
+        'WEBP': {'method': 0},
+        'AVIF': {'speed': 10},
+        'JXL': {'effort': 1},
+    },
+    'balanced': {
+        'JPEG': {},
+        'PNG': {'compress_level': 6},
+        'WEBP': {'method': 4},
+        'AVIF': {'speed': 6},
+        'JXL': {'effort': 7},
+    },
+    'smallest': {
+        'JPEG': {'optimize': True, 'progressive': True, 'subsampling': '4:2:0'},
+        'PNG': {'compress_level': 9, 'optimize': True},
+        'WEBP': {'method': 6},
+        'AVIF': {'speed': 2},
+        'JXL': {'effort': 9},
+    },
+}
+
+# How a resize meets max_edge: 'fit' keeps the whole image, 'fill' crops it to a square
+RESIZE_FITS = ('fit', 'fill')
+
+# Large reductions first shrink by an integer factor with a box filter, stopping
+# while the image is still at least this many times the target size; LANCZOS
+# resamples the rest of the way
+REDUCING_GAP = 2.0
+
+# Output formats whose quality can be searched for a target size or PSNR floor
+SEARCH_FORMATS = ('JPG', 'WEBP')
+
+# Lowest quality a search goes down to
+MIN_SEARCH_QUALITY = 5
+
+# A search stops once an attempt meets its goal this closely: within 5% under
+# target_bytes, or within half a dB over min_psnr
+TARGET_TOLERANCE = 0.05
+PSNR_TOLERANCE = 0.5
+
+# How output size (natural log) and PSNR (dB) typically change with quality,
+# relative to quality 75, at qualities 5, 10, ... 100. Measured on photo-like
+# images at 0.5-12 MP; images differ mostly by an offset, so a search follows
+# these curves and measures the offset as it goes
+_QUALITY_CURVES = {
+    'JPEG': ((-1.23, -1.08, -0.93, -0.81, -0.71, -0.62, -0.54, -0.49, -0.42, -0.37,
+              -0.32, -0.26, -0.18, -0.09, 0.0, 0.13, 0.29, 0.51, 0.87, 1.58),
+             (-11.5, -7.8, -6.0, -5.0, -4.2, -3.6, -3.1, -2.7, -2.4, -2.1,
+              -1.8, -1.4, -1.0, -0.5, 0.0, 0.6, 1.3, 2.1, 2.9, 3.4)),
+    'WEBP': ((-1.15, -1.01, -0.88, -0.79, -0.69, -0.61, -0.53, -0.45, -0.38, -0.31,
+              -0.25, -0.19, -0.13, -0.06, 0.0, 0.21, 0.43, 0.74, 1.15, 1.5),
+             (-5.1, -4.4, -3.8, -3.3, -2.8, -2.4, -2.1, -1.7, -1.4, -1.1,
+              -0.9, -0.6, -0.4, -0.2, 0.0, 0.6, 1.2, 1.9, 2.4, 2.7)),
+}
+
+# The offset is first estimated from a copy of the image reduced to about
+# _SAMPLE_EDGE pixels and encoded at quality 75. The sample packs more detail
+# into each pixel, so the full image takes about _SAMPLE_DETAIL times its bytes
+# per pixel, and scores about _SAMPLE_PSNR_GAIN dB more per doubling of the
+# reduction factor
+_SAMPLE_EDGE = 256
+_SAMPLE_DETAIL = 0.4
+_SAMPLE_PSNR_GAIN = 2.8
+
+# Decoded rows are copied out of libheif's buffer in strips of about this size
+STRIP_BYTES = 1024 * 1024
+
+# Metadata copied from the HEIC into the output, as Pillow save() parameters
+METADATA_KEYS = ('exif', 'icc_profile', 'xmp')
+
+# Largest EXIF block a JPEG APP1 marker can hold
+_JPEG_MAX_EXIF = 65533
+
+# Bytes Pillow stores per pixel; three-band images are padded to four
+_PILLOW_PIXEL_BYTES = {'L': 1, 'P': 1, 'I;16': 2}
+
+# libheif's working set above the planes it decodes into, measured on 8-bit 4:2:0 files
+_DECODE_OVERHEAD = 1.15
+
+_opener_registered = False
+# Whether numpy, which the high bit depth path needs, can be imported; checked on first use
+_high_bit_depth = None
+# Formats known to be encodable, filled in on first use
+_LOADED_FORMATS = []
+
+
+class ConversionError(Exception):
+    """Raised when an image cannot be converted"""
+
+
+class MemoryLimitError(ConversionError):
+    """Raised when an image cannot be converted within the configured memory limit"""
+
+
+@dataclass
+class ConversionOptions:
+    """Settings that control how an image is converted"""
+    format: str = 'JPG'
+    quality: int = 95
+    background: tuple = (255, 255, 255)
+    # Long-edge pixel sizes; when set, previews are written instead of a full-size image
+    thumbnail_sizes: tuple = ()
+    # 'primary', 'all', or the index of one top-level image in the container
+    frames: object = 'primary'
+    depth_images: bool = False
+    aux_images: bool = False
+    # Peak bytes a conversion may use; 0 means no limit
+    memory_limit: int = 0
+    # Downscale by an integer factor instead of failing when full size does not fit the limit
+    downscale_to_fit: bool = False
+    # Encoder effort: 'fast', 'balanced' or 'smallest' (see PRESETS)
+    preset: str = 'balanced'
+    # Leave out the EXIF, ICC profile and XMP metadata the HEIC carries
+    strip_metadata: bool = False
+    # Longest edge of the output in pixels (the side of the square with fit='fill'); 0 keeps it
+    max_edge: int = 0
+    # Most pixels the output may have, in millions; 0 means no limit
+    max_megapixels: float = 0
+    # 'fit' or 'fill' (see RESIZE_FITS)
+    fit: str = 'fit'
+    # Largest output in bytes; quality is searched downwards from quality to fit it. 0 is off
+    target_bytes: int = 0
+    # Lowest PSNR in dB the output may have against the prepared image; quality is
+    # searched for the smallest output that reaches it. 0 is off
+    min_psnr: float = 0
+    # Write 16-bit PNG from 10- and 12-bit images; off writes 8-bit PNG like the other formats
+    keep_bit_depth: bool = True
+
+
+@dataclass
+class ConversionResult:
+    """Outcome of a single successful conversion"""
+    src: str
+    dst: str
+    format: str
+    size: tuple
+    mode: str
+
+
+class NullMetrics:
+    """Stand-in for metrics.FileMetrics when the caller does not collect metrics"""
+    input_bytes = 0
+    output_bytes = 0
+    quality = None
+    encode_attempts = 0
+
+    def stage(self, name):
+        return nullcontext()
+
+
+def decodes_high_bit_depth(info, options):
+    """
+    Return True if an image with this info goes through the high bit depth path.
+
+    That path (see hdr.py) decodes 10- and 12-bit images at full depth. It
+    is taken for 16-bit PNG output, and for PQ and HLG images, whose signal
+    looks flat and dark when its low bits are simply dropped. Other 10- and
+    12-bit images are left to libheif, which converts them to 8 bits while
+    decoding; that is faster than decoding 16 bits and mapping them, and
+    within a fraction of a level of exact rounding (see bench.py --suite hdr).
+    The path needs numpy; without it libheif converts every image.
+    """
+    global _high_bit_depth
+    if (info.get('bit_depth') or 8) <= 8:
+        return False
+    if _high_bit_depth is None:
+        _high_bit_depth = importlib.util.find_spec('numpy') is not None
+    if not _high_bit_depth:
+        return False
+    import hdr
+    return (options.format == 'PNG' and options.keep_bit_depth) or hdr.is_hdr(
+        info.get('nclx_profile'))
+
+
+def register_opener():
+    """Register the HEIF plugin with Pillow once per process"""
+    global _opener_registered
+    if not _opener_registered:
+        pillow_heif.register_heif_opener()
+        _opener_registered = True
+
+
+def available_formats():
+    """
+    Return the output formats this installation can encode.
+
+    AVIF needs Pillow built with libavif (11.2 or later) and JPEG XL needs the
+    pillow_jxl plugin; the other formats are always available.
+    """
+    for name, module in _FORMAT_PLUGINS.items():
+        try:
+            __import__(module)
+        except ImportError:
+            pass
+    Image.init()
+    return [name for name, (_, pil_format) in FORMATS.items() if pil_format in Image.SAVE]
+
+
+def check_options(options):
+    """
+    Raise ConversionError if options name an unknown or unavailable format or
+    preset, or an invalid resize.
+    """
+    if options.max_edge < 0 or options.max_megapixels < 0:
+        raise ConversionError("Resize limits must not be negative")
+    if options.fit not in RESIZE_FITS:
+        raise ConversionError(f"Unknown fit: {options.fit}")
+    if options.fit == 'fill' and not options.max_edge:
+        raise ConversionError("fit='fill' needs max_edge, the side of the square to fill")
+    if options.target_bytes < 0 or options.min_psnr < 0:
+        raise ConversionError("target_bytes and min_psnr must not be negative")
+    if searches_quality(options) and options.format not in SEARCH_FORMATS:
+        raise ConversionError(f"A target size or PSNR floor needs "
+                              f"{' or '.join(SEARCH_FORMATS)} output, not {options.format}")
+    if options.format not in FORMATS:
+        raise ConversionError(f"Unsupported output format: {options.format}")
+    if options.preset not in PRESETS:
+        raise ConversionError(f"Unknown preset: {options.preset}")
+    if options.format not in _LOADED_FORMATS:
+        _LOADED_FORMATS[:] = available_formats()
+        if options.format not in _LOADED_FORMATS:
+            plugin = _FORMAT_PLUGINS.get(options.format)
+            needs = f"the {plugin} plugin" if plugin else "a Pillow build with its encoder"
+            raise ConversionError(f"{options.format} output is not available; it needs {needs}")
+
+
+def output_path(src, options=None):
+    """
+    Return the default output path for src: same directory, new extension.
+
+    An input already named with the output extension, such as an AVIF file
+    converted to AVIF or a HEIC saved as .jpg, gets a _converted suffix
+    rather than being replaced.
+    """
+    options = options or ConversionOptions()
+    extension = FORMATS[options.format][0]
+    stem, current = os.path.splitext(src)
+    if current.lower() == extension:
+        return f"{stem}_converted{extension}"
+    return stem + extension
+
+
+def thumbnail_path(dst, size):
+    """Return the path of the size-pixel preview for output path dst"""
+    stem, extension = os.path.splitext(dst)
+    return f"{stem}_{size}{extension}"
+
+
+def output_paths(dst, options):
+    """Return every file a conversion to dst writes, largest output first"""
+    if options.thumbnail_sizes:
+        return [thumbnail_path(dst, size) for size in sorted(set(options.thumbnail_sizes),
+                                                             reverse=True)]
+    return [dst]
+
+
+def primary_output(dst, options):
+    """Return the first file a conversion to dst writes, used to track it between runs"""
+    if options.frames == 'all':
+        stem, extension = os.path.splitext(dst)
+        return f"{stem}_frame0{extension}"
+    return output_paths(dst, options)[0]
+
+
+def fit_size(size, max_edge):
+    """Scale (width, height) down so the long edge is at most max_edge"""
+    width, height = size
+    scale = max_edge / max(width, height)
+    if scale >= 1:
+        return size
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def make_thumbnails(image, sizes):
+    """
+    Produce previews at several long-edge sizes from a single decode.
+
+    The HEIF plugin's draft mode swaps in the smallest embedded thumbnail that
+    is still at least as large as the biggest preview, so the full-resolution
+    image is never decoded when the container has one. Otherwise the full image
+    is decoded once, cheaply reduced by an integer factor while staying at twice
+    the largest preview size, and every preview is resampled from that.
+
+    Args:
+        image (PIL.Image.Image): An opened, not yet loaded image
+        sizes (iterable): Long-edge sizes in pixels
+
+    Returns:
+        list: (size, image) pairs, largest size first
+    """
+    sizes = sorted(set(sizes), reverse=True)
+    target = fit_size(image.size, sizes[0])
+    image.draft(None, target)
+    image.load()
+
+    factor = min(image.size[0] // (2 * target[0]), image.size[1] // (2 * target[1]))
+    if factor > 1:
+        image = image.reduce(factor)
+
+    previews = []
+    for size in sizes:
+        preview_size = fit_size(image.size, size)
+        if preview_size == image.size:
+            previews.append((size, image))
+        else:
+            previews.append((size, image.resize(preview_size, Image.LANCZOS, reducing_gap=2.0)))
+    return previews
+
+
+def _frame_indices(frames, count, primary_index):
+    if frames == 'all':
+        return set(range(count))
+    if frames == 'primary':
+        return {primary_index}
+    try:
+        index = int(frames)
+    except (TypeError, ValueError):
+        raise ConversionError(f"Invalid frame selection: {frames!r}")
+    if not 0 <= index < count:
+        raise ConversionError(f"Image index {index} out of range; file has {count} images")
+    return {index}
+
+
+def _aux_name(aux_type):
+    """Turn an auxiliary image URN such as urn:com:apple:photo:2020:aux:hdrgainmap into hdrgainmap"""
+    name = aux_type.rsplit(':', 1)[-1]
+    return ''.join(c if c.isalnum() else '-' for c in name) or 'aux'
+
+
+def iter_images(src, options):
+    """
+    Lazily yield the images selected by options from a HEIF container.
+
+    Only the container headers are parsed up front. Each top-level image is
+    decoded when it is reached and released before the next one is decoded,
+    so memory holds a single frame however many the container has.
+
+    Args:
+        src: Path or file object of the HEIF container
+        options (ConversionOptions): frames, depth_images and aux_images select
+            what is exported
+
+    Yields:
+        tuple: (name suffix, PIL.Image.Image). The suffix is '' for a single
+            selected image, '_frameN' for each image when exporting all of them,
+            followed by '_depth' or an auxiliary type name for extra images
+    """
+    heif_file = pillow_heif.open_heif(src)
+    images = list(heif_file)
+    wanted = _frame_indices(options.frames, len(images), heif_file.primary_index)
+    # The container keeps a reference to every decoded frame; only our list may hold them
+    del heif_file
+
+    for index in range(len(images)):
+        heif_image, images[index] = images[index], None
+        if index not in wanted:
+            continue
+        prefix = f"_frame{index}" if options.frames == 'all' else ""
+        yield prefix, heif_image.to_pillow()
+
+        if options.depth_images:
+            for n, depth in enumerate(heif_image.info.get('depth_images', [])):
+                yield f"{prefix}_depth{n or ''}", depth.to_pillow()
+        if options.aux_images:
+            for aux_type, aux_ids in heif_image.info.get('aux', {}).items():
+                for n, aux_id in enumerate(aux_ids):
+                    suffix = f"{prefix}_{_aux_name(aux_type)}{n or ''}"
+                    yield suffix, heif_image.get_aux_image(aux_id).to_pillow()
+        del heif_image
+
+
+def estimate_memory(size, mode, bit_depth=8, options=None, factor=1):
+    """
+    Estimate the memory a bounded conversion of one image needs, from its header.
+
+    libheif decodes the whole image into YCbCr planes (plus an alpha plane)
+    and converts them into one interleaved buffer. The output image is then
+    built from that buffer a strip at a time, so no full-size intermediate
+    copy is made. The figures were calibrated against peak RSS on 8-bit
+    files and err about 10% on the high side.
+
+    Args:
+        size (tuple): (width, height) of the coded image
+        mode (str): Mode libheif decodes to, such as 'RGB' or 'RGBA'
+        bit_depth (int): Bits per sample in the coded image
+        options (ConversionOptions): Output settings; a resize raises factor to
+            the reduce_factor() it allows, and the resized copy is counted
+        factor (int): Integer downscale applied while copying out of the decoder
+
+    Returns:
+        tuple: (bytes needed to decode, peak bytes for the whole conversion)
+    """
+    options = options or ConversionOptions()
+    width, height = size
+    pixels = width * height
+    has_alpha = 'A' in mode
+    sample_bytes = 2 if bit_depth > 8 else 1
+
+    decoded = pixels * Image.getmodebands(mode)
+    # 4:2:0 luma and chroma planes, plus the alpha plane coded as a second image
+    color_planes = pixels * 1.5 * sample_bytes
+    alpha_plane = color_planes if has_alpha else 0
+    decode_peak = int((decoded + color_planes + alpha_plane) * _DECODE_OVERHEAD)
+
+    out_mode = 'RGB' if options.format not in ALPHA_FORMATS and has_alpha else mode
+    pixel_bytes = _PILLOW_PIXEL_BYTES.get(out_mode, 4)
+    factor = max(factor, reduce_factor(size, options))
+    reduced = (-(-width // factor), -(-height // factor))
+    output = reduced[0] * reduced[1] * pixel_bytes
+    # The allocator keeps the freed color planes, so they still count while the
+    # output is built, as do a copied strip and its downscaled version
+    strip = 2 * min(STRIP_BYTES, decoded)
+    peak = int(decoded + color_planes + output + strip)
+    # The final resample runs once the decoder's buffer is gone
+    plan = resize_plan(reduced, options)
+    if plan is not None:
+        peak = max(peak, output + plan[0][0] * plan[0][1] * pixel_bytes)
+    return decode_peak, max(decode_peak, peak)
+
+
+def _copy_strips(data, size, mode, stride, factor, options):
+    """
+    Build the prepared output image from a decoded buffer, one strip of rows at a time.
+
+    Each strip is downscaled and composited onto the background as it is
+    copied, so no full-size intermediate image is ever allocated.
+    """
+    width, height = size
+    flatten = options.format not in ALPHA_FORMATS and 'A' in mode
+    output = Image.new('RGB' if flatten else mode,
+                       (-(-width // factor), -(-height // factor)),
+                       options.background if flatten else 0)
+
+    # Keep strips a whole number of downscale blocks tall so they line up in the output
+    rows = max(factor, STRIP_BYTES // stride // factor * factor)
+    for top in range(0, height, rows):
+        bottom = min(height, top + rows)
+        strip = Image.frombuffer(mode, (width, bottom - top), data[top * stride:bottom * stride],
+                                 'raw', mode, stride, 1)
+        if factor > 1:
+            strip = strip.reduce(factor)
+        output.paste(strip, (0, top // factor), strip if flatten else None)
+    return output
+
+
+def flatten_alpha(image, background=(255, 255, 255)):
+    """
+    Composite an image with transparency onto a solid background color.
+
+    The image is pasted using itself as the mask, so Pillow blends straight
+    from its alpha band in a single pass. Only the RGB output frame is
+    allocated; no per-channel copies are made with split().
+    """
+    if image.mode == 'P':
+        if 'transparency' not in image.info:
+            return image.convert('RGB')
+        image = image.convert('RGBA')
+    elif image.mode == 'PA':
+        image = image.convert('RGBA')
+    if image.mode not in ('RGBA', 'LA'):
+        return image
+    flattened = Image.new('RGB', image.size, background)
+    flattened.paste(image, mask=image)
+    return flattened
+
+
+def resize_plan(size, options):
+    """
+    Work out the resize that options ask for on an image of the given size.
+
+    Images are only ever made smaller. With fit='fit' the whole image is
+    scaled so its long edge is at most max_edge and it has at most
+    max_megapixels. With fit='fill' it is scaled so the short edge reaches
+    max_edge and then cropped around the center to a square, which
+    max_megapixels can make smaller still.
+
+    Args:
+        size (tuple): (width, height) of the source image
+        options (ConversionOptions): max_edge, max_megapixels and fit
+
+    Returns:
+        tuple: ((width, height) of the output, (left, top, right, bottom)
+            region of the source it is sampled from), or None if the image
+            is already within the limits
+    """
+    width, height = size
+    box = (0, 0, width, height)
+    if options.fit == 'fill' and options.max_edge:
+        side = options.max_edge
+        if options.max_megapixels:
+            side = min(side, int(math.sqrt(options.max_megapixels * 1e6)))
+        crop = min(width, height)
+        side = min(side, crop)
+        left, top = (width - crop) // 2, (height - crop) // 2
+        if side == crop and crop == max(width, height):
+            return None
+        return (side, side), (left, top, left + crop, top + crop)
+
+    scale = 1.0
+    if options.max_edge:
+        scale = min(scale, options.max_edge / max(width, height))
+    if options.max_megapixels:
+        scale = min(scale, math.sqrt(options.max_megapixels * 1e6 / (width * height)))
+    if scale >= 1:
+        return None
+    return (max(1, int(width * scale)), max(1, int(height * scale))), box
+
+
+def reduce_factor(size, options):
+    """
+    Return the integer factor an image of this size can be cheaply shrunk by
+    before its final resample, keeping it at least REDUCING_GAP times the
+    output size. 1 when no resize is needed.
+    """
+    plan = resize_plan(size, options)
+    if plan is None:
+        return 1
+    (out_width, out_height), (left, top, right, bottom) = plan
+    factor = int(min((right - left) / (REDUCING_GAP * out_width),
+                     (bottom - top) / (REDUCING_GAP * out_height)))
+    return max(1, factor)
+
+
+def resize_image(image, options):
+    """
+    Scale image down to the limits in options, as worked out by resize_plan().
+
+    Large reductions take a fast path: reduce() averages blocks of pixels
+    down by an integer factor, which costs little more than reading the
+    image once, and LANCZOS only resamples the last step of at most
+    REDUCING_GAP times. On 12 MP photos this is up to ten times faster than
+    LANCZOS over the full range, and differs from it by less than JPEG
+    encoding does, about 50 dB PSNR or more (see bench.py --suite resize).
+    """
+    plan = resize_plan(image.size, options)
+    if plan is None:
+        return image
+    size, box = plan
+    factor = reduce_factor(image.size, options)
+    if factor > 1:
+        image = image.reduce(factor, box)
+        box = None
+    return image.resize(size, Image.LANCZOS, box=box)
+
+
+def prepare_image(image, options):
+    """Apply the resize and format-specific adjustments before encoding"""
+    image = resize_image(image, options)
+    if options.format not in ALPHA_FORMATS:
+        return flatten_alpha(image, options.background)
+    return image
+
+
+def image_metadata(info, options):
+    """
+    Return the metadata to carry into the output, as save() keyword arguments.
+
+    libheif applies the HEIF rotation and mirroring while it decodes, so the
+    pixels are already upright and no separate transpose pass is needed. The
+    EXIF and XMP orientation tags are reset to 1 here so viewers do not rotate
+    the output a second time.
+
+    Args:
+        info (dict): info of the decoded image, from Pillow or pillow_heif
+        options (ConversionOptions): strip_metadata drops everything
+
+    Returns:
+        dict: exif, icc_profile and xmp entries that are present
+    """
+    if options.strip_metadata:
+        return {}
+    pillow_heif.set_orientation(info)
+    return {key: info[key] for key in METADATA_KEYS if info.get(key)}
+
+
+def save_image(image, dst, options, metadata=None):
+    """Encode image to dst using the format, quality and preset in options, plus metadata"""
+    pil_format = FORMATS[options.format][1]
+    params = dict(PRESETS[options.preset][pil_format])
+    if pil_format in _LOSSY_FORMATS:
+        params['quality'] = options.quality
+    params.update(metadata or {})
+    if pil_format == 'JPEG' and len(params.get('exif', b'')) > _JPEG_MAX_EXIF:
+        # Too large for one marker; Pillow would refuse to write the image at all
+        del params['exif']
+    image.save(dst, pil_format, **params)
+
+
+def searches_quality(options):
+    """Return True if options ask for the quality to be searched rather than fixed"""
+    return bool(options.target_bytes or options.min_psnr)
+
+
+def psnr(image, reference):
+    """
+    Return the peak signal-to-noise ratio of image against reference in dB.
+
+    Computed over the RGB bands from the histogram of their difference, so
+    no per-pixel arrays are built. math.inf if the images are identical.
+    """
+    difference = ImageChops.difference(image.convert('RGB'), reference.convert('RGB'))
+    squared = sum(count * (i % 256) ** 2 for i, count in enumerate(difference.histogram()))
+    mse = squared / (3 * image.size[0] * image.size[1])
+    return math.inf if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+
+
+def search_quality(image, options, metadata=None):
+    """
+    Find the quality that meets options.target_bytes and/or options.min_psnr.
+
+    Every attempt encodes the same prepared image into memory; nothing is
+    decoded or flattened again. The first attempt comes from a model fed by
+    one encode of a small sample of the image, which captures how much
+    detail it has. Later attempts interpolate between the attempts so far,
+    narrowing in on the answer until the goal is met within
+    TARGET_TOLERANCE or PSNR_TOLERANCE, so most images take two or three
+    full-size encodes.
+
+    With target_bytes the result is the highest quality, up to
+    options.quality, whose output fits. With min_psnr it is the lowest
+    quality that reaches the floor, or options.quality if none does. With
+    both, the size budget wins where the two disagree.
+
+    Args:
+        image (PIL.Image.Image): Prepared image
+        options (ConversionOptions): JPG or WebP output with target_bytes
+            and/or min_psnr; quality is the highest the search may use
+        metadata (dict): save() metadata from image_metadata(), which counts
+            towards target_bytes
+
+    Returns:
+        tuple: (output bytes, quality used, number of full-size encodes)
+
+    Raises:
+        ConversionError: If the output does not fit target_bytes even at
+            MIN_SEARCH_QUALITY
+    """
+    attempts = {}
+    reference = image.convert('RGB') if options.min_psnr else None
+    size_curve, psnr_curve = (_curve(values) for values
+                              in _QUALITY_CURVES[FORMATS[options.format][1]])
+
+    def attempt(quality):
+        if quality not in attempts:
+            data = encode_bytes(image, _fixed_quality(options, quality), metadata)
+            score = None
+            if reference is not None:
+                with Image.open(io.BytesIO(data)) as decoded:
+                    score = psnr(decoded, reference)
+            attempts[quality] = data, score
+        return attempts[quality]
+
+    factor = max(1, max(image.size) // _SAMPLE_EDGE)
+    sample = image.reduce(factor) if factor > 1 else image
+    sample_data = encode_bytes(sample, _fixed_quality(options, 75))
+
+    quality = highest = max(MIN_SEARCH_QUALITY, options.quality)
+    if options.min_psnr:
+        with Image.open(io.BytesIO(sample_data)) as decoded:
+            expected = min(psnr(decoded, sample), 99.0) + _SAMPLE_PSNR_GAIN * math.log2(factor)
+        # A PSNR floor is a size budget turned around: negate qualities and scores
+        found = _bisect_quality(lambda q: -attempt(-q)[1], -options.min_psnr, PSNR_TOLERANCE,
+                                lambda q: -psnr_curve(-q), expected - options.min_psnr,
+                                -highest, -MIN_SEARCH_QUALITY)
+        if found is not None:
+            quality = -found
+
+    # Only search for the size if the PSNR floor's choice does not already fit
+    if options.target_bytes and (not options.min_psnr
+                                 or len(attempt(quality)[0]) > options.target_bytes):
+        scale = image.size[0] * image.size[1] / (sample.size[0] * sample.size[1])
+        expected = math.log(len(sample_data) * scale * _SAMPLE_DETAIL)
+        found = _bisect_quality(lambda q: math.log(len(attempt(q)[0])),
+                                math.log(options.target_bytes), -math.log(1 - TARGET_TOLERANCE),
+                                size_curve, math.log(options.target_bytes) - expected,
+                                MIN_SEARCH_QUALITY, quality)
+        if found is None:
+            raise ConversionError(
+                f"Output is {len(attempt(MIN_SEARCH_QUALITY)[0])} bytes even at quality "
+                f"{MIN_SEARCH_QUALITY}, over the {options.target_bytes} byte target; "
+                "set a smaller max_edge too")
+        quality = found
+    return attempt(quality)[0], quality, len(attempts)
+
+
+def _fixed_quality(options, quality):
+    return replace(options, quality=quality, target_bytes=0, min_psnr=0)
+
+
+def _curve(values):
+    """Turn a row of _QUALITY_CURVES into a function of quality, interpolating between steps"""
+    def curve(quality):
+        position = min(max(quality, 5), 100) / 5 - 1
+        index = min(int(position), len(values) - 2)
+        return values[index] + (position - index) * (values[index + 1] - values[index])
+    return curve
+
+
+def _bisect_quality(measure, goal, tolerance, curve, start, lowest, highest):
+    """
+    Return the highest quality in lowest..highest whose measure is at most goal.
+
+    measure must grow with quality, roughly following curve plus an offset
+    that depends on the image; pass negated qualities, measures and curve to
+    find the lowest quality whose measure reaches a floor instead. The first
+    attempt is the quality where curve reaches start. Each later attempt
+    interpolates, along curve, between the nearest attempts on either side
+    of goal, or moves along curve by the remaining distance to goal when
+    only one side is known. The search stops as soon as an acceptable
+    quality is within tolerance of goal, or the quality above it has been
+    found unacceptable.
+
+    Returns:
+        int: The quality found, or None if even lowest is over goal
+    """
+    def highest_under(target, low, high):
+        """The highest quality in low..high where curve is at most target, else low"""
+        return next((q for q in range(high, low - 1, -1) if curve(q) <= target), low)
+
+    values = {}
+    quality = highest_under(start, lowest, highest)
+    while True:
+        values[quality] = measure(quality)
+        fits = [q for q, value in values.items() if value <= goal]
+        best = max(fits) if fits else None
+        over = [q for q, value in values.items() if value > goal and (best is None or q > best)]
+        limit = min(over) if over else None
+        if best is not None and (goal - values[best] <= tolerance or best == highest
+                                 or limit == best + 1):
+            return best
+        if best is None and limit == lowest:
+            return None
+
+        if best is not None and limit is not None:
+            fraction = (goal - values[best]) / (values[limit] - values[best])
+            target = curve(best) + fraction * (curve(limit) - curve(best))
+            quality = max(best + 1, highest_under(target, best + 1, limit - 1))
+        elif best is not None:
+            target = curve(best) + goal - values[best]
+            quality = highest_under(target, best + 1, highest)
+        else:
+            target = curve(limit) + goal - values[limit]
+            quality = highest_under(target, lowest, limit - 1)
+
+
+def read_input(data):
+    """
+    Return an encoded image as bytes, copying it only when that cannot be avoided.
+
+    libheif is handed a bytes object, so bytes (and a memoryview that covers a
+    whole bytes object) pass straight through without a copy. Other buffers
+    such as bytearray or mmap, and readable binary file objects, are copied
+    once.
+
+    Args:
+        data: bytes, bytearray, memoryview, mmap or a readable binary file object
+
+    Returns:
+        bytes: The encoded image
+    """
+    if isinstance(data, bytes):
+        return data
+    if hasattr(data, 'read'):
+        payload = data.read()
+        if not isinstance(payload, bytes):
+            raise ConversionError("File object must be opened in binary mode")
+        return payload
+    try:
+        view = memoryview(data)
+    except TypeError:
+        raise ConversionError(f"Cannot read an image from {type(data).__name__}") from None
+    if isinstance(view.obj, bytes) and view.nbytes == len(view.obj) and view.contiguous:
+        return view.obj
+    return view.tobytes()
+
+
+def decode_bytes(data):
+    """
+    Decode an encoded HEIC payload held in memory into a loaded Pillow image.
+
+    Args:
+        data: bytes, another buffer, or a readable binary file object; see read_input()
+    """
+    register_opener()
+    try:
+        image = Image.open(io.BytesIO(read_input(data)))
+        image.load()
+        return image
+    except (OSError, ValueError, SyntaxError) as e:
+        raise ConversionError(str(e)) from e
+
+
+def convert_bytes(data, options=None, out=None):
+    """
+    Convert an encoded HEIC image held in memory and return the encoded output.
+
+    Nothing is written to disk, which suits services that receive images
+    over the network or read them from object storage.
+
+    Args:
+        data: Encoded HEIC image as bytes, another buffer (bytearray,
+            memoryview, mmap) or a readable binary file object. bytes are
+            decoded in place; other inputs are copied once
+        options (ConversionOptions): Conversion settings
+        out: Where to put the output instead of returning it: a writable binary
+            file object, or a writable buffer such as a bytearray or memoryview,
+            which is filled from the start
+
+    Returns:
+        bytes: The encoded output image, or the number of bytes written when
+            out is given
+
+    Raises:
+        ConversionError: If the format is unknown, the image cannot be
+            converted, or the output does not fit in the out buffer
+    """
+    options = options or ConversionOptions()
+    check_options(options)
+    try:
+        image = decode_bytes(data)
+        metadata = image_metadata(image.info, options)
+        prepared = prepare_image(image, options)
+        del image
+        if out is None:
+            return encode_bytes(prepared, options, metadata)
+        return encode_into(prepared, out, options, metadata)
+    except (OSError, ValueError, SyntaxError, EOFError, RuntimeError) as e:
+        raise ConversionError(str(e)) from e
+    except MemoryError as e:
+        raise MemoryLimitError("Ran out of memory converting image") from e
+
+
+def encode_bytes(image, options, metadata=None, metrics=None):
+    """
+    Encode a prepared image and return the output file contents.
+
+    When options set target_bytes or min_psnr the quality is searched for
+    (see search_quality()), and metrics, if given, receives the quality
+    chosen and the number of encodes it took.
+    """
+    if searches_quality(options):
+        data, quality, attempts = search_quality(image, options, metadata)
+        if metrics is not None:
+            metrics.quality = quality
+            metrics.encode_attempts += attempts
+        return data
+    buffer = io.BytesIO()
+    try:
+        save_image(image, buffer, options, metadata)
+    except (OSError, ValueError) as e:
+        raise ConversionError(str(e)) from e
+    return buffer.getvalue()
+
+
+class _BufferWriter:
+    """File-like writer that fills a caller's preallocated buffer in place"""
+
+    def __init__(self, buffer):
+        self._view = memoryview(buffer).cast('B')
+        if self._view.readonly:
+            raise ConversionError("Output buffer is read-only")
+        self._pos = 0
+        self.size = 0
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        end = self._pos + data.nbytes
+        if end > self._view.nbytes:
+            raise ConversionError(f"Output does not fit in the {self._view.nbytes}-byte buffer")
+        self._view[self._pos:end] = data
+        self._pos = end
+        self.size = max(self.size, end)
+        return data.nbytes
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self._pos, os.SEEK_END: self.size}[whence]
+        self._pos = base + offset
+        return self._pos
+
+    def flush(self):
+        pass
+
+
+def encode_into(image, out, options, metadata=None):
+    """
+    Encode a prepared image straight into a caller-provided destination.
+
+    Args:
+        image (PIL.Image.Image): Prepared image
+        out: Writable binary file object, or writable buffer filled from the start
+        options (ConversionOptions): Output settings
+        metadata (dict): save() metadata from image_metadata()
+
+    Returns:
+        int: Number of bytes written
+
+    Raises:
+        ConversionError: If encoding fails or the output does not fit in the buffer
+    """
+    if hasattr(out, 'write'):
+        # Counts what is written, and works for streams that cannot tell() such as sockets
+        writer = _TimedWriter(out)
+    else:
+        writer = _BufferWriter(out)
+    try:
+        if searches_quality(options):
+            writer.write(encode_bytes(image, options, metadata))
+        else:
+            save_image(image, writer, options, metadata)
+    except (OSError, ValueError) as e:
+        raise ConversionError(str(e)) from e
+    return writer.size if isinstance(writer, _BufferWriter) else writer.bytes
+
+
+class _TimedWriter:
+    """
+    Write-only file wrapper that totals the time spent in write().
+
+    It has no fileno(), so Pillow hands each encoded chunk to write() instead
+    of letting the encoder write to the descriptor directly. That lets the
+    time spent on disk writes be separated from encoding without holding the
+    whole encoded file in memory.
+    """
+
+    def __init__(self, f):
+        self._file = f
+        self.bytes = 0
+        self.wall_s = 0.0
+        self.cpu_s = 0.0
+
+    def write(self, data):
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        written = self._file.write(data)
+        self.wall_s += time.perf_counter() - wall_start
+        self.cpu_s += time.thread_time() - cpu_start
+        self.bytes += len(data)
+        return written
+
+    def flush(self):
+        self._file.flush()
+
+    def tell(self):
+        return self._file.tell()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+
+@contextmanager
+def atomic_output(dst):
+    """
+    Yield a temporary path next to dst, and rename it over dst once the block succeeds.
+
+    Readers of dst see either the old file or the complete new one, never a
+    partly written file, and a failed or interrupted write leaves dst as it
+    was. The rename also replaces dst rather than writing through it, so other
+    hard links to the old file keep their content.
+    """
+    directory, name = os.path.split(dst)
+    temp = os.path.join(directory, f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        yield temp
+        os.replace(temp, dst)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def _write_output(image, dst, options, metrics, metadata=None):
+    if searches_quality(options):
+        # Every attempt is encoded in memory; only the chosen one is written
+        with metrics.stage('encode'):
+            data = encode_bytes(image, options, metadata, metrics)
+        with metrics.stage('write'):
+            with atomic_output(dst) as temp, open(temp, 'wb') as f:
+                f.write(data)
+        metrics.output_bytes += len(data)
+        return
+    if isinstance(metrics, NullMetrics):
+        with atomic_output(dst) as temp:
+            save_image(image, temp, options, metadata)
+        return
+    with metrics.stage('encode'):
+        with atomic_output(dst) as temp, open(temp, 'wb') as f:
+            writer = _TimedWriter(f)
+            save_image(image, writer, options, metadata)
+    metrics.move_time('encode', 'write', writer.wall_s, writer.cpu_s)
+    metrics.output_bytes += writer.bytes
+
+
+def convert(src, dst=None, options=None, metrics=None):
+    """
+    Convert a HEIC image to JPG, PNG, WebP, AVIF or JPEG XL.
+
+    Args:
+        src (str): Path to the HEIC file
+        dst (str): Output path; defaults to src with the new extension. In
+            thumbnail mode each preview is written next to it as NAME_SIZE.EXT,
+            and extra images from the container as NAME_frameN.EXT,
+            NAME_depth.EXT and so on
+        options (ConversionOptions): Conversion settings
+        metrics (metrics.FileMetrics): If given, receives per-stage timings
+            (decode, flatten, encode, write) and input/output byte counts
+
+    Returns:
+        ConversionResult: Details of the written file (the largest preview in
+            thumbnail mode, the first image when several are exported)
+
+    Raises:
+        ConversionError: If the format is unknown or the image cannot be converted
+    """
+    options = options or ConversionOptions()
+    check_options(options)
+
+    register_opener()
+    dst = dst or output_path(src, options)
+    metrics = metrics or NullMetrics()
+    if os.path.abspath(dst) == os.path.abspath(src):
+        raise ConversionError(f"Converting {os.path.basename(src)} would overwrite it")
+
+    selects_images = (options.frames != 'primary' or options.depth_images
+                      or options.aux_images)
+    if selects_images and options.thumbnail_sizes:
+        raise ConversionError("Thumbnail mode only supports the primary image")
+    if options.memory_limit and (selects_images or options.thumbnail_sizes):
+        raise ConversionError("Memory-limited mode only converts the primary image")
+
+    try:
+        metrics.input_bytes += os.path.getsize(src)
+        if options.memory_limit:
+            return _convert_bounded(src, dst, options, metrics)
+        if selects_images:
+            return _convert_images(src, dst, options, metrics)
+        with Image.open(src) as image:
+            if options.thumbnail_sizes:
+                return _convert_thumbnails(image, src, dst, options, metrics)
+            if image.format == 'HEIF' and decodes_high_bit_depth(image.info, options):
+                return _convert_high_bit_depth(src, dst, options, metrics)
+            with metrics.stage('decode'):
+                image.load()
+            metadata = image_metadata(image.info, options)
+            with metrics.stage('flatten'):
+                prepared = prepare_image(image, options)
+            _write_output(prepared, dst, options, metrics, metadata)
+            return ConversionResult(src, dst, options.format, prepared.size, prepared.mode)
+    except (OSError, ValueError, SyntaxError, EOFError, RuntimeError) as e:
+        raise ConversionError(str(e)) from e
+    except MemoryError as e:
+        raise MemoryLimitError(f"Ran out of memory converting {os.path.basename(src)}") from e
+
+
+def _convert_high_bit_depth(src, dst, options, metrics):
+    """
+    Convert a 10- or 12-bit primary image without first reducing it to 8 bits.
+
+    PNG output keeps 16 bits per sample, unless keep_bit_depth is off. Other
+    formats get a tone-map to 8 bits: one table lookup per band over the
+    decoded samples, which rolls off PQ and HLG highlights instead of
+    clipping them, and rounds SDR images. Resizing and alpha flattening then
+    work on the 8-bit image as usual.
+    """
+    import hdr
+
+    heif_file = pillow_heif.open_heif(src, convert_hdr_to_8bit=False)
+    heif_image = heif_file[heif_file.primary_index]
+    del heif_file
+
+    size, mode = heif_image.size, heif_image.mode
+    bit_depth = heif_image.info['bit_depth']
+    nclx = heif_image.info.get('nclx_profile')
+    metadata = image_metadata(heif_image.info, options)
+    with metrics.stage('decode'):
+        samples = hdr.decode(heif_image)
+
+    if options.format == 'PNG' and options.keep_bit_depth:
+        with metrics.stage('flatten'):
+            samples = hdr.to_16bit(samples, bit_depth)
+            del heif_image
+            plan = resize_plan(size, options)
+            if plan is not None:
+                samples = hdr.resize(samples, *plan)
+        level = PRESETS[options.preset]['PNG'].get('compress_level', 6)
+        with metrics.stage('encode'):
+            with atomic_output(dst) as temp, open(temp, 'wb') as f:
+                writer = _TimedWriter(f)
+                hdr.write_png(writer, samples, level, metadata, nclx)
+        if not isinstance(metrics, NullMetrics):
+            metrics.move_time('encode', 'write', writer.wall_s, writer.cpu_s)
+        metrics.output_bytes += writer.bytes
+        return ConversionResult(src, dst, options.format, (samples.shape[1], samples.shape[0]),
+                                mode)
+
+    with metrics.stage('flatten'):
+        image = hdr.to_8bit(samples, bit_depth, (nclx or {}).get('transfer_characteristics'))
+        del samples, heif_image
+        if hdr.is_hdr(nclx):
+            # A profile for the PQ or HLG signal would not describe the tone-mapped pixels
+            metadata.pop('icc_profile', None)
+        prepared = prepare_image(image, options)
+    _write_output(prepared, dst, options, metrics, metadata)
+    return ConversionResult(src, dst, options.format, prepared.size, prepared.mode)
+
+
+def _convert_bounded(src, dst, options, metrics):
+    """
+    Convert the primary image within options.memory_limit.
+
+    The limit is checked against an estimate from the container header
+    before anything is decoded. libheif has no API for decoding part of an
+    image, so the decode itself is the floor: if it alone does not fit, the
+    file is refused. Otherwise the output is copied out of the decoder's
+    buffer in strips, reduced by an integer factor on the way when a resize
+    allows it or downscale_to_fit calls for it, and the decoder's buffer is
+    freed before the final resample and encoding. The encoder streams
+    straight to dst rather than into memory.
+    """
+    heif_file = pillow_heif.open_heif(src)
+    heif_image = heif_file[heif_file.primary_index]
+    del heif_file
+
+    size, mode = heif_image.size, heif_image.mode
+    metadata = image_metadata(heif_image.info, options)
+    bit_depth = heif_image.info.get('bit_depth') or 8
+    limit = options.memory_limit
+    needed_to_decode, needed = estimate_memory(size, mode, bit_depth, options)
+    if needed_to_decode > limit:
+        raise MemoryLimitError(
+            f"Decoding {size[0]}x{size[1]} needs about {needed_to_decode / 2**20:.0f} MB, "
+            f"over the {limit / 2**20:.0f} MB memory limit")
+
+    factor = reduce_factor(size, options)
+    while needed > limit and options.downscale_to_fit and factor < max(size):
+        factor += 1
+        needed = estimate_memory(size, mode, bit_depth, options, factor)[1]
+    if needed > limit:
+        advice = "" if options.downscale_to_fit else "; allow downscaling to convert it smaller"
+        raise MemoryLimitError(
+            f"Converting {size[0]}x{size[1]} needs about {needed / 2**20:.0f} MB, "
+            f"over the {limit / 2**20:.0f} MB memory limit{advice}")
+
+    with metrics.stage('decode'):
+        data = heif_image.data
+    with metrics.stage('flatten'):
+        prepared = _copy_strips(data, size, mode, heif_image.stride, factor, options)
+    del data, heif_image
+    with metrics.stage('flatten'):
+        prepared = resize_image(prepared, options)
+
+    if searches_quality(options):
+        _write_output(prepared, dst, options, metrics, metadata)
+        return ConversionResult(src, dst, options.format, prepared.size, prepared.mode)
+    # Encoding and writing overlap when streaming, so both are timed as encode
+    with metrics.stage('encode'):
+        with atomic_output(dst) as temp:
+            save_image(prepared, temp, options, metadata)
+    metrics.output_bytes += os.path.getsize(dst)
+    return ConversionResult(src, dst, options.format, prepared.size, prepared.mode)
+
+
+def _convert_images(src, dst, options, metrics):
+    stem, extension = os.path.splitext(dst)
+    results = []
+    images = iter_images(src, options)
+    while True:
+        with metrics.stage('decode'):
+            item = next(images, None)
+        if item is None:
+            break
+        suffix, image = item
+        image_dst = stem + suffix + extension if suffix else dst
+        metadata = image_metadata(image.info, options)
+        with metrics.stage('flatten'):
+            prepared = prepare_image(image, options)
+        _write_output(prepared, image_dst, options, metrics, metadata)
+        results.append(ConversionResult(src, image_dst, options.format,
+                                        prepared.size, prepared.mode))
+        del image, prepared
+    return results[0]
+
+
+def _convert_thumbnails(image, src, dst, options, metrics):
+    results = []
+    # Read before draft() can swap in an embedded thumbnail
+    metadata = image_metadata(image.info, options)
+    # Decoding and resampling happen together when previews are made
+    with metrics.stage('decode'):
+        previews = make_thumbnails(image, options.thumbnail_sizes)
+    for size, preview in previews:
+        preview_dst = thumbnail_path(dst, size)
+        with metrics.stage('flatten'):
+            prepared = prepare_image(preview, options)
+        _write_output(prepared, preview_dst, options, metrics, metadata)
+        results.append(ConversionResult(src, preview_dst, options.format,
+                                        prepared.size, prepared.mode))
+    return results[0]
@@ -0,0 +1,159 @@
+"""
+Duplicate detection for HEIC to JPG/PNG Converter
+Finds inputs with identical content so each is converted once, and stores outputs by content
+"""
+
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import converter
+from cache import file_digest
+
+# How a duplicate's output is made from the output of the first identical input
+MODES = ('copy', 'link', 'off')
+
+# Bytes of converted output the service keeps for repeated uploads
+STORE_BYTES = 64 * 1024 * 1024
+
+
+def supports(options):
+    """Return True if a conversion with these options writes exactly one file"""
+    return (not options.thumbnail_sizes and options.frames == 'primary'
+            and not options.depth_images and not options.aux_images)
+
+
+def hash_candidates(paths, sizes=(), workers=None):
+    """
+    Hash the inputs that could have an identical twin.
+
+    Files can only be identical if they are the same size, so a file is
+    hashed only when another input, or one of sizes, has its size. Every
+    other file costs a single stat. Hashing runs on threads; BLAKE2b releases
+    the GIL on large reads, so several files hash at once.
+
+    Args:
+        paths (list): Input files
+        sizes (set): Sizes of earlier inputs that may match, such as those
+            recorded in the manifest
+        workers (int): Hashing threads; defaults to the CPU count
+
+    Returns:
+        dict: path -> digest for every hashed file
+    """
+    by_size = {}
+    for path in paths:
+        try:
+            by_size.setdefault(os.path.getsize(path), []).append(path)
+        except OSError:
+            # Reported when the conversion tries to read it
+            pass
+    wanted = [path for size, group in by_size.items()
+              if len(group) > 1 or size in sizes for path in group]
+    if not wanted:
+        return {}
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        return dict(zip(wanted, pool.map(file_digest, wanted)))
+
+
+def split_duplicates(planned, digests):
+    """
+    Split planned (src, dst) pairs into the ones to convert and their duplicates.
+
+    Args:
+        planned (list): (src, dst) pairs, in the order they would be converted
+        digests (dict): src -> content digest; inputs missing from it are unique
+
+    Returns:
+        tuple: (pairs to convert, {src of the first input: [(src, dst), ...]}
+            for the later inputs with the same content)
+    """
+    first = {}
+    unique = []
+    duplicates = {}
+    for src, dst in planned:
+        digest = digests.get(src)
+        if digest is None:
+            unique.append((src, dst))
+        elif digest in first:
+            duplicates.setdefault(first[digest], []).append((src, dst))
+        else:
+            first[digest] = src
+            unique.append((src, dst))
+    return unique, duplicates
+
+
+def place(existing, target, mode='copy'):
+    """
+    Make target a copy of, or a hard link to, the file existing.
+
+    The new file is made under a temporary name and renamed over target (see
+    converter.atomic_output), so target is never seen half written. A link
+    falls back to a copy where hard links are not possible, such as across
+    file systems.
+
+    Args:
+        existing (str): Output already converted from the same content
+        target (str): Output path to fill
+        mode (str): 'copy' or 'link'
+    """
+    if os.path.abspath(existing) == os.path.abspath(target):
+        return
+    with converter.atomic_output(target) as temp:
+        if mode == 'link':
+            try:
+                os.link(existing, temp)
+                return
+            except OSError:
+                pass
+        shutil.copyfile(existing, temp)
+
+
+def content_key(data):
+    """Return the digest of an encoded image held in memory, matching file_digest()"""
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+class OutputStore:
+    """
+    Least recently used store of converted outputs, keyed by input content and settings.
+
+    Thread-safe. Outputs larger than the whole store are not kept.
+
+    Args:
+        max_bytes (int): Total output bytes kept; 0 keeps nothing
+    """
+
+    def __init__(self, max_bytes=STORE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """Return the stored output for key, or None"""
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        """Store data under key, evicting the least recently used outputs to make room"""
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._items[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
@@ -0,0 +1,228 @@
+"""
+High bit depth conversion for HEIC to JPG/PNG Converter
+Decodes 10- and 12-bit HEIC images at full depth, for 16-bit PNG or a one-pass tone-map to 8 bits
+"""
+
+import math
+import struct
+import zlib
+
+import numpy as np
+from PIL import Image
+
+# nclx transfer characteristics (ITU-T H.273) of HDR signals
+TRANSFER_PQ = 16
+TRANSFER_HLG = 18
+
+# Display luminance, in cd/m², that SDR white stands for (ITU-R BT.2408 reference white)
+REFERENCE_WHITE_NITS = 203.0
+
+# Peak luminance HDR content is rolled off to fit under; HLG is displayed at this peak
+HDR_PEAK_NITS = 1000.0
+
+# System gamma of the HLG reference display at HDR_PEAK_NITS (ITU-R BT.2100)
+HLG_GAMMA = 1.2
+
+# Rows filtered and compressed at a time when writing PNG, bounding the extra memory
+PNG_STRIP_ROWS = 256
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Bands -> PNG color type: gray, gray + alpha, RGB, RGBA
+_PNG_COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+# Pillow mode of a tone-mapped image by bands
+_MODES = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}
+
+# Tone-map tables by (bit depth, transfer); each is built once per process
+_LUTS = {}
+
+
+def decode(heif_image):
+    """
+    Decode a pillow_heif image opened with convert_hdr_to_8bit=False.
+
+    Returns:
+        numpy.ndarray: uint16 samples, shape (height, width, bands). libheif
+            puts the coded bits at the top of each sample, so a 10-bit value v
+            is stored as v << 6
+    """
+    width, height = heif_image.size
+    bands = len(heif_image.mode.split(';')[0])
+    rows = np.frombuffer(heif_image.data, np.uint16).reshape(height, heif_image.stride // 2)
+    return rows[:, :width * bands].reshape(height, width, bands)
+
+
+def is_hdr(nclx):
+    """Return True if an nclx profile (from pillow_heif info) describes a PQ or HLG signal"""
+    return (nclx or {}).get('transfer_characteristics') in (TRANSFER_PQ, TRANSFER_HLG)
+
+
+def _srgb_encode(linear):
+    """Apply the sRGB transfer curve to linear light in 0..1"""
+    linear = np.clip(linear, 0, 1)
+    return np.where(linear <= 0.0031308, 12.92 * linear,
+                    1.055 * np.power(linear, 1 / 2.4) - 0.055)
+
+
+def _pq_to_nits(signal):
+    """SMPTE ST 2084 EOTF: PQ signal in 0..1 to display luminance in cd/m²"""
+    m1, m2 = 2610 / 16384, 2523 / 4096 * 128
+    c1, c2, c3 = 3424 / 4096, 2413 / 4096 * 32, 2392 / 4096 * 32
+    e = np.power(signal, 1 / m2)
+    return 10000 * np.power(np.maximum(e - c1, 0) / (c2 - c3 * e), 1 / m1)
+
+
+def _hlg_to_nits(signal):
+    """ITU-R BT.2100 HLG inverse OETF and OOTF, per channel, on a HDR_PEAK_NITS display"""
+    a = 0.17883277
+    b = 1 - 4 * a
+    c = 0.5 - a * math.log(4 * a)
+    scene = np.where(signal <= 0.5, signal ** 2 / 3,
+                     (np.exp((signal - c) / a) + b) / 12)
+    return HDR_PEAK_NITS * np.power(scene, HLG_GAMMA)
+
+
+def tone_map_lut(bit_depth, transfer=None):
+    """
+    Return the table that maps decoded 16-bit samples straight to 8-bit output.
+
+    The table has an entry for every uint16 value, so tone-mapping a whole
+    image is one vectorized lookup per band, with no float image in memory.
+    SDR samples are rescaled with rounding, so 1023 maps to 255 and 512 to
+    128, where a plain bit shift would floor them. PQ and HLG samples are
+    turned into display light, scaled so REFERENCE_WHITE_NITS becomes SDR
+    white, rolled off above it with an extended Reinhard curve that reaches 1
+    at HDR_PEAK_NITS, and sRGB-encoded. Each channel is mapped on its own and
+    the color primaries are left as they are.
+
+    Args:
+        bit_depth (int): Bits per sample in the coded image
+        transfer (int): nclx transfer characteristics; only TRANSFER_PQ and
+            TRANSFER_HLG are treated as HDR
+
+    Returns:
+        numpy.ndarray: 65536 uint8 entries
+    """
+    key = (bit_depth, transfer if transfer in (TRANSFER_PQ, TRANSFER_HLG) else None)
+    if key not in _LUTS:
+        codes = np.arange(65536) >> (16 - bit_depth)
+        signal = codes / ((1 << bit_depth) - 1)
+        if key[1] is None:
+            table = np.rint(signal * 255)
+        else:
+            nits = _pq_to_nits(signal) if transfer == TRANSFER_PQ else _hlg_to_nits(signal)
+            relative = nits / REFERENCE_WHITE_NITS
+            white = HDR_PEAK_NITS / REFERENCE_WHITE_NITS
+            rolled = relative * (1 + relative / white ** 2) / (1 + relative)
+            table = np.rint(_srgb_encode(rolled) * 255)
+        _LUTS[key] = table.astype(np.uint8)
+    return _LUTS[key]
+
+
+def to_8bit(samples, bit_depth, transfer=None):
+    """
+    Tone-map samples from decode() to an 8-bit Pillow image.
+
+    Color bands go through tone_map_lut(); alpha is only rescaled.
+
+    Returns:
+        PIL.Image.Image: 'RGB' or 'RGBA' (or 'L'/'LA' for grayscale)
+    """
+    bands = samples.shape[2]
+    color = bands if bands in (1, 3) else bands - 1
+    out = np.empty(samples.shape, np.uint8)
+    out[..., :color] = tone_map_lut(bit_depth, transfer)[samples[..., :color]]
+    if color < bands:
+        out[..., color:] = tone_map_lut(bit_depth)[samples[..., color:]]
+    return Image.fromarray(out, _MODES[bands])
+
+
+def to_16bit(samples, bit_depth):
+    """
+    Return a copy of samples from decode() stretched to the full 16-bit range.
+
+    The coded bits are repeated into the low bits, so the largest code value
+    becomes 65535 rather than stopping short of it, as PNG expects.
+    """
+    samples = np.array(samples, copy=True)
+    samples |= samples >> bit_depth
+    return samples
+
+
+def resize(samples, size, box=None):
+    """
+    Resize 16-bit samples with LANCZOS, one band at a time.
+
+    Pillow has no 16-bit RGB mode, but it resamples single 'I;16' bands.
+    Those have no reduce(), so large reductions take longer here than on
+    8-bit images.
+
+    Args:
+        samples (numpy.ndarray): uint16 samples, shape (height, width, bands)
+        size (tuple): Output (width, height)
+        box (tuple): Region of the input to resample, as from resize_plan()
+    """
+    out = np.empty((size[1], size[0], samples.shape[2]), np.uint16)
+    for band in range(samples.shape[2]):
+        image = Image.fromarray(np.ascontiguousarray(samples[..., band]))
+        out[..., band] = np.asarray(image.resize(size, Image.LANCZOS, box=box))
+    return out
+
+
+def _chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack(
+        '>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def write_png(f, samples, compress_level=6, metadata=None, nclx=None):
+    """
+    Write 16-bit samples to f as a PNG.
+
+    Pillow cannot save 16 bits per channel in color, so the chunks are
+    written here. Rows are stored with the Up filter, which on photos
+    compresses close to Pillow's adaptive choice at a fraction of the cost,
+    and filtered and compressed PNG_STRIP_ROWS at a time.
+
+    Args:
+        f: Binary file object
+        samples (numpy.ndarray): uint16 samples covering the full 16-bit range,
+            shape (height, width, bands)
+        compress_level (int): zlib level, as in Pillow's compress_level
+        metadata (dict): exif, icc_profile and xmp, from converter.image_metadata()
+        nclx (dict): nclx profile of the HEIC; an HDR one is recorded in a
+            cICP chunk so viewers show the output as HDR
+    """
+    metadata = metadata or {}
+    height, width, bands = samples.shape
+    f.write(_PNG_SIGNATURE)
+    f.write(_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 16,
+                                        _PNG_COLOR_TYPES[bands], 0, 0, 0)))
+    if is_hdr(nclx):
+        f.write(_chunk(b'cICP', bytes([nclx['color_primaries'],
+                                       nclx['transfer_characteristics'], 0, 1])))
+    elif metadata.get('icc_profile'):
+        f.write(_chunk(b'iCCP', b'ICC Profile\0\0' + zlib.compress(metadata['icc_profile'])))
+    if metadata.get('exif'):
+        exif = metadata['exif']
+        f.write(_chunk(b'eXIf', exif[6:] if exif.startswith(b'Exif\0\0') else exif))
+    if metadata.get('xmp'):
+        xmp = metadata['xmp']
+        xmp = xmp if isinstance(xmp, bytes) else xmp.encode()
+        f.write(_chunk(b'iTXt', b'XML:com.adobe.xmp\0\0\0\0\0' + xmp))
+
+    compressor = zlib.compressobj(compress_level)
+    row_bytes = width * bands * 2
+    previous = np.zeros(row_bytes, np.uint8)
+    for top in range(0, height, PNG_STRIP_ROWS):
+        rows = samples[top:top + PNG_STRIP_ROWS].astype('>u2').reshape(-1, width * bands)
+        rows = rows.view(np.uint8)
+        filtered = np.empty((len(rows), row_bytes + 1), np.uint8)
+        filtered[:, 0] = 2
+        # uint8 arithmetic wraps, which is the modulo 256 the Up filter wants
+        np.subtract(rows[0], previous, out=filtered[0, 1:])
+        np.subtract(rows[1:], rows[:-1], out=filtered[1:, 1:])
+        previous = rows[-1]
+        data = compressor.compress(filtered)
+        if data:
+            f.write(_chunk(b'IDAT', data))
+    f.write(_chunk(b'IDAT', compressor.flush()))
+    f.write(_chunk(b'IEND', b''))
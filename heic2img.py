@@ -0,0 +1,721 @@
+"""
+Command-line batch converter for HEIC to JPG/PNG Converter
+Walks a directory tree and converts every HEIC file using a pool of worker processes
+
+Usage:
+    python -m heic2img IN_DIR OUT_DIR [--jobs N] [--format JPG|PNG|WEBP|AVIF|JXL] [--quality Q]
+                      [--preset fast|balanced|smallest] [--strip-metadata]
+                      [--dedup copy|link|off] [--layout mirror|flat] [--name-template TEMPLATE]
+                      [--on-collision overwrite|skip|suffix]
+                      [--resume] [--retries N] [--dead-letter FILE]
+                      [--no-cache] [--prune] [--pipeline [--queue-size N]]
+                      [--thumbnails SIZE[,SIZE...]] [--frames all|primary|N] [--depth] [--aux]
+                      [--metrics-jsonl FILE] [--metrics-prom FILE] [--stats]
+                      [--background COLOR] [--memory-limit SIZE [--downscale-to-fit]]
+                      [--memory-budget SIZE]
+                      [--watch]
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import converter
+import dedup
+import layout
+import preflight
+import sniff
+from cache import ConversionCache, file_digest, options_key
+from journal import DEAD_LETTER_NAME, JOURNAL_NAME, Journal, JournalError
+from metrics import FileMetrics, MetricsCollector
+from pipeline import Pipeline
+from watcher import FolderWatcher
+
+# Seconds to wait before the first round of retries; each later round waits longer
+RETRY_DELAY = 1.0
+
+# Longest a watch loop sleeps before checking for finished conversions and stop requests
+WATCH_TICK = 0.5
+
+
+def find_heic_files(in_dir, skip_dir=None):
+    """
+    Return a sorted list of HEIF-family files below in_dir.
+
+    Files are found by a HEIF extension (.heic, .heif, .hif, .avif) or, for
+    any other name, by the brands in their first bytes, so an image saved
+    with the wrong extension is converted too.
+
+    Args:
+        in_dir (str): Directory to search
+        skip_dir (str): Directory not to search, such as an output folder
+            inside in_dir whose AVIF outputs would otherwise be found
+    """
+    found = []
+    for dirpath, dirnames, filenames in os.walk(in_dir):
+        if skip_dir is not None:
+            dirnames[:] = [d for d in dirnames if not is_within(os.path.join(dirpath, d), skip_dir)]
+        dirnames.sort()
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if sniff.is_heif_input(path):
+                found.append(path)
+    found.sort()
+    return found
+
+
+def is_within(path, directory):
+    """Return True if path is directory or below it"""
+    path, directory = os.path.abspath(path), os.path.abspath(directory)
+    return os.path.commonpath([path, directory]) == directory
+
+
+def plan_outputs(in_dir, out_dir, files, options):
+    """Map each input file to an output path that mirrors the input tree"""
+    return layout.OutputLayout(in_dir, out_dir).plan(files, options)[0]
+
+
+def create_output_dirs(planned):
+    """Create every output directory once, before any worker starts"""
+    layout.make_dirs(dst for _, dst in planned)
+
+
+def make_layout(args):
+    """Build the OutputLayout described by the command line"""
+    return layout.OutputLayout(args.in_dir, args.out_dir, args.name_template,
+                               mirror=args.layout == 'mirror', collision=args.on_collision)
+
+
+def convert_task(src, dst, options, collect_metrics=False, hash_input=False):
+    """
+    Convert one file in a worker process.
+
+    Args:
+        hash_input (bool): Also compute the content digest of src for the
+            cache, so the parent does not have to read the file again
+
+    Returns:
+        tuple: ((src, dst, error message or None), metrics dict or None,
+            digest of src or None)
+    """
+    file_metrics = FileMetrics(src) if collect_metrics else None
+    error = None
+    digest = None
+    try:
+        converter.convert(src, dst, options, file_metrics)
+        if hash_input:
+            # The decode has just pulled the file into the page cache
+            digest = file_digest(src)
+    except converter.ConversionError as e:
+        error = str(e)
+    except OSError as e:
+        error = f"Cannot read {os.path.basename(src)}: {e}"
+    if file_metrics is None:
+        return (src, dst, error), None, digest
+    file_metrics.error = error
+    return (src, dst, error), file_metrics.to_dict(), digest
+
+
+def run_batch(planned, options, jobs=None, report=None, metrics=None, digests=None,
+              infos=None, memory_budget=0):
+    """
+    Convert planned (src, dst) pairs, in parallel when jobs > 1.
+
+    Args:
+        planned (list): (src, dst) pairs to convert
+        options (ConversionOptions): Conversion settings shared by all files
+        jobs (int): Number of worker processes; defaults to the CPU count
+        report (callable): Called with (src, dst, error) as each file finishes
+        metrics (MetricsCollector): If given, receives per-file stage metrics
+        digests (dict): If given, the workers hash each converted input that
+            is not already in it, and src -> digest is stored here before
+            report is called
+        infos (dict): src -> preflight.ImageInfo; if given, the largest files
+            start first
+        memory_budget (int): With infos, bytes the running conversions may
+            use together, by their estimates; files that would go over it wait
+            while smaller ones run. 0 is no limit
+
+    Returns:
+        list: (src, dst, error) tuples for every file, in completion order
+    """
+    jobs = jobs or os.cpu_count() or 1
+    collect = metrics is not None
+    hashing = {src: digests is not None and src not in digests for src, _ in planned}
+    results = []
+
+    def finish(outcome, file_metrics, digest):
+        results.append(outcome)
+        if collect:
+            metrics.add(FileMetrics.from_dict(file_metrics))
+        if digest is not None:
+            digests[outcome[0]] = digest
+        if report:
+            report(*outcome)
+
+    infos = infos or {}
+    if infos:
+        planned = preflight.largest_first(planned, infos)
+    if jobs == 1 or len(planned) <= 1:
+        for src, dst in planned:
+            finish(*convert_task(src, dst, options, collect, hashing[src]))
+        return results
+
+    def cost(pair):
+        info = infos.get(pair[0])
+        return job_memory(info, options) if info else 0
+
+    scheduler = preflight.MemoryScheduler(planned, cost, memory_budget)
+    running = {}
+    workers = min(jobs, len(planned))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while scheduler or running:
+            # Only as many files as there are workers are handed out, so a
+            # file held back for memory is not queued behind the pool's back
+            while scheduler and len(running) < workers:
+                pair = scheduler.next()
+                if pair is None:
+                    break
+                running[pool.submit(convert_task, *pair, options, collect,
+                                    hashing[pair[0]])] = pair
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                scheduler.finished(running.pop(future))
+                finish(*future.result())
+    return results
+
+
+def job_memory(info, options):
+    """Return the peak bytes converting the file described by info is expected to take"""
+    needed = info.memory(options)
+    if options.memory_limit and options.downscale_to_fit:
+        # Bounded conversions reduce the image until it fits the limit
+        needed = min(needed, options.memory_limit)
+    return needed
+
+
+def parse_sizes(value):
+    """Parse a comma-separated list of positive pixel sizes"""
+    try:
+        sizes = tuple(sorted({int(part) for part in value.split(',') if part.strip()}))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size list: {value!r}")
+    if not sizes or sizes[0] < 1:
+        raise argparse.ArgumentTypeError(f"sizes must be positive: {value!r}")
+    return sizes
+
+
+def parse_color(value):
+    """Parse a color name or #RRGGBB value into an RGB tuple"""
+    from PIL import ImageColor
+    try:
+        return ImageColor.getrgb(value)[:3]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid color: {value!r}")
+
+
+def parse_bytes(value):
+    """Parse a memory size such as 512M, 1.5G or a plain number of bytes"""
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30}
+    text = value.strip().upper().rstrip('B')
+    scale = units.get(text[-1:], 1)
+    if text[-1:] in units:
+        text = text[:-1]
+    try:
+        size = int(float(text) * scale)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {value!r}")
+    if size < 1:
+        raise argparse.ArgumentTypeError(f"size must be positive: {value!r}")
+    return size
+
+
+def parse_frames(value):
+    """Parse the --frames selection: 'all', 'primary' or an image index"""
+    if value.lower() in ('all', 'primary'):
+        return value.lower()
+    try:
+        index = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected all, primary or an index: {value!r}")
+    if index < 0:
+        raise argparse.ArgumentTypeError(f"image index must not be negative: {value!r}")
+    return index
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='heic2img',
+        description="Convert every HEIC file in a directory tree to JPG, PNG, WebP, AVIF or "
+                    "JPEG XL.")
+    parser.add_argument('in_dir', help="Directory to search for .heic files")
+    parser.add_argument('out_dir', help="Directory to write converted files to")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help="Number of worker processes (default: CPU count)")
+    parser.add_argument('-f', '--format', default='JPG', type=str.upper,
+                        choices=sorted(converter.FORMATS), help="Output format (default: JPG)")
+    parser.add_argument('-q', '--quality', type=int, default=95,
+                        help="JPEG, WebP, AVIF and JPEG XL quality (default: 95)")
+    parser.add_argument('--preset', default='balanced', type=str.lower,
+                        choices=list(converter.PRESETS),
+                        help="Encoder effort: fast, balanced or smallest output (default: "
+                             "balanced)")
+    parser.add_argument('--target-size', type=parse_bytes, default=0, metavar='SIZE',
+                        help="Search for the highest quality, up to --quality, whose JPG or WebP "
+                             "output fits in SIZE (e.g. 300K)")
+    parser.add_argument('--min-psnr', type=float, default=0, metavar='DB',
+                        help="Search for the lowest JPG or WebP quality whose output still has "
+                             "this PSNR against the original (e.g. 40); with --target-size, the "
+                             "size wins")
+    parser.add_argument('--strip-metadata', action='store_true',
+                        help="Leave out the EXIF (capture time, GPS, camera), color profile and "
+                             "XMP metadata that is otherwise copied from each HEIC")
+    parser.add_argument('--8bit-png', dest='keep_bit_depth', action='store_false',
+                        help="Write 8-bit PNG from 10- and 12-bit HEIC images instead of "
+                             "keeping their depth in 16-bit PNG")
+    parser.add_argument('--max-edge', type=int, default=0, metavar='PIXELS',
+                        help="Scale outputs down so the long edge is at most PIXELS, in the "
+                             "same pass as the conversion (with --fit fill, the side of the "
+                             "square)")
+    parser.add_argument('--max-megapixels', type=float, default=0, metavar='MP',
+                        help="Scale outputs down to at most MP million pixels")
+    parser.add_argument('--fit', default='fit', type=str.lower, choices=converter.RESIZE_FITS,
+                        help="fit keeps the whole image within the limits (default); fill "
+                             "crops it to a --max-edge square around the center")
+    parser.add_argument('--background', type=parse_color, default=(255, 255, 255),
+                        metavar='COLOR',
+                        help="Matte color behind transparent areas in JPG output, as a name "
+                             "or #RRGGBB (default: white)")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="Use one process with overlapping read/decode/encode/write stages, "
+                             "which suits network storage; --jobs sets decode and encode workers")
+    parser.add_argument('--queue-size', type=int, default=None,
+                        help="Maximum jobs waiting between pipeline stages "
+                             "(default: twice the worker count)")
+    parser.add_argument('--thumbnails', type=parse_sizes, default=(), metavar='SIZE[,SIZE...]',
+                        help="Write previews with these long-edge sizes (e.g. 256,1024) instead "
+                             "of full-size images; embedded HEIF thumbnails are used when large "
+                             "enough")
+    parser.add_argument('--frames', type=parse_frames, default='primary',
+                        metavar='all|primary|N',
+                        help="Which top-level images of burst or sequence files to export "
+                             "(default: primary)")
+    parser.add_argument('--depth', action='store_true',
+                        help="Also export depth maps as NAME_depth files")
+    parser.add_argument('--aux', action='store_true',
+                        help="Also export auxiliary images such as HDR gain maps")
+    parser.add_argument('--memory-limit', type=parse_bytes, default=0, metavar='SIZE',
+                        help="Refuse files whose conversion would use more than SIZE of memory "
+                             "per worker (e.g. 1.5G), estimated from the file header")
+    parser.add_argument('--downscale-to-fit', action='store_true',
+                        help="With --memory-limit, convert files that do not fit at a reduced "
+                             "size instead of refusing them")
+    parser.add_argument('--memory-budget', type=parse_bytes, default=None, metavar='SIZE',
+                        help="Memory all workers may use together, estimated from the file "
+                             "headers; large files wait rather than run side by side "
+                             "(default: 75%% of physical memory)")
+    parser.add_argument('--metrics-jsonl', metavar='FILE',
+                        help="Append per-file stage timings and sizes to FILE as JSON lines")
+    parser.add_argument('--metrics-prom', metavar='FILE',
+                        help="Write Prometheus text-format counters and histograms to FILE")
+    parser.add_argument('--stats', action='store_true',
+                        help="Print a per-stage timing summary at the end of the run")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Convert every file, ignoring the manifest in OUT_DIR")
+    parser.add_argument('--layout', default='mirror', choices=('mirror', 'flat'),
+                        help="mirror recreates the input folders below OUT_DIR (default); flat "
+                             "writes every output directly into OUT_DIR")
+    parser.add_argument('--name-template', default=layout.DEFAULT_TEMPLATE, metavar='TEMPLATE',
+                        help="Output file name without extension, from {stem}, {parent} (input "
+                             "folder name) and {format}; may contain / for subfolders "
+                             "(default: {stem})")
+    parser.add_argument('--on-collision', default='overwrite', choices=layout.COLLISION_POLICIES,
+                        help="When an output name is already taken: overwrite it (default), "
+                             "skip the input, or add a _1, _2... suffix")
+    parser.add_argument('--dedup', default='copy', type=str.lower, choices=dedup.MODES,
+                        help="Convert inputs with identical content once and copy (default) or "
+                             "hard-link the output to the other names, including outputs from "
+                             "earlier runs in the manifest; off converts every file")
+    parser.add_argument('--prune', action='store_true',
+                        help="Remove manifest entries whose source files no longer exist")
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue the interrupted run recorded in OUT_DIR's journal, "
+                             "without scanning IN_DIR again; use the same options as that run")
+    parser.add_argument('--retries', type=int, default=2,
+                        help="Times a failed file is tried again before it is given up on and "
+                             "listed in the dead-letter file (default: 2)")
+    parser.add_argument('--dead-letter', metavar='FILE',
+                        help="Where to list files that failed every attempt, as JSON lines "
+                             f"(default: OUT_DIR/{DEAD_LETTER_NAME})")
+    parser.add_argument('--watch', action='store_true',
+                        help="After converting existing files, keep watching IN_DIR and convert "
+                             "new or modified HEIC files as they arrive, until Ctrl+C")
+    args = parser.parse_args(argv)
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.retries < 0:
+        parser.error("--retries must not be negative")
+    try:
+        layout.check_template(args.name_template)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        converter.check_options(converter.ConversionOptions(
+            format=args.format, preset=args.preset, max_edge=args.max_edge,
+            max_megapixels=args.max_megapixels, fit=args.fit,
+            target_bytes=args.target_size, min_psnr=args.min_psnr))
+    except converter.ConversionError as e:
+        parser.error(str(e))
+    if args.thumbnails and (args.max_edge or args.max_megapixels):
+        parser.error("--thumbnails sets the output sizes itself; drop --max-edge and "
+                     "--max-megapixels")
+    if args.pipeline and args.thumbnails:
+        parser.error("--pipeline cannot be combined with --thumbnails")
+    if args.pipeline and (args.frames != 'primary' or args.depth or args.aux):
+        parser.error("--pipeline only converts the primary image")
+    if args.thumbnails and (args.frames != 'primary' or args.depth or args.aux):
+        parser.error("--thumbnails only supports the primary image")
+    if args.memory_limit and (args.pipeline or args.thumbnails or args.frames != 'primary'
+                              or args.depth or args.aux):
+        parser.error("--memory-limit only converts the primary image, without --pipeline "
+                     "or --thumbnails")
+    if args.downscale_to_fit and not args.memory_limit:
+        parser.error("--downscale-to-fit requires --memory-limit")
+    if args.watch and args.pipeline:
+        parser.error("--watch converts with worker processes and cannot use --pipeline")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not os.path.isdir(args.in_dir):
+        print(f"Error: {args.in_dir} is not a directory", file=sys.stderr)
+        return 2
+
+    options = converter.ConversionOptions(format=args.format, quality=args.quality,
+                                          background=args.background,
+                                          thumbnail_sizes=args.thumbnails,
+                                          frames=args.frames, depth_images=args.depth,
+                                          aux_images=args.aux,
+                                          memory_limit=args.memory_limit,
+                                          downscale_to_fit=args.downscale_to_fit,
+                                          preset=args.preset,
+                                          strip_metadata=args.strip_metadata,
+                                          keep_bit_depth=args.keep_bit_depth,
+                                          max_edge=args.max_edge,
+                                          max_megapixels=args.max_megapixels, fit=args.fit,
+                                          target_bytes=args.target_size,
+                                          min_psnr=args.min_psnr)
+    journal = None
+    if args.resume:
+        try:
+            journal = Journal.resume(os.path.join(args.out_dir, JOURNAL_NAME),
+                                     options_key(options))
+        except JournalError as e:
+            print(f"Error: cannot resume: {e}", file=sys.stderr)
+            return 2
+
+    # Started before the scan so files arriving during the first batch are not missed
+    # Files are sniffed only once they have settled, when their first bytes are there
+    watcher = FolderWatcher(args.in_dir) if args.watch else None
+    if journal is None:
+        files = find_heic_files(args.in_dir, skip_dir=args.out_dir)
+        if not files:
+            print("No HEIC files found.")
+            if watcher is None:
+                return 0
+
+    cache = None if args.no_cache else ConversionCache(args.out_dir)
+    if journal is not None:
+        # The journal holds the plan, so the tree is not walked or stat'ed again
+        planned, taken = journal.pending(), ()
+        print(f"Resuming: {len(planned)} of {len(journal.planned)} files left")
+        files = planned
+    else:
+        planned, taken = make_layout(args).plan(files, options, cache)
+    metrics = None
+    if args.metrics_jsonl or args.metrics_prom or args.stats:
+        metrics = MetricsCollector(args.metrics_jsonl, args.metrics_prom)
+    try:
+        code = 0
+        if files:
+            code = run_cli_batch(planned, options, args, cache, metrics, taken, journal)
+        if watcher is not None:
+            code = max(code, watch_folder(watcher, options, args, cache, metrics))
+        return code
+    finally:
+        if watcher is not None:
+            watcher.close()
+        if journal is not None:
+            journal.close()
+        if cache is not None:
+            cache.close()
+        if metrics is not None:
+            metrics.close()
+
+
+def make_report(options, cache, digests):
+    """Return the report callback that prints each outcome and records it in the cache"""
+    def report(src, dst, error):
+        if error:
+            print(f"FAILED {src}: {error}", file=sys.stderr)
+        else:
+            print(f"{src} -> {converter.primary_output(dst, options)}")
+            if cache is not None:
+                cache.record(src, converter.primary_output(dst, options), options,
+                             digest=digests.pop(src, None))
+    return report
+
+
+def report_duplicates(duplicates, mode, report):
+    """
+    Wrap report so each finished conversion also fills in its duplicates' outputs.
+
+    Args:
+        duplicates (dict): src -> [(src, dst), ...] inputs with the same content
+        mode (str): 'copy' or 'link', see dedup.place()
+        report (callable): Called with (src, dst, error) for every file,
+            duplicates included
+
+    Returns:
+        tuple: (wrapped report, list the duplicates' outcomes are appended to)
+    """
+    outcomes = []
+
+    def wrapped(src, dst, error):
+        report(src, dst, error)
+        for copy_src, copy_dst in duplicates.pop(src, ()):
+            copy_error = error and f"same content as {os.path.basename(src)}: {error}"
+            if not error:
+                try:
+                    dedup.place(dst, copy_dst, mode)
+                except OSError as e:
+                    copy_error = f"Cannot write {copy_dst}: {e}"
+            outcomes.append((copy_src, copy_dst, copy_error))
+            report(copy_src, copy_dst, copy_error)
+    return wrapped, outcomes
+
+
+def reuse_outputs(planned, options, cache, digests, mode, report):
+    """
+    Fill in outputs whose content was converted by an earlier run.
+
+    Returns:
+        tuple: (pairs that still need converting, outcomes of the reused ones)
+    """
+    pending = []
+    outcomes = []
+    for src, dst in planned:
+        existing = cache.find_output(digests[src], options) if src in digests else None
+        if existing is None:
+            pending.append((src, dst))
+            continue
+        try:
+            dedup.place(existing, dst, mode)
+            error = None
+        except OSError as e:
+            error = f"Cannot write {dst}: {e}"
+        outcomes.append((src, dst, error))
+        report(src, dst, error)
+    return pending, outcomes
+
+
+def make_final_report(journal, report):
+    """
+    Wrap report so each file's final outcome is journaled and kept.
+
+    Returns:
+        tuple: (wrapped report, dict of src -> (src, dst, error))
+    """
+    final = {}
+
+    def wrapped(src, dst, error):
+        if error:
+            journal.record_dead(src, error)
+        else:
+            journal.record_done(src)
+        final[src] = (src, dst, error)
+        report(src, dst, error)
+    return wrapped, final
+
+
+def make_retrying_report(journal, report, retries):
+    """
+    Wrap report so failed files are set aside to be tried again.
+
+    Args:
+        journal (Journal): Journal of the run; failed attempts are recorded
+            in it and counted from it, including attempts made by an earlier
+            session of a resumed run
+        report (callable): Called with (src, dst, error) once a file has
+            converted or has failed for the last time
+        retries (int): Extra attempts each file is allowed
+
+    Returns:
+        tuple: (wrapped report, list the files to retry are appended to)
+    """
+    retry = []
+
+    def wrapped(src, dst, error):
+        if error and journal.failures.get(src, 0) < retries:
+            journal.record_failed(src, error)
+            retry.append((src, dst))
+            print(f"RETRY {src}: {error}", file=sys.stderr)
+        else:
+            report(src, dst, error)
+    return wrapped, retry
+
+
+def run_cli_batch(planned, options, args, cache, metrics=None, taken=(), journal=None):
+    skipped = 0
+    if journal is None:
+        if cache is not None:
+            pending = [(src, dst) for src, dst in planned
+                       if not cache.is_fresh(src, converter.primary_output(dst, options),
+                                             options)]
+            skipped = len(planned) - len(pending)
+            planned = pending
+        journal = Journal.create(os.path.join(args.out_dir, JOURNAL_NAME), options_key(options),
+                                 planned)
+    create_output_dirs(planned)
+    # Inputs are hashed by the workers, in parallel, rather than re-read here
+    digests = {} if cache is not None else None
+    final_report, final = make_final_report(journal, make_report(options, cache, digests))
+    report = final_report
+
+    start = time.perf_counter()
+    total = len(planned)
+    # Headers are read before anything is hashed or decoded, so broken files fail at once
+    infos, rejected = preflight.scan([src for src, _ in planned], args.jobs)
+    if rejected:
+        bad = dict(rejected)
+        for src, dst in [pair for pair in planned if pair[0] in bad]:
+            final_report(src, dst, bad[src])
+        planned = [(src, dst) for src, dst in planned if src not in bad]
+    budget = preflight.default_budget() if args.memory_budget is None else args.memory_budget
+    reused = []
+    duplicated = []
+    if args.dedup != 'off' and dedup.supports(options):
+        sizes = cache.input_sizes(options) if cache is not None else set()
+        hashed = dedup.hash_candidates([src for src, _ in planned], sizes, args.jobs)
+        if digests is not None:
+            digests.update(hashed)
+            planned, reused = reuse_outputs(planned, options, cache, hashed, args.dedup,
+                                            final_report)
+        planned, duplicates = dedup.split_duplicates(planned, hashed)
+        report, duplicated = report_duplicates(duplicates, args.dedup, final_report)
+    # Retries come first, so duplicates are only filled in once their original's outcome is final
+    report, retry = make_retrying_report(journal, report, args.retries)
+
+    rounds = 0
+    with journal:
+        while planned:
+            if args.pipeline:
+                pipeline = Pipeline(options, decoders=args.jobs, encoders=args.jobs,
+                                    queue_size=args.queue_size)
+                pipeline.run(preflight.largest_first(planned, infos), report, metrics, digests)
+            else:
+                run_batch(planned, options, args.jobs, report, metrics, digests, infos,
+                          budget)
+            planned, retry[:] = list(retry), []
+            if planned:
+                rounds += 1
+                print(f"Retrying {len(planned)} failed files", file=sys.stderr)
+                time.sleep(RETRY_DELAY * rounds)
+    results = list(final.values())
+    elapsed = time.perf_counter() - start
+
+    failed = [r for r in results if r[2]]
+    print(f"\nConverted {len(results) - len(failed)} of {len(results)} files "
+          f"in {elapsed:.1f}s ({len(results) / elapsed if elapsed else 0:.1f} files/s)")
+    if skipped:
+        print(f"Skipped {skipped} unchanged files")
+    if taken:
+        print(f"Skipped {len(taken)} files whose output name is already taken")
+    if reused or duplicated:
+        hits = len(reused) + len(duplicated)
+        print(f"Deduplicated {hits} of {total} files ({100 * hits / total:.0f}% hit rate): "
+              f"{len(duplicated)} repeated in this batch, {len(reused)} from earlier runs")
+    dead_letter = args.dead_letter or os.path.join(args.out_dir, DEAD_LETTER_NAME)
+    if journal.dead:
+        count = journal.write_dead_letters(dead_letter)
+        print(f"{count} files failed every attempt; listed in {dead_letter}")
+    elif os.path.exists(dead_letter):
+        os.remove(dead_letter)
+    if args.stats and metrics is not None:
+        print(metrics.summary())
+    if cache is not None and args.prune:
+        print(f"Pruned {cache.prune()} stale manifest entries")
+    return 1 if failed else 0
+
+
+def watch_folder(watcher, options, args, cache, metrics=None, stop=None):
+    """
+    Convert files reported by watcher until Ctrl+C, or until stop is set.
+
+    Conversions run on a pool of worker processes that stays up for the
+    whole session, so a file that has finished syncing is converted without
+    paying for process start-up. Files already converted with the same
+    settings are skipped using the cache.
+
+    Args:
+        watcher (FolderWatcher): Watcher on args.in_dir
+        options (ConversionOptions): Conversion settings
+        args (argparse.Namespace): Parsed command line
+        cache (ConversionCache): Manifest to check and update, or None
+        metrics (MetricsCollector): If given, receives per-file stage metrics
+        stop (threading.Event): If given, watching ends once it is set
+
+    Returns:
+        int: 1 if any file failed to convert, otherwise 0
+    """
+    digests = {} if cache is not None else None
+    report = make_report(options, cache, digests)
+    collect = metrics is not None
+    outputs = make_layout(args)
+    pending = set()
+    failed = 0
+
+    def finish(future):
+        nonlocal failed
+        outcome, file_metrics, digest = future.result()
+        if collect:
+            metrics.add(FileMetrics.from_dict(file_metrics))
+        if digest is not None:
+            digests[outcome[0]] = digest
+        failed += bool(outcome[2])
+        report(*outcome)
+
+    print(f"Watching {args.in_dir} for new HEIC files; press Ctrl+C to stop")
+    with ProcessPoolExecutor(max_workers=args.jobs or os.cpu_count() or 1,
+                             initializer=converter.register_opener) as pool:
+        try:
+            while stop is None or not stop.is_set():
+                for src in watcher.wait(timeout=WATCH_TICK):
+                    if is_within(src, args.out_dir) or not sniff.is_heif_input(src):
+                        continue
+                    planned, _ = outputs.plan([src], options, cache)
+                    if not planned:
+                        print(f"Skipped {src}: output name already taken")
+                        continue
+                    (src, dst), = planned
+                    if cache is not None and cache.is_fresh(
+                            src, converter.primary_output(dst, options), options):
+                        continue
+                    outputs.make_dirs([dst])
+                    pending.add(pool.submit(convert_task, src, dst, options, collect,
+                                            digests is not None))
+                for future in [f for f in pending if f.done()]:
+                    pending.discard(future)
+                    finish(future)
+        except KeyboardInterrupt:
+            print("\nStopping; waiting for conversions in progress...")
+        for future in pending:
+            finish(future)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
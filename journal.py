@@ -0,0 +1,175 @@
+"""
+Checkpoint journal for HEIC to JPG/PNG Converter
+Records the plan and outcome of every file in a batch run so an interrupted run can resume
+"""
+
+import json
+import os
+import time
+
+JOURNAL_NAME = '.heic2img-journal.jsonl'
+DEAD_LETTER_NAME = 'heic2img-failed.jsonl'
+
+# Lines are flushed as they are written, which survives the process crashing;
+# they are also synced to disk this often, which survives the machine going down
+SYNC_INTERVAL = 1.0
+
+_VERSION = 1
+
+
+class JournalError(Exception):
+    """Raised when a journal cannot be resumed"""
+
+
+class Journal:
+    """
+    Append-only record of a batch run.
+
+    The journal starts with the run's settings and every planned (src, dst)
+    pair, then gets one line per outcome: 'done', 'failed' for an attempt that
+    will be retried, and 'dead' for a file that used up its retries. Files
+    that are planned but have no final outcome were waiting or in flight when
+    the run stopped. A line cut short by a crash is ignored on reading.
+
+    Use Journal.create() for a new run and Journal.resume() to continue one.
+    """
+
+    def __init__(self, path, f, options_key):
+        self.path = path
+        self.options_key = options_key
+        self.planned = []
+        self.done = set()
+        self.dead = {}
+        self.failures = {}
+        self._file = f
+        self._last_sync = time.monotonic()
+
+    @classmethod
+    def create(cls, path, options_key, planned):
+        """
+        Start a new journal at path, replacing any earlier one.
+
+        Args:
+            path (str): Journal file
+            options_key (str): Conversion settings, from cache.options_key()
+            planned (list): (src, dst) pairs the run will convert
+
+        Returns:
+            Journal: Open for appending outcomes
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        temp = path + '.tmp'
+        with open(temp, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'event': 'run', 'version': _VERSION,
+                                'options': options_key}) + '\n')
+            for src, dst in planned:
+                f.write(json.dumps({'event': 'plan', 'src': src, 'dst': dst}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, path)
+        journal = cls(path, open(path, 'a', encoding='utf-8'), options_key)
+        journal.planned = list(planned)
+        return journal
+
+    @classmethod
+    def resume(cls, path, options_key):
+        """
+        Reopen the journal at path to continue the run it records.
+
+        Args:
+            path (str): Journal file
+            options_key (str): Settings of the resuming run, which must match
+
+        Returns:
+            Journal: With planned, done, failures and dead filled in
+
+        Raises:
+            JournalError: If there is no journal or it was written with other settings
+        """
+        try:
+            f = open(path, encoding='utf-8')
+        except FileNotFoundError:
+            raise JournalError(f"no journal to resume at {path}") from None
+        with f:
+            lines = f.read().splitlines()
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # The last line may have been cut short by a crash
+                continue
+        if not records or records[0].get('event') != 'run':
+            raise JournalError(f"{path} is not a heic2img journal")
+        if records[0].get('options') != options_key:
+            raise JournalError("the journal was written with different conversion settings; "
+                               "resume with the same options as the original run")
+
+        journal = cls(path, open(path, 'a', encoding='utf-8'), options_key)
+        for record in records[1:]:
+            event, src = record.get('event'), record.get('src')
+            if event == 'plan':
+                journal.planned.append((src, record['dst']))
+            elif event == 'done':
+                journal.done.add(src)
+                journal.dead.pop(src, None)
+            elif event == 'failed':
+                journal.failures[src] = journal.failures.get(src, 0) + 1
+            elif event == 'dead':
+                journal.failures[src] = journal.failures.get(src, 0) + 1
+                journal.dead[src] = record.get('error')
+        return journal
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def pending(self):
+        """Return the planned (src, dst) pairs that have no final outcome yet"""
+        return [(src, dst) for src, dst in self.planned
+                if src not in self.done and src not in self.dead]
+
+    def record_done(self, src):
+        self.done.add(src)
+        self._write({'event': 'done', 'src': src})
+
+    def record_failed(self, src, error):
+        """Record a failed attempt that will be retried"""
+        self.failures[src] = self.failures.get(src, 0) + 1
+        self._write({'event': 'failed', 'src': src, 'error': error})
+
+    def record_dead(self, src, error):
+        """Record a file that failed its last allowed attempt"""
+        self.failures[src] = self.failures.get(src, 0) + 1
+        self.dead[src] = error
+        self._write({'event': 'dead', 'src': src, 'error': error})
+
+    def write_dead_letters(self, path):
+        """
+        Write every file that used up its retries to path as JSON lines.
+
+        Returns:
+            int: Number of files listed
+        """
+        destinations = dict(self.planned)
+        with open(path, 'w', encoding='utf-8') as f:
+            for src, error in self.dead.items():
+                f.write(json.dumps({'src': src, 'dst': destinations.get(src), 'error': error,
+                                    'attempts': self.failures.get(src, 1)}) + '\n')
+        return len(self.dead)
+
+    def close(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+    def _write(self, record):
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        if time.monotonic() - self._last_sync >= SYNC_INTERVAL:
+            os.fsync(self._file.fileno())
+            self._last_sync = time.monotonic()
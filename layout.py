@@ -0,0 +1,159 @@
+"""
+Output layout for HEIC to JPG/PNG Converter
+Decides where batch outputs go: folders, file names, and what to do when a name is taken
+"""
+
+import os
+import string
+
+import converter
+
+# What to do when an output name is already taken
+COLLISION_POLICIES = ('overwrite', 'skip', 'suffix')
+
+# Fields a name template may use
+TEMPLATE_FIELDS = ('stem', 'parent', 'format')
+
+DEFAULT_TEMPLATE = '{stem}'
+
+
+class OutputLayout:
+    """
+    Maps input files to output paths for a batch run.
+
+    Outputs go below out_dir, in the same folders the inputs have below
+    in_dir (mirror) or all directly in out_dir. The file name comes from a
+    template; the output format's extension is added to it. A template may
+    contain slashes to sort outputs into subfolders.
+
+    When a name is taken, by an existing file or by an earlier input in the
+    same batch, the collision policy decides: 'overwrite' replaces it, 'skip'
+    leaves the input out, and 'suffix' adds _1, _2 and so on until the name is
+    free.
+
+    Args:
+        in_dir (str): Directory the inputs were found in
+        out_dir (str): Directory outputs are written below
+        template (str): Output name without extension; may use {stem} (input
+            name without extension), {parent} (name of the input's folder)
+            and {format} (output format, lower case)
+        mirror (bool): Recreate the input folders below out_dir
+        collision (str): 'overwrite', 'skip' or 'suffix'
+
+    Raises:
+        ValueError: If the template or collision policy is not valid
+    """
+
+    def __init__(self, in_dir, out_dir, template=DEFAULT_TEMPLATE, mirror=True,
+                 collision='overwrite'):
+        self.in_dir = in_dir
+        self.out_dir = out_dir
+        self.template = template
+        self.mirror = mirror
+        self.collision = collision
+        self._made_dirs = set()
+        if collision not in COLLISION_POLICIES:
+            raise ValueError(f"collision policy must be one of {', '.join(COLLISION_POLICIES)}")
+        check_template(template)
+
+    def target(self, src, options):
+        """Return the output path for src before any collision is resolved"""
+        stem = os.path.splitext(os.path.basename(src))[0]
+        parent = os.path.basename(os.path.dirname(os.path.abspath(src)))
+        name = self.template.format(stem=stem, parent=parent, format=options.format.lower())
+        directory = self.out_dir
+        if self.mirror:
+            directory = os.path.join(directory, os.path.dirname(os.path.relpath(src, self.in_dir)))
+        return converter.output_path(os.path.join(directory, os.path.normpath(name)), options)
+
+    def plan(self, files, options, cache=None):
+        """
+        Choose the output path of every input.
+
+        Args:
+            files (list): Input files, in the order names are handed out
+            options (ConversionOptions): Conversion settings
+            cache (ConversionCache): If given, an existing file that is the
+                recorded output of the same input is not a collision, so
+                reruns keep their names
+
+        Returns:
+            tuple: ((src, dst) pairs to convert, inputs skipped because their
+                output name is taken)
+        """
+        planned = []
+        skipped = []
+        claimed = set()
+        for src in files:
+            dst = self.target(src, options)
+            if self.collision != 'overwrite':
+                dst = self._resolve(src, dst, options, claimed, cache)
+                if dst is None:
+                    skipped.append(src)
+                    continue
+            claimed.add(os.path.abspath(converter.primary_output(dst, options)))
+            planned.append((src, dst))
+        return planned, skipped
+
+    def _resolve(self, src, dst, options, claimed, cache):
+        recorded = cache.recorded_output(src, options) if cache is not None else None
+        stem, extension = os.path.splitext(dst)
+        candidate = dst
+        n = 0
+        while True:
+            primary = os.path.abspath(converter.primary_output(candidate, options))
+            taken = primary in claimed or (primary != recorded and os.path.lexists(primary))
+            if not taken:
+                return candidate
+            if self.collision == 'skip':
+                return None
+            n += 1
+            candidate = f"{stem}_{n}{extension}"
+
+    def make_dirs(self, paths):
+        """Create the folders the output paths need, each at most once per layout"""
+        make_dirs(paths, self._made_dirs)
+
+
+def make_dirs(paths, made=None):
+    """
+    Create the folders a set of output paths needs, before any worker starts.
+
+    Only the deepest new folders are passed to makedirs, which creates their
+    parents on the way, so a batch of thousands of files costs one call per
+    leaf folder rather than a makedirs or exists call per file.
+
+    Args:
+        paths (iterable): Output file paths
+        made (set): Folders known to exist; skipped, and updated with the
+            folders created
+    """
+    made = set() if made is None else made
+    wanted = {os.path.dirname(os.path.abspath(path)) for path in paths} - made
+    # Deepest first, so each parent is marked as made before it comes up
+    for directory in sorted(wanted, reverse=True):
+        if directory in made:
+            continue
+        os.makedirs(directory, exist_ok=True)
+        while directory not in made and directory != os.path.dirname(directory):
+            made.add(directory)
+            directory = os.path.dirname(directory)
+
+
+def check_template(template):
+    """
+    Raise ValueError if template is not a usable output name template.
+    """
+    try:
+        fields = [field for _, field, _, _ in string.Formatter().parse(template)
+                  if field is not None]
+    except ValueError as e:
+        raise ValueError(f"invalid name template {template!r}: {e}")
+    unknown = [field for field in fields if field not in TEMPLATE_FIELDS]
+    if unknown:
+        raise ValueError(f"unknown field {{{unknown[0]}}} in name template; "
+                         f"use {', '.join('{' + f + '}' for f in TEMPLATE_FIELDS)}")
+    name = template.format(stem='x', parent='x', format='x')
+    if not name or os.path.isabs(name) or '..' in name.replace('\\', '/').split('/'):
+        raise ValueError(f"name template {template!r} must give a relative name inside "
+                         "the output folder")
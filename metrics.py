@@ -0,0 +1,308 @@
+"""
+Conversion metrics for HEIC to JPG/PNG Converter
+Records per-file, per-stage timings and sizes, and exports them as JSON lines or Prometheus text
+"""
+
+import json
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+PROMETHEUS_WRITE_INTERVAL = 5.0
+
+# Per-stage wall time samples kept for the summary's p95; older samples are
+# replaced at random so the reservoir stays a uniform sample of the whole batch
+RESERVOIR_SIZE = 1024
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process in bytes, or None where unsupported"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def current_rss_bytes():
+    """Current resident set size of this process in bytes, or None where unsupported"""
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident_pages * os.sysconf('SC_PAGE_SIZE')
+
+
+class FileMetrics:
+    """
+    Timings and sizes for one converted file.
+
+    Each stage records wall time and the CPU time of the calling thread, so
+    figures stay per-file when several files convert in parallel threads.
+    Where the current RSS can be read (Linux), each stage also records
+    rss_delta_bytes: how much the resident set grew across the stage, the
+    largest growth if the stage ran more than once. That is the memory the
+    stage itself added, although threads converting other files at the
+    same time contribute to it too. peak_rss_bytes is the process
+    high-water mark seen at the end of each stage; in a worker process that
+    converts many files it only ever goes up, so it describes the process
+    rather than the file.
+
+    When the quality is searched for a target size or PSNR floor, quality is
+    the one chosen and encode_attempts counts the encodes it took; the
+    encode stage covers all of them.
+    """
+
+    def __init__(self, src):
+        self.src = src
+        self.stages = {}
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.peak_rss_bytes = None
+        self.error = None
+        self.quality = None
+        self.encode_attempts = 0
+
+    @contextmanager
+    def stage(self, name):
+        rss_start = current_rss_bytes()
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            totals = self.stages.setdefault(name, {'wall_s': 0.0, 'cpu_s': 0.0})
+            totals['wall_s'] += time.perf_counter() - wall_start
+            totals['cpu_s'] += time.thread_time() - cpu_start
+            if rss_start is not None:
+                delta = current_rss_bytes() - rss_start
+                totals['rss_delta_bytes'] = max(totals.get('rss_delta_bytes', delta), delta)
+            self.peak_rss_bytes = peak_rss_bytes()
+
+    def move_time(self, source, target, wall_s, cpu_s):
+        """Reassign time measured inside stage source to stage target"""
+        totals = self.stages[source]
+        totals['wall_s'] -= wall_s
+        totals['cpu_s'] -= cpu_s
+        moved = self.stages.setdefault(target, {'wall_s': 0.0, 'cpu_s': 0.0})
+        moved['wall_s'] += wall_s
+        moved['cpu_s'] += cpu_s
+
+    def to_dict(self):
+        return {
+            'src': self.src,
+            'stages': self.stages,
+            'input_bytes': self.input_bytes,
+            'output_bytes': self.output_bytes,
+            'peak_rss_bytes': self.peak_rss_bytes,
+            'error': self.error,
+            'quality': self.quality,
+            'encode_attempts': self.encode_attempts,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        file_metrics = cls(data['src'])
+        file_metrics.stages = data['stages']
+        file_metrics.input_bytes = data['input_bytes']
+        file_metrics.output_bytes = data['output_bytes']
+        file_metrics.peak_rss_bytes = data['peak_rss_bytes']
+        file_metrics.error = data['error']
+        file_metrics.quality = data.get('quality')
+        file_metrics.encode_attempts = data.get('encode_attempts', 0)
+        return file_metrics
+
+
+class MetricsCollector:
+    """
+    Aggregates FileMetrics from a batch.
+
+    Args:
+        jsonl_path (str): If set, one JSON object per file is appended here
+        prometheus_path (str): If set, Prometheus text-format counters and
+            histograms are rewritten here periodically and when closed, for
+            a textfile collector or local scraper to pick up
+    """
+
+    def __init__(self, jsonl_path=None, prometheus_path=None):
+        self.prometheus_path = prometheus_path
+        self._jsonl = open(jsonl_path, 'a') if jsonl_path else None
+        self._lock = threading.Lock()
+        self._last_prometheus_write = 0.0
+        self.files_ok = 0
+        self.files_failed = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.peak_rss_bytes = None
+        # Running histogram per stage: bucket counts (not cumulative), sum and count
+        self.stage_buckets = {}
+        self.stage_wall_sum = {}
+        self.stage_count = {}
+        self.stage_samples = {}
+        self.stage_cpu = {}
+        self.stage_rss_delta = {}
+        self.searched_files = 0
+        self.encode_attempts = 0
+        self.searched_quality_sum = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def add(self, file_metrics):
+        with self._lock:
+            if file_metrics.error:
+                self.files_failed += 1
+            else:
+                self.files_ok += 1
+            self.input_bytes += file_metrics.input_bytes
+            self.output_bytes += file_metrics.output_bytes
+            if file_metrics.peak_rss_bytes is not None:
+                self.peak_rss_bytes = max(self.peak_rss_bytes or 0, file_metrics.peak_rss_bytes)
+            if file_metrics.quality is not None:
+                self.searched_files += 1
+                self.encode_attempts += file_metrics.encode_attempts
+                self.searched_quality_sum += file_metrics.quality
+            for name, totals in file_metrics.stages.items():
+                self._add_sample(name, totals['wall_s'])
+                self.stage_cpu[name] = self.stage_cpu.get(name, 0.0) + totals['cpu_s']
+                if 'rss_delta_bytes' in totals:
+                    self.stage_rss_delta[name] = max(self.stage_rss_delta.get(name, 0),
+                                                     totals['rss_delta_bytes'])
+
+            if self._jsonl:
+                self._jsonl.write(json.dumps(file_metrics.to_dict()) + '\n')
+            if (self.prometheus_path and time.monotonic() - self._last_prometheus_write
+                    >= PROMETHEUS_WRITE_INTERVAL):
+                self._write_prometheus()
+
+    def _add_sample(self, name, wall_s):
+        if name not in self.stage_buckets:
+            self.stage_buckets[name] = [0] * len(BUCKETS)
+            self.stage_wall_sum[name] = 0.0
+            self.stage_count[name] = 0
+            self.stage_samples[name] = []
+        for i, bound in enumerate(BUCKETS):
+            if wall_s <= bound:
+                self.stage_buckets[name][i] += 1
+                break
+        self.stage_wall_sum[name] += wall_s
+        self.stage_count[name] += 1
+        samples = self.stage_samples[name]
+        if len(samples) < RESERVOIR_SIZE:
+            samples.append(wall_s)
+        else:
+            slot = random.randrange(self.stage_count[name])
+            if slot < RESERVOIR_SIZE:
+                samples[slot] = wall_s
+
+    def close(self):
+        with self._lock:
+            if self._jsonl:
+                self._jsonl.close()
+                self._jsonl = None
+            if self.prometheus_path:
+                self._write_prometheus()
+
+    def _write_prometheus(self):
+        temp_path = self.prometheus_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(temp_path, self.prometheus_path)
+        self._last_prometheus_write = time.monotonic()
+
+    def prometheus_text(self):
+        """Render the aggregate metrics in the Prometheus text exposition format"""
+        lines = [
+            "# HELP heic2img_files_total Files processed, by outcome.",
+            "# TYPE heic2img_files_total counter",
+            f'heic2img_files_total{{status="ok"}} {self.files_ok}',
+            f'heic2img_files_total{{status="failed"}} {self.files_failed}',
+            "# HELP heic2img_input_bytes_total Bytes of HEIC input read.",
+            "# TYPE heic2img_input_bytes_total counter",
+            f"heic2img_input_bytes_total {self.input_bytes}",
+            "# HELP heic2img_output_bytes_total Bytes of converted output written.",
+            "# TYPE heic2img_output_bytes_total counter",
+            f"heic2img_output_bytes_total {self.output_bytes}",
+            "# HELP heic2img_stage_cpu_seconds_total CPU time spent in each stage.",
+            "# TYPE heic2img_stage_cpu_seconds_total counter",
+        ]
+        for name in sorted(self.stage_cpu):
+            lines.append(f'heic2img_stage_cpu_seconds_total{{stage="{name}"}} '
+                         f'{self.stage_cpu[name]:.6f}')
+
+        lines += [
+            "# HELP heic2img_stage_seconds Wall time per file spent in each stage.",
+            "# TYPE heic2img_stage_seconds histogram",
+        ]
+        for name in sorted(self.stage_buckets):
+            cumulative = 0
+            for bound, count in zip(BUCKETS, self.stage_buckets[name]):
+                cumulative += count
+                lines.append(f'heic2img_stage_seconds_bucket{{stage="{name}",le="{bound:g}"}} '
+                             f'{cumulative}')
+            count = self.stage_count[name]
+            lines.append(f'heic2img_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {count}')
+            lines.append(f'heic2img_stage_seconds_sum{{stage="{name}"}} '
+                         f'{self.stage_wall_sum[name]:.6f}')
+            lines.append(f'heic2img_stage_seconds_count{{stage="{name}"}} {count}')
+
+        if self.stage_rss_delta:
+            lines += [
+                "# HELP heic2img_stage_rss_delta_bytes Largest RSS growth seen across one stage.",
+                "# TYPE heic2img_stage_rss_delta_bytes gauge",
+            ]
+            for name in sorted(self.stage_rss_delta):
+                lines.append(f'heic2img_stage_rss_delta_bytes{{stage="{name}"}} '
+                             f'{self.stage_rss_delta[name]}')
+
+        if self.searched_files:
+            lines += [
+                "# HELP heic2img_quality_search_files_total Files whose quality was searched.",
+                "# TYPE heic2img_quality_search_files_total counter",
+                f"heic2img_quality_search_files_total {self.searched_files}",
+                "# HELP heic2img_encode_attempts_total Encodes made by quality searches.",
+                "# TYPE heic2img_encode_attempts_total counter",
+                f"heic2img_encode_attempts_total {self.encode_attempts}",
+            ]
+        if self.peak_rss_bytes is not None:
+            lines += [
+                "# HELP heic2img_peak_rss_bytes Highest peak RSS reported by any worker.",
+                "# TYPE heic2img_peak_rss_bytes gauge",
+                f"heic2img_peak_rss_bytes {self.peak_rss_bytes}",
+            ]
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Human-readable totals showing where conversion time went"""
+        files = self.files_ok + self.files_failed
+        lines = [f"{files} files ({self.files_failed} failed), "
+                 f"{self.input_bytes / 1e6:.1f} MB in, {self.output_bytes / 1e6:.1f} MB out"]
+        total = sum(self.stage_wall_sum.values())
+        for name, wall_s in sorted(self.stage_wall_sum.items(), key=lambda i: -i[1]):
+            share = wall_s / total * 100 if total else 0
+            mean = wall_s / self.stage_count[name]
+            samples = sorted(self.stage_samples[name])
+            p95 = samples[int(0.95 * (len(samples) - 1))]
+            line = f"  {name:<8} {share:5.1f}%  mean {mean * 1000:.0f} ms  p95 {p95 * 1000:.0f} ms"
+            if name in self.stage_rss_delta:
+                line += f"  RSS +{max(self.stage_rss_delta[name], 0) / 1e6:.0f} MB"
+            lines.append(line)
+        if self.searched_files:
+            lines.append(f"  quality search: {self.encode_attempts / self.searched_files:.1f} "
+                         f"encodes per file, mean quality "
+                         f"{self.searched_quality_sum / self.searched_files:.0f}")
+        if self.peak_rss_bytes is not None:
+            lines.append(f"  peak RSS {self.peak_rss_bytes / 1e6:.0f} MB")
+        return '\n'.join(lines)
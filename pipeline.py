@@ -0,0 +1,175 @@
+"""
+Streaming conversion pipeline for HEIC to JPG/PNG Converter
+Overlaps file reads, decoding, encoding and writes using bounded queues between stages
+"""
+
+import hashlib
+import os
+import queue
+import threading
+
+import converter
+from metrics import FileMetrics
+
+# Marks the end of the work stream; each stage forwards it once all its workers stop
+_DONE = object()
+
+
+class _Job:
+    """One file moving through the pipeline"""
+    __slots__ = ('src', 'dst', 'payload', 'error', 'metrics', 'digest', 'metadata')
+
+    def __init__(self, src, dst, metrics=None, hash_input=False):
+        self.src = src
+        self.dst = dst
+        self.payload = None
+        self.error = None
+        self.metrics = metrics or converter.NullMetrics()
+        # Set to the content hash after the read when the caller wants digests
+        self.digest = '' if hash_input else None
+        self.metadata = None
+
+
+def _read(job, options):
+    with job.metrics.stage('read'):
+        with open(job.src, 'rb') as f:
+            job.payload = f.read()
+    job.metrics.input_bytes += len(job.payload)
+    if job.digest is not None:
+        # Same digest as cache.file_digest, taken from the bytes already in memory
+        job.digest = hashlib.blake2b(job.payload, digest_size=20).hexdigest()
+
+
+def _decode(job, options):
+    with job.metrics.stage('decode'):
+        image = converter.decode_bytes(job.payload)
+    job.metadata = converter.image_metadata(image.info, options)
+    with job.metrics.stage('flatten'):
+        job.payload = converter.prepare_image(image, options)
+
+
+def _encode(job, options):
+    with job.metrics.stage('encode'):
+        job.payload = converter.encode_bytes(job.payload, options, job.metadata)
+
+
+def _write(job, options):
+    with job.metrics.stage('write'):
+        with converter.atomic_output(job.dst) as temp, open(temp, 'wb') as f:
+            f.write(job.payload)
+    job.metrics.output_bytes += len(job.payload)
+    job.payload = None
+
+
+class Pipeline:
+    """
+    Staged converter: read -> decode -> encode -> write.
+
+    Each stage runs on its own worker threads and hands jobs to the next stage
+    through a bounded queue. When a downstream stage falls behind, the queue
+    fills up and the upstream workers block, so at most queue_size jobs wait
+    between any two stages no matter how large the batch is. Pillow and libheif
+    release the GIL while decoding and encoding, so the stages overlap on
+    multiple cores.
+    """
+
+    def __init__(self, options, readers=2, decoders=None, encoders=None, writers=2,
+                 queue_size=None):
+        workers = os.cpu_count() or 1
+        self.options = options
+        self.decoders = decoders or workers
+        self.encoders = encoders or workers
+        self.stages = [
+            (_read, readers),
+            (_decode, self.decoders),
+            (_encode, self.encoders),
+            (_write, writers),
+        ]
+        self.queue_size = queue_size or 2 * max(self.decoders, self.encoders)
+
+    def run(self, planned, report=None, metrics=None, digests=None):
+        """
+        Convert planned (src, dst) pairs.
+
+        Args:
+            planned (list): (src, dst) pairs to convert
+            report (callable): Called with (src, dst, error) as each file finishes
+            metrics (MetricsCollector): If given, receives per-file stage metrics
+            digests (dict): If given, each input not already in it is hashed by
+                the read stage and src -> digest is stored here before report
+                is called
+
+        Returns:
+            list: (src, dst, error) tuples for every file, in completion order
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = []
+        for (func, count), inbox, outbox in zip(self.stages, queues, queues[1:]):
+            threads.append(self._start_stage(func, count, inbox, outbox))
+
+        feeder = threading.Thread(target=self._feed,
+                                  args=(planned, queues[0], metrics, digests),
+                                  daemon=True)
+        feeder.start()
+
+        results = []
+        done = queues[-1]
+        while True:
+            job = done.get()
+            if job is _DONE:
+                break
+            outcome = (job.src, job.dst, job.error)
+            results.append(outcome)
+            if metrics is not None:
+                job.metrics.error = job.error
+                metrics.add(job.metrics)
+            if job.digest and job.error is None:
+                digests[job.src] = job.digest
+            if report:
+                report(*outcome)
+
+        feeder.join()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def _feed(self, planned, inbox, metrics, digests):
+        for src, dst in planned:
+            inbox.put(_Job(src, dst, FileMetrics(src) if metrics is not None else None,
+                           digests is not None and src not in digests))
+        inbox.put(_DONE)
+
+    def _start_stage(self, func, count, inbox, outbox):
+        def work():
+            while True:
+                job = inbox.get()
+                if job is _DONE:
+                    # Let sibling workers see the marker too
+                    inbox.put(_DONE)
+                    return
+                if job.error is None:
+                    try:
+                        func(job, self.options)
+                    except MemoryError:
+                        job.error = str(converter.MemoryLimitError(
+                            f"Ran out of memory converting {os.path.basename(job.src)}"))
+                        job.payload = None
+                    except Exception as e:
+                        # A worker that dies loses its job and can stall the whole stream,
+                        # so every failure is reported against the file instead
+                        job.error = str(e) or e.__class__.__name__
+                        job.payload = None
+                outbox.put(job)
+
+        workers = [threading.Thread(target=work, daemon=True) for _ in range(count)]
+        for worker in workers:
+            worker.start()
+
+        def finish():
+            for worker in workers:
+                worker.join()
+            outbox.put(_DONE)
+
+        supervisor = threading.Thread(target=finish, daemon=True)
+        supervisor.start()
+        return supervisor
@@ -0,0 +1,173 @@
+"""
+Pre-flight scan for HEIC to JPG/PNG Converter
+Reads HEIF headers, without decoding any pixels, to reject bad files early and schedule big ones
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import pillow_heif
+
+import converter
+import sniff
+
+# Share of physical memory a batch may plan to use at once when no budget is given
+DEFAULT_BUDGET_SHARE = 0.75
+
+
+@dataclass
+class ImageInfo:
+    """What the container header says about a HEIC file"""
+    path: str
+    # (width, height) of the primary image
+    size: tuple
+    # Top-level images in the container; more than one for bursts and sequences
+    frames: int
+    bit_depth: int
+    has_alpha: bool
+
+    @property
+    def pixels(self):
+        return self.size[0] * self.size[1]
+
+    def memory(self, options=None):
+        """Peak bytes converting the file is expected to take, from converter.estimate_memory()"""
+        mode = 'RGBA' if self.has_alpha else 'RGB'
+        return converter.estimate_memory(self.size, mode, self.bit_depth, options)[1]
+
+
+def inspect(path):
+    """
+    Read the header of one HEIC file.
+
+    libheif parses the container's boxes and the primary image's properties;
+    nothing is decoded, so this costs a few small reads however large the
+    image is.
+
+    Args:
+        path (str): File to inspect
+
+    Returns:
+        ImageInfo: Dimensions, frame count, bit depth and alpha of the primary image
+
+    Raises:
+        ConversionError: If the file cannot be read, is not a HEIF image (by
+            the brands of its ftyp box), uses a codec no decoder here handles,
+            or its header is damaged
+    """
+    name = os.path.basename(path)
+    try:
+        with open(path, 'rb') as f:
+            codec = sniff.heif_codec(f.read(sniff.SNIFF_BYTES))
+    except FileNotFoundError:
+        raise converter.ConversionError(f"{name} does not exist") from None
+    except OSError as e:
+        raise converter.ConversionError(f"Cannot read {name}: {e}") from e
+    # The brands rule out other files before libheif parses anything
+    if codec is None:
+        raise converter.ConversionError(f"{name} is not a HEIF image")
+    if codec not in sniff.decodable_codecs():
+        raise converter.ConversionError(
+            f"{name} holds {codec} images, which this installation cannot decode")
+    try:
+        heif_file = pillow_heif.open_heif(path, convert_hdr_to_8bit=False)
+        primary = heif_file[heif_file.primary_index]
+        return ImageInfo(path, primary.size, len(heif_file),
+                         primary.info.get('bit_depth') or 8, primary.has_alpha)
+    except (OSError, ValueError, RuntimeError, IndexError) as e:
+        raise converter.ConversionError(f"{name} is not a readable HEIC image: {e}") from e
+
+
+def scan(paths, workers=None):
+    """
+    Inspect many files at once on threads; libheif reads headers without the GIL.
+
+    Args:
+        paths (list): Files to inspect
+        workers (int): Threads; defaults to the CPU count
+
+    Returns:
+        tuple: ({path: ImageInfo} for the good files, [(path, error message)]
+            for the rejected ones, in the order given)
+    """
+    def check(path):
+        try:
+            return inspect(path), None
+        except converter.ConversionError as e:
+            return None, str(e)
+
+    infos = {}
+    rejected = []
+    if not paths:
+        return infos, rejected
+    with ThreadPoolExecutor(max_workers=min(len(paths), workers or os.cpu_count() or 1)) as pool:
+        for path, (info, error) in zip(paths, pool.map(check, paths)):
+            if error is None:
+                infos[path] = info
+            else:
+                rejected.append((path, error))
+    return infos, rejected
+
+
+def largest_first(planned, infos):
+    """
+    Order planned (src, dst) pairs by pixel count, largest first.
+
+    Started last, the largest files would leave one worker busy long after
+    the rest have finished; started first, they overlap with everything
+    else. Files without an ImageInfo keep their order at the end.
+    """
+    return sorted(planned, key=lambda pair: -infos[pair[0]].pixels if pair[0] in infos else 1)
+
+
+def default_budget():
+    """Return DEFAULT_BUDGET_SHARE of physical memory, or 0 (no budget) where it cannot be read"""
+    try:
+        return int(os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+                   * DEFAULT_BUDGET_SHARE)
+    except (AttributeError, ValueError, OSError):
+        return 0
+
+
+class MemoryScheduler:
+    """
+    Hands out jobs in order, holding back any that would take the memory in
+    use by running jobs over a budget.
+
+    When the next job does not fit, a later, smaller one that does is started
+    in its place, so cores stay busy while a huge file waits for memory. A
+    job that does not fit even on its own is started once nothing else is
+    running.
+
+    Args:
+        jobs (list): Jobs in the order they should start
+        cost (callable): Estimated peak bytes of a job
+        budget (int): Bytes all running jobs may use together; 0 is no limit
+    """
+
+    def __init__(self, jobs, cost, budget=0):
+        self.waiting = list(jobs)
+        self.cost = cost
+        self.budget = budget
+        self.in_use = 0
+        self.running = 0
+
+    def __bool__(self):
+        return bool(self.waiting)
+
+    def next(self):
+        """Return the next job that may start now and mark it running, or None"""
+        for index, job in enumerate(self.waiting):
+            cost = self.cost(job)
+            if not self.budget or not self.running or self.in_use + cost <= self.budget:
+                del self.waiting[index]
+                self.in_use += cost
+                self.running += 1
+                return job
+        return None
+
+    def finished(self, job):
+        """Release the memory held by a job handed out by next()"""
+        self.in_use -= self.cost(job)
+        self.running -= 1
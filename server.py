@@ -0,0 +1,426 @@
+"""
+HTTP conversion service for HEIC to JPG/PNG Converter
+Accepts HEIC bytes over HTTP and returns the converted image, using a warm pool of worker processes
+
+Usage:
+    python -m server [--host 127.0.0.1] [--port 8765] [--workers N] [--queue-size N]
+                     [--dedup-store-mb MB]
+
+    curl --data-binary @photo.heic -o photo.jpg \
+        "http://127.0.0.1:8765/convert?format=jpg&quality=90&max_edge=2048&preset=fast&strip_metadata=1"
+"""
+
+import argparse
+import json
+import os
+import queue
+import sys
+import threading
+import concurrent.futures
+from concurrent.futures import Future, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import converter
+import dedup
+from cache import options_key
+
+CONTENT_TYPES = {
+    'JPG': 'image/jpeg',
+    'PNG': 'image/png',
+    'WEBP': 'image/webp',
+    'AVIF': 'image/avif',
+    'JXL': 'image/jxl',
+}
+
+MAX_UPLOAD_BYTES = 200 * 1024 * 1024
+
+# How long a request waits for its conversion before giving up
+REQUEST_TIMEOUT = 120.0
+
+# Seconds clients are asked to wait after a 503
+RETRY_AFTER = 1
+
+
+def warm_worker():
+    """Pool initializer: load Pillow, libheif and the encoders before the first request"""
+    from PIL import Image
+    converter.register_opener()
+    Image.init()
+
+
+def convert_batch(items):
+    """
+    Convert several in-memory images in one worker call.
+
+    Args:
+        items (list): (HEIC bytes, ConversionOptions) pairs
+
+    Returns:
+        list: (output bytes, None) or (None, error message) for each item, in order
+    """
+    results = []
+    for data, options in items:
+        try:
+            results.append((converter.convert_bytes(data, options), None))
+        except converter.ConversionError as e:
+            results.append((None, str(e)))
+    return results
+
+
+class ConversionService:
+    """
+    Bounded request queue in front of a persistent process pool.
+
+    A dispatcher thread takes requests off the queue and hands them to the
+    pool, sending whatever else is already waiting along in the same batch
+    (up to batch_size) so small images share one round trip to a worker.
+    At most two batches per worker are in flight; beyond that requests wait
+    in the queue, and once the queue is full submit() raises queue.Full so
+    the caller can shed load instead of piling up work.
+
+    Uploads are keyed by a hash of their content and settings. A repeat of a
+    recent upload is answered from a store of converted outputs, and one
+    that arrives while the same conversion is still running waits for it,
+    so identical images are only converted once.
+
+    Args:
+        workers (int): Worker processes; defaults to the CPU count
+        queue_size (int): Requests that may wait for a worker before new ones
+            are refused; defaults to four per worker
+        batch_size (int): Most requests sent to a worker in one call
+        store_bytes (int): Converted output kept for repeated uploads; 0
+            turns deduplication off
+    """
+
+    def __init__(self, workers=None, queue_size=None, batch_size=4,
+                 store_bytes=dedup.STORE_BYTES):
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=warm_worker)
+        self.queue = queue.Queue(maxsize=queue_size or 4 * self.workers)
+        self._in_flight = threading.BoundedSemaphore(2 * self.workers)
+        self._lock = threading.Lock()
+        self.store = dedup.OutputStore(store_bytes) if store_bytes else None
+        # Content key -> Future of a conversion that is queued or running
+        self._converting = {}
+        self.requests = 0
+        self.batches = 0
+        self.rejected = 0
+        self.dedup_hits = 0
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def warm_up(self):
+        """Start every worker process now rather than on the first requests"""
+        for future in [self.pool.submit(convert_batch, []) for _ in range(self.workers)]:
+            future.result()
+
+    def submit(self, data, options):
+        """
+        Queue one conversion.
+
+        Args:
+            data (bytes): Encoded HEIC image
+            options (ConversionOptions): Conversion settings, including any resize
+
+        Returns:
+            concurrent.futures.Future: Resolves to the output bytes, or raises
+                ConversionError if the image cannot be converted
+
+        Raises:
+            queue.Full: If the request queue is full
+        """
+        key = None
+        if self.store is not None:
+            key = (dedup.content_key(data), options_key(options))
+            with self._lock:
+                output = self.store.get(key)
+                if output is None:
+                    future = self._converting.get(key)
+                else:
+                    future = Future()
+                    future.set_result(output)
+                if future is not None:
+                    self.requests += 1
+                    self.dedup_hits += 1
+                    return future
+
+        future = Future()
+        with self._lock:
+            try:
+                self.queue.put_nowait((data, options, future, key))
+            except queue.Full:
+                self.rejected += 1
+                raise
+            self.requests += 1
+            if key is not None:
+                self._converting[key] = future
+        return future
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queued': self.queue.qsize(),
+                'queue_size': self.queue.maxsize,
+                'requests': self.requests,
+                'batches': self.batches,
+                'rejected': self.rejected,
+                'dedup_hits': self.dedup_hits,
+                'dedup_hit_rate': round(self.dedup_hits / max(self.requests, 1), 3),
+                'stored_outputs': len(self.store) if self.store is not None else 0,
+            }
+
+    def close(self):
+        self.queue.put(None)
+        self._dispatcher.join()
+        self.pool.shutdown(wait=True)
+
+    def _dispatch(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            self._in_flight.acquire()
+            batch = [job]
+            while len(batch) < self.batch_size:
+                try:
+                    job = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    # Keep the shutdown marker for the outer loop
+                    self.queue.put(None)
+                    break
+                batch.append(job)
+            with self._lock:
+                self.batches += 1
+            try:
+                pool_future = self.pool.submit(convert_batch,
+                                               [job[:2] for job in batch])
+            except RuntimeError as e:
+                # The pool has been shut down
+                self._in_flight.release()
+                self._fail(batch, e)
+                continue
+            pool_future.add_done_callback(lambda f, b=batch: self._finish(f, b))
+
+    def _fail(self, batch, error):
+        with self._lock:
+            for *_, key in batch:
+                self._converting.pop(key, None)
+        for *_, future, _ in batch:
+            future.set_exception(error)
+
+    def _finish(self, pool_future, batch):
+        self._in_flight.release()
+        try:
+            results = pool_future.result()
+        except Exception as e:
+            # A worker died; every request in its batch fails
+            self._fail(batch, e)
+            return
+        for (*_, future, key), (data, error) in zip(batch, results):
+            if error is None and key is not None:
+                # Stored before the key is released, so no repeat slips in between
+                self.store.put(key, data)
+            with self._lock:
+                self._converting.pop(key, None)
+            if error is None:
+                future.set_result(data)
+            else:
+                future.set_exception(converter.ConversionError(error))
+
+
+def parse_options(query):
+    """
+    Build ConversionOptions from URL query parameters.
+
+    max_size is accepted as the older name of max_edge.
+
+    Returns:
+        ConversionOptions: The requested settings
+
+    Raises:
+        ValueError: If a parameter is not valid
+    """
+    params = {key: values[-1] for key, values in parse_qs(query).items()}
+    format = params.get('format', 'JPG').upper()
+    if format == 'JPEG':
+        format = 'JPG'
+    if format not in converter.FORMATS:
+        raise ValueError(f"format must be one of {', '.join(sorted(converter.FORMATS))}")
+    preset = params.get('preset', 'balanced').lower()
+    try:
+        quality = int(params.get('quality', 95))
+        max_edge = int(params.get('max_edge', params.get('max_size', 0)))
+    except ValueError:
+        raise ValueError("quality and max_edge must be integers")
+    try:
+        max_megapixels = float(params.get('max_megapixels', 0))
+        min_psnr = float(params.get('min_psnr', 0))
+        target_bytes = int(params.get('target_bytes', 0))
+    except ValueError:
+        raise ValueError("max_megapixels and min_psnr must be numbers, target_bytes an integer")
+    if not 1 <= quality <= 100:
+        raise ValueError("quality must be between 1 and 100")
+    strip = params.get('strip_metadata', '0').lower()
+    if strip not in ('0', '1', 'false', 'true'):
+        raise ValueError("strip_metadata must be 0 or 1")
+    options = converter.ConversionOptions(format=format, quality=quality, preset=preset,
+                                          strip_metadata=strip in ('1', 'true'),
+                                          max_edge=max_edge, max_megapixels=max_megapixels,
+                                          fit=params.get('fit', 'fit').lower(),
+                                          target_bytes=target_bytes, min_psnr=min_psnr)
+    try:
+        converter.check_options(options)
+    except converter.ConversionError as e:
+        raise ValueError(str(e))
+    return options
+
+
+class ConversionHandler(BaseHTTPRequestHandler):
+    """POST /convert with HEIC bytes as the body; GET /health for queue statistics"""
+
+    server_version = 'heic2img'
+
+    def do_GET(self):
+        if urlsplit(self.path).path != '/health':
+            self.send_error(404)
+            return
+        self.send_json(200, self.server.service.stats())
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != '/convert':
+            self.send_error(404)
+            return
+        try:
+            options = parse_options(url.query)
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+
+        header = self.headers.get('Content-Length')
+        if not header:
+            self.send_json(411, {'error': "request body with Content-Length required"})
+            return
+        try:
+            length = int(header)
+        except ValueError:
+            length = -1
+        if length < 1:
+            self.send_json(400, {'error': f"invalid Content-Length: {header!r}"})
+            self.close_connection = True
+            return
+        if length > self.server.max_upload:
+            self.send_json(413, {'error': f"body larger than {self.server.max_upload} bytes"})
+            self.close_connection = True
+            return
+        data = self.rfile.read(length)
+
+        try:
+            future = self.server.service.submit(data, options)
+        except queue.Full:
+            self.send_json(503, {'error': "server busy, retry later"},
+                           {'Retry-After': str(RETRY_AFTER)})
+            return
+        try:
+            output = future.result(timeout=REQUEST_TIMEOUT)
+        except converter.ConversionError as e:
+            self.send_json(422, {'error': str(e)})
+            return
+        except concurrent.futures.TimeoutError:
+            self.send_json(504, {'error': f"conversion took longer than {REQUEST_TIMEOUT:g}s"})
+            return
+        except Exception as e:
+            self.send_json(500, {'error': str(e) or e.__class__.__name__})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPES[options.format])
+        self.send_header('Content-Length', str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+    def send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class ConversionServer(ThreadingHTTPServer):
+    """HTTP server that owns a ConversionService; closing the server closes the pool"""
+
+    daemon_threads = True
+
+    def __init__(self, address, service, max_upload=MAX_UPLOAD_BYTES, quiet=False):
+        super().__init__(address, ConversionHandler)
+        self.service = service
+        self.max_upload = max_upload
+        self.quiet = quiet
+
+    def server_close(self):
+        super().server_close()
+        self.service.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='server', description="Serve HEIC to JPG/PNG/WebP/AVIF/JPEG XL conversion over HTTP.")
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=8765, help="Port to listen on (default: 8765)")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Worker processes (default: CPU count)")
+    parser.add_argument('--queue-size', type=int, default=None,
+                        help="Requests that may wait before new ones get 503 "
+                             "(default: four per worker)")
+    parser.add_argument('--batch-size', type=int, default=4,
+                        help="Most queued requests sent to a worker at once (default: 4)")
+    parser.add_argument('--dedup-store-mb', type=int, default=dedup.STORE_BYTES // 2**20,
+                        help="Converted output kept to answer repeated uploads of the same "
+                             "image, in MB; 0 turns deduplication off (default: 64)")
+    parser.add_argument('--max-upload-mb', type=int, default=MAX_UPLOAD_BYTES // 2**20,
+                        help="Largest accepted request body in MB (default: 200)")
+    parser.add_argument('--quiet', action='store_true', help="Do not log each request")
+    args = parser.parse_args(argv)
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    if args.dedup_store_mb < 0:
+        parser.error("--dedup-store-mb must not be negative")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    service = ConversionService(args.workers, args.queue_size, args.batch_size,
+                                args.dedup_store_mb * 2**20)
+    service.warm_up()
+    server = ConversionServer((args.host, args.port), service,
+                              args.max_upload_mb * 2**20, args.quiet)
+    print(f"Serving on http://{args.host}:{server.server_port} "
+          f"with {service.workers} workers", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""
+Input detection for HEIC to JPG/PNG Converter
+Recognizes HEIF-family files by the brands in their ftyp box, reading only the first bytes
+"""
+
+import os
+import struct
+
+# Bytes read from the start of a file; the ftyp box comes first and lists only a few brands
+SNIFF_BYTES = 256
+
+# Extensions HEIF-family files are saved with; files are also found by content
+HEIF_EXTENSIONS = ('.heic', '.heif', '.hif', '.avif')
+
+# ftyp brands of HEIF-family files and the codec of their images. The
+# structural brands say nothing about the codec; the coded brands next to
+# them in the compatible list do
+HEIF_BRANDS = {
+    'heic': 'HEVC', 'heix': 'HEVC', 'heim': 'HEVC', 'heis': 'HEVC',
+    'hevc': 'HEVC', 'hevx': 'HEVC', 'hevm': 'HEVC', 'hevs': 'HEVC',
+    'avif': 'AV1', 'avis': 'AV1',
+    'vvic': 'VVC', 'vvis': 'VVC',
+    'j2ki': 'JPEG 2000', 'j2is': 'JPEG 2000',
+    'mif1': None, 'mif2': None, 'msf1': None,
+}
+
+# libheif decoder plugins and the codec each one decodes
+DECODER_CODECS = {
+    'libde265': 'HEVC', 'ffmpeg': 'HEVC', 'dav1d': 'AV1', 'aom': 'AV1',
+    'vvdec': 'VVC', 'openjpeg': 'JPEG 2000',
+}
+
+_decodable = None
+
+
+def read_brands(header):
+    """
+    Return the brands of the ftyp box at the start of header.
+
+    Args:
+        header (bytes): The first bytes of a file; SNIFF_BYTES is enough
+
+    Returns:
+        list: The major brand followed by the compatible brands, or an empty
+            list if header does not start with an ftyp box
+    """
+    if len(header) < 16 or header[4:8] != b'ftyp':
+        return []
+    size, = struct.unpack('>I', header[:4])
+    # 0 runs to the end of the file and 1 is a 64-bit size; both only as far as we read
+    end = len(header) if size < 16 else min(size, len(header))
+    brands = [header[8:12]] + [header[i:i + 4] for i in range(16, end - 3, 4)]
+    return [brand.decode('latin-1') for brand in brands]
+
+
+def heif_codec(header):
+    """
+    Tell from the ftyp box whether header starts a HEIF-family file.
+
+    Returns:
+        str: The codec of its images ('HEVC', 'AV1', ...), 'HEIF' when the
+            brands only name the container, or None if it is not a HEIF file
+    """
+    brands = [brand for brand in read_brands(header) if brand in HEIF_BRANDS]
+    if not brands:
+        return None
+    return next((HEIF_BRANDS[b] for b in brands if HEIF_BRANDS[b]), 'HEIF')
+
+
+def decodable_codecs():
+    """
+    Return the codecs this installation can decode HEIF images of.
+
+    HEVC and the rest come from the decoders libheif was built with. AVIF is
+    also decodable when Pillow has its own AVIF plugin, which Image.open()
+    uses for it. A file with only structural brands is left for the decoder
+    to judge.
+    """
+    global _decodable
+    if _decodable is None:
+        import pillow_heif
+        from PIL import features
+
+        codecs = {'HEIF'}
+        codecs.update(DECODER_CODECS[name] for name in pillow_heif.libheif_info()['decoders']
+                      if name in DECODER_CODECS)
+        if features.check('avif'):
+            codecs.add('AV1')
+        _decodable = frozenset(codecs)
+    return _decodable
+
+
+def sniff_file(path):
+    """Return heif_codec() of the first bytes of path, or None if it cannot be read"""
+    try:
+        with open(path, 'rb') as f:
+            return heif_codec(f.read(SNIFF_BYTES))
+    except OSError:
+        return None
+
+
+def is_heif_name(path):
+    """Return True if path has a HEIF-family file extension"""
+    return path.lower().endswith(HEIF_EXTENSIONS)
+
+
+def is_heif_file(path):
+    """Return True if path holds a HEIF-family image this installation can decode, by content"""
+    return sniff_file(path) in decodable_codecs()
+
+
+def is_heif_input(path):
+    """
+    Return True if path should be converted: its name says HEIF, or its content does.
+
+    Files named as HEIF are kept even when their content is not, so the
+    pre-flight scan reports them instead of leaving them out without a word.
+    Only files with other names are opened, and only their first bytes read.
+    """
+    return is_heif_name(path) or (os.path.isfile(path) and is_heif_file(path))
@@ -2,9 +2,15 @@ import unittest
 import os
 import tempfile
 import shutil
+import queue
+import subprocess
+import sys
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from unittest.mock import Mock, patch, MagicMock
 from PIL import Image
 import pillow_heif
+import app
 from app import HEICConverter
 
 
@@ -279,6 +285,260 @@ class TestErrorHandling(unittest.TestCase):
         self.assertFalse(os.path.exists(nonexistent))
 
 
+class TestBatchQueue(unittest.TestCase):
+    """Test the multi-file queue and background conversion"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        pillow_heif.register_heif_opener()
+
+        # Build the app without a real Tk window
+        self.app = HEICConverter.__new__(HEICConverter)
+        self.app.root = Mock()
+        self.app.file_path_var = Mock()
+        self.app.convert_btn = Mock()
+        self.app.progress = Mock()
+        self.app.format_var = Mock()
+        self.app.format_var.get.return_value = "JPG"
+        self.app.preset_var = Mock()
+        self.app.preset_var.get.return_value = "balanced"
+        self.app.pending_files = []
+        self.app.file_infos = {}
+        self.app.executor = None
+        self.app.results = queue.Queue()
+        self.app.batch_results = []
+        self.app.batch_total = 0
+        self.app.batch_metrics = None
+        self.app.batch_scheduler = None
+        self.app.batch_options = None
+        self.app.engine = None
+        self.app.start_engine_load()
+        self.app.engine.result()
+
+    def tearDown(self):
+        if self.app.executor:
+            self.app.executor.shutdown(wait=True)
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def make_files(self, count, sizes=None):
+        paths = []
+        for i in range(count):
+            path = os.path.join(self.test_dir, f"img{i}.heic")
+            size = sizes[i] if sizes else (32, 32)
+            pillow_heif.from_pillow(Image.new('RGB', size, 'red')).save(path)
+            paths.append(path)
+        return paths
+
+    def run_until_done(self):
+        """Drive the root.after polling loop until the batch finishes"""
+        while self.app.root.after.called:
+            self.app.root.after.reset_mock()
+            time.sleep(0.01)
+            self.app.poll_progress()
+
+    @patch('app.messagebox')
+    def test_load_files_queues_valid_files(self, mock_messagebox):
+        """Test that many files are queued and invalid ones are skipped"""
+        paths = self.make_files(3)
+        self.app.load_files(paths + [os.path.join(self.test_dir, "photo.jpg")])
+
+        self.assertEqual(self.app.pending_files, paths)
+        mock_messagebox.showerror.assert_called_once()
+        self.app.file_path_var.set.assert_called_with("Selected: 3 files")
+
+    @patch('app.messagebox')
+    def test_load_files_ignores_duplicates(self, mock_messagebox):
+        """Test that dropping the same file twice queues it once"""
+        paths = self.make_files(1)
+        self.app.load_files(paths)
+        self.app.load_file(paths[0])
+
+        self.assertEqual(self.app.pending_files, paths)
+
+    def test_drop_splits_multiple_paths(self):
+        """Test that dropped paths with spaces are split correctly"""
+        self.app.root.tk.splitlist.return_value = ("/a/b c.heic", "/d.heic")
+        self.app.load_files = Mock()
+        event = Mock(data="{/a/b c.heic} /d.heic")
+        self.app.drop_file(event)
+
+        self.app.root.tk.splitlist.assert_called_once_with(event.data)
+        self.app.load_files.assert_called_once_with(("/a/b c.heic", "/d.heic"))
+
+    @patch('app.messagebox')
+    def test_convert_files_in_background(self, mock_messagebox):
+        """Test that a batch converts off the main thread and reports progress"""
+        paths = self.make_files(4)
+        self.app.load_files(paths)
+        self.app.convert_files()
+
+        self.assertEqual(self.app.pending_files, [])
+        self.app.progress.config.assert_any_call(maximum=4, value=0)
+        self.run_until_done()
+
+        self.app.progress.config.assert_any_call(value=4)
+        for path in paths:
+            self.assertTrue(os.path.exists(path[:-5] + ".jpg"))
+        mock_messagebox.showinfo.assert_called_once()
+        self.assertEqual(self.app.batch_total, 0)
+
+        # The success message includes the per-stage summary
+        message = mock_messagebox.showinfo.call_args[0][1]
+        self.assertIn("4 files (0 failed)", message)
+        self.assertIn("decode", message)
+
+    @patch('app.messagebox')
+    def test_failed_files_reported(self, mock_messagebox):
+        """Test that one bad file does not stop the rest of the batch"""
+        paths = self.make_files(2)
+        broken = os.path.join(self.test_dir, "broken.heic")
+        with open(broken, 'w') as f:
+            f.write("not an image")
+        self.app.load_files(paths + [broken])
+        self.app.convert_files()
+        self.run_until_done()
+
+        mock_messagebox.showerror.assert_called_once()
+        self.assertIn("broken.heic", mock_messagebox.showerror.call_args[0][1])
+        self.assertTrue(os.path.exists(paths[1][:-5] + ".jpg"))
+
+    @patch('app.messagebox')
+    def test_unreadable_files_rejected_on_load(self, mock_messagebox):
+        """Test that files with a .heic name but no HEIC content are refused when added"""
+        paths = self.make_files(1)
+        fake = os.path.join(self.test_dir, "fake.heic")
+        Image.new('RGB', (8, 8)).save(fake, 'PNG')
+        self.app.load_files(paths + [fake])
+
+        self.assertEqual(self.app.pending_files, paths)
+        self.assertEqual(list(self.app.file_infos), paths)
+        title, message = mock_messagebox.showerror.call_args[0]
+        self.assertEqual(title, "Invalid File")
+        self.assertIn("fake.heic", message)
+
+    @patch('app.messagebox')
+    def test_files_queued_before_engine_checked_at_convert(self, mock_messagebox):
+        """Test that files added while the engine loads are inspected when converting"""
+        paths = self.make_files(1)
+        fake = os.path.join(self.test_dir, "fake.heic")
+        with open(fake, 'w') as f:
+            f.write("not an image")
+        engine, self.app.engine = self.app.engine, Future()
+        self.app.load_files(paths + [fake])
+        mock_messagebox.showerror.assert_not_called()
+
+        self.app.engine = engine
+        self.app.convert_files()
+        self.run_until_done()
+
+        self.assertTrue(os.path.exists(paths[0][:-5] + ".jpg"))
+        message = mock_messagebox.showerror.call_args[0][1]
+        self.assertIn("Converted 1 of 2", message)
+        self.assertIn("fake.heic", message)
+
+    @patch('app.messagebox')
+    def test_largest_files_start_first(self, mock_messagebox):
+        """Test that a batch is handed to the workers largest first"""
+        paths = self.make_files(3, sizes=[(16, 16), (64, 64), (32, 32)])
+        self.app.load_files(paths)
+        # One worker, so the calls happen in the order the files were handed out
+        self.app.executor = ThreadPoolExecutor(max_workers=1)
+        with patch('converter.convert') as convert:
+            self.app.convert_files()
+            self.run_until_done()
+
+        self.assertEqual([c[0][0] for c in convert.call_args_list],
+                         [paths[1], paths[2], paths[0]])
+
+    @patch('app.messagebox')
+    def test_unavailable_format_keeps_queue(self, mock_messagebox):
+        """Test that choosing an encoder that is not installed reports it before converting"""
+        paths = self.make_files(1)
+        self.app.load_files(paths)
+        self.app.format_var.get.return_value = "JXL"
+        with patch('converter.available_formats', return_value=['JPG', 'PNG']), \
+                patch('converter._LOADED_FORMATS', []):
+            self.app.convert_files()
+
+        mock_messagebox.showerror.assert_called_once()
+        self.assertEqual(self.app.pending_files, paths)
+        self.assertEqual(self.app.batch_total, 0)
+
+    @patch('app.messagebox')
+    def test_watch_folder_converts_new_files(self, mock_messagebox):
+        """Test that files arriving in a watched folder are converted next to themselves"""
+        self.app.watch_btn = Mock()
+        self.app.watch_status_var = Mock()
+        self.app.watcher = None
+        self.app.watch_found = queue.Queue()
+        self.app.watch_done = queue.Queue()
+        self.app.watch_outputs = set()
+        self.app.start_watch(self.test_dir)
+        self.addCleanup(self.app.stop_watch)
+
+        path = self.make_files(1)[0]
+        deadline = time.time() + 30
+        while self.app.watch_converted < 1 and time.time() < deadline:
+            time.sleep(0.05)
+            self.app.poll_watch()
+
+        self.assertTrue(os.path.exists(path[:-5] + ".jpg"))
+        self.app.watch_status_var.set.assert_called_with(
+            f"Watching {self.test_dir}: 1 converted")
+        mock_messagebox.showerror.assert_not_called()
+
+        self.app.stop_watch()
+        self.app.watch_btn.config.assert_called_with(text="Watch Folder...")
+        self.assertIsNone(self.app.watcher)
+
+    @patch('app.messagebox')
+    def test_watch_folder_skips_own_outputs(self, mock_messagebox):
+        """Test that AVIF outputs written into the watched folder are not converted again"""
+        self.app.watch_btn = Mock()
+        self.app.watch_status_var = Mock()
+        self.app.watcher = None
+        self.app.watch_found = queue.Queue()
+        self.app.watch_done = queue.Queue()
+        self.app.watch_outputs = set()
+        self.app.format_var.get.return_value = "AVIF"
+        self.app.start_watch(self.test_dir)
+        self.addCleanup(self.app.stop_watch)
+
+        self.make_files(1)
+        deadline = time.time() + 30
+        while self.app.watch_converted < 1 and time.time() < deadline:
+            time.sleep(0.05)
+            self.app.poll_watch()
+        # Long enough for the output to settle and be reported if it were not skipped
+        settle_until = time.time() + 1
+        while time.time() < settle_until:
+            time.sleep(0.05)
+            self.app.poll_watch()
+
+        self.assertEqual(sorted(os.listdir(self.test_dir)), ["img0.avif", "img0.heic"])
+        self.assertEqual(self.app.watch_converted, 1)
+
+    def test_image_libraries_not_imported_at_startup(self):
+        """Test that importing the app leaves Pillow and libheif for the background loader"""
+        code = "import sys, app; print('PIL' in sys.modules, 'converter' in sys.modules)"
+        output = subprocess.check_output([sys.executable, "-c", code],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.decode().split(), ["False", "False"])
+
+    @patch('app.messagebox')
+    def test_convert_waits_for_engine(self, mock_messagebox):
+        """Test that Convert retries instead of blocking while the engine is still loading"""
+        paths = self.make_files(1)
+        self.app.load_files(paths)
+        self.app.engine = Future()
+        self.app.convert_files()
+
+        self.assertEqual(self.app.pending_files, paths)
+        self.assertEqual(self.app.batch_total, 0)
+        self.app.root.after.assert_called_once_with(app.POLL_INTERVAL_MS, self.app.convert_files)
+
+
 def run_tests():
     """Run all tests"""
     # Create test suite
@@ -289,6 +549,7 @@ def run_tests():
     suite.addTests(loader.loadTestsFromTestCase(TestHEICConverter))
     suite.addTests(loader.loadTestsFromTestCase(TestImageQuality))
     suite.addTests(loader.loadTestsFromTestCase(TestErrorHandling))
+    suite.addTests(loader.loadTestsFromTestCase(TestBatchQueue))
     
     # Run tests
     runner = unittest.TextTestRunner(verbosity=2)
@@ -0,0 +1,132 @@
+import unittest
+import os
+import json
+import tempfile
+import shutil
+from contextlib import redirect_stdout, redirect_stderr
+from io import StringIO
+from unittest.mock import patch
+
+import bench
+
+
+class TestBenchmark(unittest.TestCase):
+    """Smoke test the benchmark harness on a tiny fixture"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.fixtures = os.path.join(self.test_dir, "fixtures")
+        self.output = os.path.join(self.test_dir, "results.json")
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def run_bench(self, *args):
+        with redirect_stdout(StringIO()), redirect_stderr(StringIO()):
+            return bench.main(["--sizes", "0.05", "--repeat", "1", "--fixtures", self.fixtures,
+                               "--output", self.output] + list(args))
+
+    def test_resolution_for(self):
+        """Test the standard and custom fixture resolutions"""
+        self.assertEqual(bench.resolution_for(12), (4032, 3024))
+        width, height = bench.resolution_for(0.05)
+        self.assertAlmostEqual(width * height / 1e6, 0.05, places=2)
+
+    def test_writes_json_results(self):
+        """Test that every stage is timed and reported with throughput"""
+        self.assertEqual(self.run_bench(), 0)
+
+        with open(self.output) as f:
+            report = json.load(f)
+        self.assertIn('commit', report)
+        fixtures = {r['fixture']: r for r in report['results']}
+        self.assertEqual(set(fixtures), {"0.05mp_rgb.heic", "0.05mp_rgba.heic"})
+
+        rgba_stages = [s['stage'] for s in fixtures["0.05mp_rgba.heic"]['stages']]
+        self.assertEqual(rgba_stages, ['decode', 'flatten', 'encode_jpeg_q95', 'encode_png'])
+        self.assertNotIn('flatten', [s['stage'] for s in fixtures["0.05mp_rgb.heic"]['stages']])
+        for stage in fixtures["0.05mp_rgba.heic"]['stages']:
+            self.assertGreater(stage['mp_per_s'], 0)
+
+    def test_flatten_suite(self):
+        """Test that the flatten suite reports legacy and current timings with allocations"""
+        self.assertEqual(self.run_bench("--suite", "flatten", "--modes", "RGBA"), 0)
+
+        with open(self.output) as f:
+            report = json.load(f)
+        stages = {s['stage']: s for s in report['results'][0]['stages']}
+        self.assertEqual(set(stages), {'flatten_legacy', 'flatten'})
+        self.assertEqual(stages['flatten']['allocations'], 1)
+        self.assertGreater(stages['flatten_legacy']['allocations'], 1)
+
+    def test_bounded_suite(self):
+        """Test that the bounded suite reports its memory estimate alongside peak RSS"""
+        self.assertEqual(self.run_bench("--suite", "bounded", "--modes", "RGB"), 0)
+
+        with open(self.output) as f:
+            result = json.load(f)['results'][0]
+        stage = result['stages'][0]
+        self.assertEqual(stage['stage'], 'convert_bounded')
+        self.assertGreater(stage['estimated_peak_mb'], 0)
+
+    def test_presets_suite(self):
+        """Test that every available format is encoded with every preset and sized"""
+        self.assertEqual(self.run_bench("--suite", "presets", "--modes", "RGB"), 0)
+
+        with open(self.output) as f:
+            stages = {s['stage']: s for s in json.load(f)['results'][0]['stages']}
+        for preset in ('fast', 'balanced', 'smallest'):
+            self.assertIn(f"jpg_{preset}", stages)
+            self.assertIn(f"png_{preset}", stages)
+        self.assertLess(stages['png_smallest']['bytes'], stages['png_fast']['bytes'])
+
+    def test_resize_suite(self):
+        """Test that the fast resize path is compared with plain LANCZOS"""
+        self.assertEqual(self.run_bench("--suite", "resize", "--modes", "RGB"), 0)
+
+        with open(self.output) as f:
+            stages = {s['stage']: s for s in json.load(f)['results'][0]['stages']}
+        self.assertIn("resize_lanczos_128", stages)
+        self.assertGreater(stages['resize_fast_128']['psnr_db'] or 100, 30)
+
+    def test_hdr_suite(self):
+        """Test that both 10-bit fixtures compare libheif's 8-bit output with the deep path"""
+        self.assertEqual(self.run_bench("--suite", "hdr"), 0)
+
+        with open(self.output) as f:
+            results = json.load(f)['results']
+        self.assertEqual(sorted(r['fixture'] for r in results),
+                         ["0.05mp_pq10.heic", "0.05mp_rgb10.heic"])
+        for result in results:
+            stages = {s['stage']: s for s in result['stages']}
+            for format in ('jpg', 'png'):
+                self.assertIn(f"convert_{format}_libheif", stages)
+            self.assertGreater(stages['convert_png_deep']['bytes'],
+                               stages['convert_png_libheif']['bytes'])
+            if 'rgb10' in result['fixture']:
+                self.assertGreater(stages['decode_8bit']['psnr_db'] or 100, 40)
+
+    def test_fixtures_built_outside_the_parent(self):
+        """Test that fixture generation does not raise the peak RSS children inherit"""
+        with patch('bench.make_fixture', side_effect=AssertionError("built in the parent")):
+            self.assertEqual(self.run_bench("--modes", "RGB"), 0)
+        self.assertTrue(os.path.exists(bench.fixture_path(0.05, 'RGB', self.fixtures)))
+
+    def test_compare_flags_regressions(self):
+        """Test that a slower stage than the baseline is reported"""
+        self.run_bench()
+        with open(self.output) as f:
+            report = json.load(f)
+        baseline = os.path.join(self.test_dir, "baseline.json")
+        for result in report['results']:
+            for stage in result['stages']:
+                stage['seconds'] /= 10
+        with open(baseline, 'w') as f:
+            json.dump(report, f)
+
+        self.assertEqual(self.run_bench("--compare", baseline), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
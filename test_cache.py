@@ -0,0 +1,170 @@
+import unittest
+import os
+import tempfile
+import shutil
+import sqlite3
+from contextlib import redirect_stdout, redirect_stderr
+from io import StringIO
+from unittest.mock import patch
+
+import converter
+import heic2img
+from cache import ConversionCache, file_digest
+from test_converter import create_heic
+
+
+class TestConversionCache(unittest.TestCase):
+    """Test the SQLite conversion manifest"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.src = create_heic(os.path.join(self.test_dir, "photo.heic"))
+        self.dst = os.path.join(self.test_dir, "out", "photo.jpg")
+        self.options = converter.ConversionOptions()
+        os.makedirs(os.path.dirname(self.dst))
+        converter.convert(self.src, self.dst, self.options)
+        self.cache = ConversionCache(os.path.join(self.test_dir, "out"))
+
+    def tearDown(self):
+        self.cache.close()
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def test_unknown_file_is_not_fresh(self):
+        """Test that files never recorded are converted"""
+        self.assertFalse(self.cache.is_fresh(self.src, self.dst, self.options))
+
+    def test_recorded_file_is_fresh(self):
+        """Test that an unchanged input with its output in place is skipped"""
+        self.cache.record(self.src, self.dst, self.options)
+        self.assertTrue(self.cache.is_fresh(self.src, self.dst, self.options))
+
+    def test_options_change_invalidates(self):
+        """Test that different conversion settings are not treated as cached"""
+        self.cache.record(self.src, self.dst, self.options)
+        other = converter.ConversionOptions(quality=80)
+        self.assertFalse(self.cache.is_fresh(self.src, self.dst, other))
+
+    def test_missing_output_invalidates(self):
+        """Test that a deleted output is regenerated"""
+        self.cache.record(self.src, self.dst, self.options)
+        os.remove(self.dst)
+        self.assertFalse(self.cache.is_fresh(self.src, self.dst, self.options))
+
+    def test_edited_source_invalidates(self):
+        """Test that changed source content is reconverted"""
+        self.cache.record(self.src, self.dst, self.options)
+        create_heic(self.src, size=(80, 40), color='blue')
+        self.assertFalse(self.cache.is_fresh(self.src, self.dst, self.options))
+
+    def test_touched_source_uses_hash(self):
+        """Test that a new mtime with identical content is still fresh"""
+        self.cache.record(self.src, self.dst, self.options)
+        stat = os.stat(self.src)
+        os.utime(self.src, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        with patch('cache.file_digest', wraps=file_digest) as digest:
+            self.assertTrue(self.cache.is_fresh(self.src, self.dst, self.options))
+            digest.assert_called_once()
+        # The new mtime is recorded, so the next check needs no hash
+        with patch('cache.file_digest', wraps=file_digest) as digest:
+            self.assertTrue(self.cache.is_fresh(self.src, self.dst, self.options))
+            digest.assert_not_called()
+
+    def test_prune_removes_missing_sources(self):
+        """Test pruning entries whose sources were deleted"""
+        other = create_heic(os.path.join(self.test_dir, "other.heic"))
+        self.cache.record(self.src, self.dst, self.options)
+        self.cache.record(other, self.dst, self.options)
+        os.remove(other)
+
+        self.assertEqual(self.cache.prune(), 1)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_prune_evicts_least_recently_used(self):
+        """Test the max_entries limit evicts the oldest entries"""
+        self.cache.record(self.src, self.dst, self.options)
+        self.cache.record(self.src, self.dst, converter.ConversionOptions(quality=80))
+        self.cache.is_fresh(self.src, self.dst, self.options)
+
+        self.assertEqual(self.cache.prune(max_entries=1), 1)
+        self.assertTrue(self.cache.is_fresh(self.src, self.dst, self.options))
+
+    def test_records_are_committed_periodically(self):
+        """Test that records become durable during a batch, not only at close"""
+        cache = ConversionCache(os.path.join(self.test_dir, "out"), name="periodic.sqlite",
+                                commit_every=2, commit_interval=3600)
+        self.addCleanup(cache.close)
+        reader = sqlite3.connect(cache.path)
+        self.addCleanup(reader.close)
+
+        def committed():
+            return reader.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+        cache.record(self.src, self.dst, self.options)
+        self.assertEqual(committed(), 0)
+        cache.record(self.src, self.dst, converter.ConversionOptions(quality=80))
+        self.assertEqual(committed(), 2)
+
+
+class TestIncrementalBatch(unittest.TestCase):
+    """Test that batch runs skip unchanged inputs"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.in_dir = os.path.join(self.test_dir, "in")
+        self.out_dir = os.path.join(self.test_dir, "out")
+        os.makedirs(self.in_dir)
+        for name in ("a.heic", "b.heic"):
+            create_heic(os.path.join(self.in_dir, name))
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def run_cli(self, *args):
+        output = StringIO()
+        with redirect_stdout(output), redirect_stderr(StringIO()):
+            code = heic2img.main([self.in_dir, self.out_dir, "-j", "1"] + list(args))
+        return code, output.getvalue()
+
+    def test_second_run_skips_everything(self):
+        """Test that a rerun over an unchanged folder converts nothing"""
+        self.run_cli()
+        code, output = self.run_cli()
+
+        self.assertEqual(code, 0)
+        self.assertIn("Converted 0 of 0", output)
+        self.assertIn("Skipped 2 unchanged files", output)
+
+    def test_new_file_is_converted(self):
+        """Test that only new files are converted on a rerun"""
+        self.run_cli()
+        create_heic(os.path.join(self.in_dir, "c.heic"))
+        _, output = self.run_cli()
+
+        self.assertIn("Converted 1 of 1", output)
+        self.assertTrue(os.path.exists(os.path.join(self.out_dir, "c.jpg")))
+
+    def test_no_cache_converts_everything(self):
+        """Test that --no-cache ignores the manifest"""
+        self.run_cli()
+        _, output = self.run_cli("--no-cache")
+
+        self.assertIn("Converted 2 of 2", output)
+
+    def test_workers_hash_inputs(self):
+        """Test that recorded digests come from the workers, not a second read"""
+        for mode in ([], ["--pipeline"]):
+            with self.subTest(mode=mode):
+                shutil.rmtree(self.out_dir, ignore_errors=True)
+                with patch.object(ConversionCache, 'record', autospec=True,
+                                  side_effect=ConversionCache.record) as record:
+                    self.run_cli(*mode)
+                digests = {call.args[1]: call.kwargs['digest'] for call in record.call_args_list}
+                self.assertEqual(len(digests), 2)
+                for src, digest in digests.items():
+                    self.assertEqual(digest, file_digest(src))
+
+
+if __name__ == '__main__':
+    unittest.main()
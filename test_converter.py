@@ -0,0 +1,840 @@
+import unittest
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import shutil
+import numpy as np
+from PIL import Image, ImageChops, ImageFilter
+import pillow_heif
+from unittest.mock import patch
+
+import bench
+import converter
+from metrics import FileMetrics
+
+
+def create_heic(path, size=(64, 48), mode='RGB', color='red', thumbnails=()):
+    """Write a real HEIC file for tests"""
+    img = Image.new(mode, size, color=color)
+    pillow_heif.from_pillow(img).save(path, quality=90, thumbnails=list(thumbnails))
+    return path
+
+
+def create_deep_heic(path, size=(64, 48), value=700, alpha=None, nclx=None):
+    """Write a 10-bit HEIC file with every color sample at value, for tests"""
+    samples = np.full((size[1], size[0], 3 if alpha is None else 4), value, np.uint16)
+    if alpha is not None:
+        samples[..., 3] = alpha
+    mode = 'RGB;16' if alpha is None else 'RGBA;16'
+    heif_file = pillow_heif.from_bytes(mode=mode, size=size, data=(samples << 6).tobytes())
+    heif_file.save(path, quality=90, nclx_profile=nclx)
+    return path
+
+
+def png_header(path):
+    """Return the bit depth and color type from a PNG's IHDR chunk"""
+    with open(path, 'rb') as f:
+        header = f.read(26)
+    return header[24], header[25]
+
+
+class TestConvert(unittest.TestCase):
+    """Test the GUI-free conversion engine"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.src = create_heic(os.path.join(self.test_dir, "photo.heic"))
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def test_engine_does_not_import_tkinter(self):
+        """Test that the engine module has no GUI dependencies"""
+        code = "import sys, converter; print('tkinter' in sys.modules)"
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.strip(), b'False')
+
+    def test_convert_jpg_default_path(self):
+        """Test converting to JPG next to the source file"""
+        result = converter.convert(self.src)
+
+        self.assertEqual(result.dst, os.path.join(self.test_dir, "photo.jpg"))
+        with Image.open(result.dst) as img:
+            self.assertEqual(img.format, 'JPEG')
+            self.assertEqual(img.size, (64, 48))
+
+    def test_convert_png_explicit_path(self):
+        """Test converting to PNG at a chosen destination"""
+        dst = os.path.join(self.test_dir, "out.png")
+        options = converter.ConversionOptions(format='PNG')
+        result = converter.convert(self.src, dst, options)
+
+        self.assertEqual(result.dst, dst)
+        self.assertEqual(result.format, 'PNG')
+        with Image.open(dst) as img:
+            self.assertEqual(img.format, 'PNG')
+
+    def test_rgba_flattened_for_jpg(self):
+        """Test that transparent images get a white background for JPG"""
+        src = create_heic(os.path.join(self.test_dir, "alpha.heic"),
+                          mode='RGBA', color=(0, 0, 0, 0))
+        result = converter.convert(src)
+
+        self.assertEqual(result.mode, 'RGB')
+        with Image.open(result.dst) as img:
+            r, g, b = img.getpixel((10, 10))
+            self.assertGreater(min(r, g, b), 240)
+
+    def test_output_path(self):
+        """Test default output path generation"""
+        options = converter.ConversionOptions(format='PNG')
+        self.assertEqual(converter.output_path("/path/to/image.heic", options),
+                         "/path/to/image.png")
+        self.assertEqual(converter.output_path("/path/to/image.HEIC"),
+                         "/path/to/image.jpg")
+        # An input with the output's extension is never its own default output
+        self.assertEqual(converter.output_path("/path/to/IMG_1.JPG"),
+                         "/path/to/IMG_1_converted.jpg")
+        self.assertEqual(converter.output_path("/path/to/b.avif",
+                                               converter.ConversionOptions(format='AVIF')),
+                         "/path/to/b_converted.avif")
+
+    def test_mislabeled_and_avif_inputs(self):
+        """Test that a HEIC saved as .jpg and an AVIF file convert without replacing themselves"""
+        mislabeled = create_heic(os.path.join(self.test_dir, "IMG_0001.jpg"))
+        avif = os.path.join(self.test_dir, "photo.avif")
+        Image.new('RGB', (40, 30), 'blue').save(avif)
+
+        result = converter.convert(mislabeled)
+        self.assertEqual(os.path.basename(result.dst), "IMG_0001_converted.jpg")
+        self.assertEqual(converter.convert(avif).size, (40, 30))
+        with open(mislabeled, 'rb') as f:
+            self.assertEqual(f.read(12)[4:], b'ftypheic')
+        with self.assertRaisesRegex(converter.ConversionError, "would overwrite"):
+            converter.convert(mislabeled, mislabeled)
+
+    def test_unsupported_format(self):
+        """Test that unknown output formats are rejected"""
+        options = converter.ConversionOptions(format='GIF')
+        with self.assertRaises(converter.ConversionError):
+            converter.convert(self.src, options=options)
+
+    def test_corrupted_input(self):
+        """Test that undecodable input raises ConversionError"""
+        bad = os.path.join(self.test_dir, "bad.heic")
+        with open(bad, 'w') as f:
+            f.write("not an image")
+        with self.assertRaises(converter.ConversionError):
+            converter.convert(bad)
+
+
+class TestThumbnails(unittest.TestCase):
+    """Test preview generation"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        converter.register_opener()
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def test_fit_size(self):
+        """Test long-edge scaling without upscaling"""
+        self.assertEqual(converter.fit_size((4000, 3000), 1024), (1024, 768))
+        self.assertEqual(converter.fit_size((3000, 4000), 256), (192, 256))
+        self.assertEqual(converter.fit_size((100, 50), 256), (100, 50))
+
+    def test_uses_embedded_thumbnail(self):
+        """Test that a large enough embedded thumbnail replaces the full decode"""
+        src = create_heic(os.path.join(self.test_dir, "big.heic"), size=(2000, 1500),
+                          thumbnails=[512])
+        with Image.open(src) as image, patch.object(
+                pillow_heif.HeifImage, 'load', autospec=True) as full_decode:
+            previews = converter.make_thumbnails(image, [256, 512])
+
+        full_decode.assert_not_called()
+        self.assertEqual([(s, p.size) for s, p in previews],
+                         [(512, (512, 384)), (256, (256, 192))])
+
+    def test_falls_back_to_full_decode(self):
+        """Test previews when the embedded thumbnail is too small"""
+        src = create_heic(os.path.join(self.test_dir, "big.heic"), size=(2000, 1500),
+                          thumbnails=[128])
+        with Image.open(src) as image:
+            previews = converter.make_thumbnails(image, [300])
+
+        self.assertEqual(previews[0][1].size, (300, 225))
+
+    def test_convert_writes_every_size(self):
+        """Test that thumbnail mode writes one file per size"""
+        src = create_heic(os.path.join(self.test_dir, "photo.heic"), size=(800, 600),
+                          mode='RGBA')
+        options = converter.ConversionOptions(thumbnail_sizes=(128, 400))
+        result = converter.convert(src, options=options)
+
+        self.assertEqual(result.dst, os.path.join(self.test_dir, "photo_400.jpg"))
+        self.assertEqual(converter.output_paths(converter.output_path(src, options), options),
+                         [result.dst, os.path.join(self.test_dir, "photo_128.jpg")])
+        with Image.open(os.path.join(self.test_dir, "photo_128.jpg")) as img:
+            self.assertEqual(img.size, (128, 96))
+            self.assertEqual(img.mode, 'RGB')
+
+
+class TestFlattenAlpha(unittest.TestCase):
+    """Test compositing transparent images onto a matte color"""
+
+    def gradient_rgba(self, size=(96, 64)):
+        image = Image.merge('RGB', [Image.linear_gradient('L').resize(size),
+                                    Image.radial_gradient('L').resize(size),
+                                    Image.new('L', size, 40)])
+        image.putalpha(Image.linear_gradient('L').rotate(90).resize(size))
+        return image
+
+    def test_matches_split_based_flatten(self):
+        """Test that RGBA and palette images flatten exactly as the split() approach did"""
+        rgba = self.gradient_rgba()
+        palette = rgba.convert('RGB').quantize(16)
+        palette.info['transparency'] = 3
+        for image in (rgba, palette):
+            expected = bench.legacy_flatten(image, (10, 200, 30))
+            actual = converter.flatten_alpha(image, (10, 200, 30))
+            self.assertEqual(actual.mode, 'RGB')
+            self.assertEqual(actual.tobytes(), expected.tobytes())
+
+    def test_grayscale_alpha_composited(self):
+        """Test that LA images blend onto the background instead of ignoring alpha"""
+        image = Image.new('LA', (4, 4), (200, 0))
+        flattened = converter.flatten_alpha(image, (0, 0, 255))
+        self.assertEqual(flattened.mode, 'RGB')
+        self.assertEqual(flattened.getpixel((0, 0)), (0, 0, 255))
+
+    def test_opaque_images_untouched(self):
+        """Test that images without transparency are returned as they are"""
+        image = Image.new('RGB', (4, 4), 'red')
+        self.assertIs(converter.flatten_alpha(image), image)
+
+    def test_single_allocation(self):
+        """Test that only the output frame is allocated, unlike the split() approach"""
+        image = self.gradient_rgba()
+        self.assertEqual(bench.count_allocations(lambda: converter.flatten_alpha(image)), 1)
+        self.assertGreater(bench.count_allocations(lambda: bench.legacy_flatten(image)), 1)
+
+
+class TestBoundedMemory(unittest.TestCase):
+    """Test the memory-limited conversion mode"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        size = (300, 200)
+        image = Image.merge('RGB', [Image.linear_gradient('L').resize(size),
+                                    Image.radial_gradient('L').resize(size),
+                                    Image.new('L', size, 90)])
+        image.putalpha(Image.linear_gradient('L').rotate(90).resize(size))
+        self.src = os.path.join(self.test_dir, "photo.heic")
+        pillow_heif.from_pillow(image).save(self.src, quality=90)
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def convert_both(self, format, **limits):
+        """Convert with and without a limit and return both outputs' pixels"""
+        outputs = []
+        for name, extra in (("plain", {}), ("bounded", limits)):
+            dst = os.path.join(self.test_dir, f"{name}.{format.lower()}")
+            converter.convert(self.src, dst, converter.ConversionOptions(format=format, **extra))
+            with Image.open(dst) as img:
+                outputs.append((img.size, img.mode, img.tobytes()))
+        return outputs
+
+    def test_matches_unbounded_output(self):
+        """Test that strip-wise conversion writes the same pixels as a full decode"""
+        with patch.object(converter, 'STRIP_BYTES', 7 * 300 * 4):
+            for format in ('JPG', 'PNG'):
+                plain, bounded = self.convert_both(format, memory_limit=2**30)
+                self.assertEqual(plain, bounded)
+
+    def test_estimate_grows_with_pixels_and_alpha(self):
+        """Test that the header estimate scales with image size and transparency"""
+        small = converter.estimate_memory((1000, 1000), 'RGB')
+        large = converter.estimate_memory((2000, 2000), 'RGB')
+        alpha = converter.estimate_memory((1000, 1000), 'RGBA')
+        self.assertAlmostEqual(large[0] / small[0], 4, places=1)
+        self.assertGreater(alpha[0], small[0])
+        self.assertGreaterEqual(small[1], small[0])
+        reduced = converter.estimate_memory((2000, 2000), 'RGB', factor=2)
+        self.assertLess(reduced[1], large[1])
+
+    def test_resize_in_bounded_mode(self):
+        """Test that a resize is reduced while copying strips and counted in the estimate"""
+        options = converter.ConversionOptions(format='PNG', max_edge=50)
+        self.assertEqual(converter.reduce_factor((300, 200), options), 3)
+        full = converter.estimate_memory((300, 200), 'RGBA', options=options)
+        self.assertLess(full[1], converter.estimate_memory((300, 200), 'RGBA')[1])
+
+        outputs = []
+        with patch.object(converter, 'STRIP_BYTES', 7 * 300 * 4):
+            for limit in (0, full[1]):
+                dst = os.path.join(self.test_dir, f"out{limit}.png")
+                converter.convert(self.src, dst, converter.ConversionOptions(
+                    format='PNG', max_edge=50, memory_limit=limit))
+                with Image.open(dst) as img:
+                    outputs.append((img.size, img.tobytes()))
+        self.assertEqual(outputs[0][0], (50, 33))
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_refuses_when_decode_does_not_fit(self):
+        """Test that a file is refused up front when decoding alone would exceed the limit"""
+        dst = os.path.join(self.test_dir, "out.jpg")
+        options = converter.ConversionOptions(memory_limit=1024, downscale_to_fit=True)
+        with self.assertRaises(converter.MemoryLimitError):
+            converter.convert(self.src, dst, options)
+        self.assertFalse(os.path.exists(dst))
+
+    def test_downscales_to_fit(self):
+        """Test that the output is reduced when only the full-size copy is over the limit"""
+        decode, needed = converter.estimate_memory((300, 200), 'RGBA')
+        limit = converter.estimate_memory((300, 200), 'RGBA', factor=2)[1]
+        self.assertLess(decode, limit)
+        self.assertLess(limit, needed)
+        dst = os.path.join(self.test_dir, "out.jpg")
+
+        with self.assertRaises(converter.MemoryLimitError):
+            converter.convert(self.src, dst, converter.ConversionOptions(memory_limit=limit))
+        result = converter.convert(self.src, dst, converter.ConversionOptions(
+            memory_limit=limit, downscale_to_fit=True))
+        self.assertEqual(result.size, (150, 100))
+        with Image.open(dst) as img:
+            self.assertEqual(img.size, result.size)
+
+    def test_rejects_extra_images(self):
+        """Test that memory-limited mode cannot be combined with thumbnails or frame export"""
+        for extra in ({'thumbnail_sizes': (64,)}, {'frames': 'all'}):
+            with self.assertRaises(converter.ConversionError):
+                converter.convert(self.src, None,
+                                  converter.ConversionOptions(memory_limit=2**30, **extra))
+
+    def test_out_of_memory_reported_cleanly(self):
+        """Test that a MemoryError becomes a conversion error instead of killing the worker"""
+        with patch.object(converter, 'prepare_image', side_effect=MemoryError):
+            with self.assertRaises(converter.MemoryLimitError):
+                converter.convert(self.src, os.path.join(self.test_dir, "out.jpg"))
+
+
+class TestResize(unittest.TestCase):
+    """Test max_edge, max_megapixels and fit limits and the fast resize path"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def plan(self, size, **limits):
+        return converter.resize_plan(size, converter.ConversionOptions(**limits))
+
+    def test_plan(self):
+        """Test fit and fill targets, and that images are never enlarged"""
+        self.assertEqual(self.plan((4000, 3000), max_edge=2048), ((2048, 1536), (0, 0, 4000, 3000)))
+        self.assertEqual(self.plan((4000, 3000), max_megapixels=3)[0], (2000, 1500))
+        self.assertEqual(self.plan((4000, 3000), max_edge=3000, max_megapixels=3)[0],
+                         (2000, 1500))
+        self.assertEqual(self.plan((4000, 3000), max_edge=256, fit='fill'),
+                         ((256, 256), (500, 0, 3500, 3000)))
+        self.assertEqual(self.plan((400, 300), max_edge=1000, fit='fill')[0], (300, 300))
+        self.assertIsNone(self.plan((400, 300), max_edge=1000))
+        self.assertIsNone(self.plan((400, 300)))
+
+    def test_invalid_limits(self):
+        """Test that fill without an edge, unknown fits and negative limits are refused"""
+        for limits in ({'fit': 'fill'}, {'fit': 'stretch', 'max_edge': 10},
+                       {'max_edge': -1}, {'max_megapixels': -1}):
+            with self.subTest(limits=limits), self.assertRaises(converter.ConversionError):
+                converter.check_options(converter.ConversionOptions(**limits))
+
+    def test_fast_path_matches_lanczos(self):
+        """Test that reducing first gives nearly the same pixels as a full LANCZOS resize"""
+        image = Image.merge('RGB', [Image.linear_gradient('L').resize((1600, 1200)),
+                                    Image.radial_gradient('L').resize((1600, 1200)),
+                                    Image.new('L', (1600, 1200), 90)])
+        options = converter.ConversionOptions(max_edge=200)
+        with patch.object(Image.Image, 'reduce', autospec=True,
+                          side_effect=Image.Image.reduce) as reduce:
+            fast = converter.resize_image(image, options)
+        self.assertEqual(reduce.call_args.args[1], 4)
+
+        reference = image.resize((200, 150), Image.LANCZOS)
+        difference = ImageChops.difference(fast, reference)
+        self.assertEqual(fast.size, (200, 150))
+        self.assertLessEqual(max(high for _, high in difference.getextrema()), 4)
+
+    def test_convert_resizes_in_the_same_pass(self):
+        """Test that file conversion writes the resized image, keeping its metadata"""
+        src, icc = create_tagged_heic(os.path.join(self.test_dir, "photo.heic"))
+        dst = os.path.join(self.test_dir, "photo.jpg")
+        result = converter.convert(src, dst, converter.ConversionOptions(max_edge=20))
+
+        self.assertEqual(result.size, (20, 10))
+        with Image.open(dst) as img:
+            self.assertEqual(img.size, (20, 10))
+            self.assertEqual(img.info.get('icc_profile'), icc)
+
+
+def create_photo(size=(640, 480)):
+    """Return an RGB image with gradients and fine detail, which compresses like a photo"""
+    noise = Image.effect_noise(size, 40).filter(ImageFilter.GaussianBlur(2))
+    gradients = Image.merge('RGB', [Image.linear_gradient('L').resize(size),
+                                    Image.radial_gradient('L').resize(size),
+                                    noise])
+    return Image.blend(gradients, Image.merge('RGB', [noise] * 3), 0.3)
+
+
+class TestQualitySearch(unittest.TestCase):
+    """Test encoding to a target size or PSNR floor"""
+
+    def setUp(self):
+        self.image = create_photo()
+
+    def encode(self, quality, format='JPG'):
+        options = converter.ConversionOptions(format=format, quality=quality)
+        return converter.encode_bytes(self.image, options)
+
+    def test_target_bytes(self):
+        """Test that the highest quality that fits is found in a few encodes"""
+        for format in ('JPG', 'WEBP'):
+            target = len(self.encode(60, format)) + 500
+            options = converter.ConversionOptions(format=format, target_bytes=target)
+            with self.subTest(format=format):
+                data, quality, attempts = converter.search_quality(self.image, options)
+                self.assertLessEqual(len(data), target)
+                self.assertEqual(data, self.encode(quality, format))
+                # Either close to the target or the next quality up does not fit
+                self.assertTrue(len(data) >= target * (1 - converter.TARGET_TOLERANCE)
+                                or len(self.encode(quality + 1, format)) > target)
+                self.assertLessEqual(attempts, 5)
+
+    def test_min_psnr(self):
+        """Test that the lowest quality reaching the floor is chosen"""
+        reference = Image.open(io.BytesIO(self.encode(70)))
+        floor = converter.psnr(reference, self.image)
+        options = converter.ConversionOptions(min_psnr=floor)
+        data, quality, attempts = converter.search_quality(self.image, options)
+
+        score = converter.psnr(Image.open(io.BytesIO(data)), self.image)
+        self.assertGreaterEqual(score, floor)
+        # Either close to the floor or no worse than the quality that set it
+        self.assertTrue(score - floor <= converter.PSNR_TOLERANCE or quality <= 70)
+        self.assertLessEqual(attempts, 5)
+
+    def test_size_wins_over_psnr(self):
+        """Test that a budget too small for the PSNR floor is still met"""
+        target = len(self.encode(30))
+        options = converter.ConversionOptions(target_bytes=target, min_psnr=60)
+        data, quality, _ = converter.search_quality(self.image, options)
+        self.assertLessEqual(len(data), target)
+        self.assertLessEqual(quality, 30)
+
+    def test_unreachable_target(self):
+        """Test that a budget below the smallest possible output is an error"""
+        options = converter.ConversionOptions(target_bytes=100)
+        with self.assertRaisesRegex(converter.ConversionError, "even at quality"):
+            converter.search_quality(self.image, options)
+        with self.assertRaises(converter.ConversionError):
+            converter.check_options(converter.ConversionOptions(format='PNG', target_bytes=1000))
+
+    def test_bisect_finds_boundary(self):
+        """Test the search against a measure with a known boundary and a bad first guess"""
+        measured = []
+
+        def measure(quality):
+            measured.append(quality)
+            return quality * 10
+
+        for start in (-10, 0, 10):
+            measured.clear()
+            found = converter._bisect_quality(measure, 437, 0, lambda q: q / 20, start, 5, 95)
+            self.assertEqual(found, 43)
+            self.assertEqual(len(measured), len(set(measured)))
+        self.assertIsNone(converter._bisect_quality(measure, 10, 0, lambda q: q, 0, 5, 95))
+
+    def test_convert_reports_quality_and_attempts(self):
+        """Test that file conversion writes the chosen encode and records the search"""
+        test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, test_dir)
+        src = os.path.join(test_dir, "photo.heic")
+        pillow_heif.from_pillow(self.image).save(src, quality=95)
+        dst = os.path.join(test_dir, "photo.jpg")
+        target = len(self.encode(50))
+        file_metrics = FileMetrics(src)
+        converter.convert(src, dst, converter.ConversionOptions(target_bytes=target),
+                          file_metrics)
+
+        self.assertLessEqual(os.path.getsize(dst), target)
+        self.assertEqual(file_metrics.output_bytes, os.path.getsize(dst))
+        self.assertGreater(file_metrics.encode_attempts, 0)
+        self.assertLess(file_metrics.quality, 95)
+        self.assertIn('encode', file_metrics.stages)
+
+
+class TestEncoderPresets(unittest.TestCase):
+    """Test the extra output formats and encoder presets"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.src = create_heic(os.path.join(self.test_dir, "photo.heic"), size=(96, 64),
+                               mode='RGBA', color=(0, 128, 255, 128))
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def test_presets_trade_speed_for_size(self):
+        """Test that the smallest preset writes smaller PNG and JPEG files than fast"""
+        for format in ('PNG', 'JPG'):
+            sizes = {}
+            for preset in ('fast', 'smallest'):
+                options = converter.ConversionOptions(format=format, preset=preset)
+                dst = os.path.join(self.test_dir, f"{preset}{converter.FORMATS[format][0]}")
+                converter.convert(self.src, dst, options)
+                sizes[preset] = os.path.getsize(dst)
+            self.assertLess(sizes['smallest'], sizes['fast'], format)
+
+    def test_smallest_jpeg_is_progressive(self):
+        """Test that the smallest preset turns on optimized progressive JPEG"""
+        options = converter.ConversionOptions(preset='smallest')
+        result = converter.convert(self.src, options=options)
+        with Image.open(result.dst) as img:
+            self.assertTrue(img.info.get('progressive'))
+
+    @unittest.skipUnless('AVIF' in converter.available_formats(), "Pillow built without AVIF")
+    def test_avif_keeps_alpha(self):
+        """Test AVIF output, which stores transparency like PNG"""
+        options = converter.ConversionOptions(format='AVIF', preset='fast')
+        result = converter.convert(self.src, options=options)
+
+        self.assertTrue(result.dst.endswith(".avif"))
+        with Image.open(result.dst) as img:
+            self.assertEqual((img.format, img.mode, img.size), ('AVIF', 'RGBA', (96, 64)))
+
+    def test_unavailable_format_and_unknown_preset(self):
+        """Test that missing encoders and bad presets are reported before decoding"""
+        with patch('converter.available_formats', return_value=['JPG', 'PNG']), \
+                patch('converter._LOADED_FORMATS', []):
+            with self.assertRaisesRegex(converter.ConversionError, "not available"):
+                converter.convert(self.src, options=converter.ConversionOptions(format='JXL'))
+        with self.assertRaisesRegex(converter.ConversionError, "preset"):
+            converter.convert(self.src, options=converter.ConversionOptions(preset='tiny'))
+
+
+def create_tagged_heic(path, size=(80, 40), orientation=1):
+    """Write a HEIC with a capture time, EXIF orientation and an sRGB ICC profile"""
+    from PIL import ImageCms
+    img = Image.new('RGB', size, 'blue')
+    exif = Image.Exif()
+    exif[0x0132] = "2024:01:01 10:00:00"
+    exif[0x0112] = orientation
+    icc = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+    pillow_heif.from_pillow(img).save(path, quality=90, exif=exif.tobytes(), icc_profile=icc)
+    return path, icc
+
+
+class TestMetadata(unittest.TestCase):
+    """Test that EXIF, ICC and orientation are carried into the output"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.src, self.icc = create_tagged_heic(os.path.join(self.test_dir, "photo.heic"),
+                                                orientation=6)
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def assert_tagged(self, path):
+        with Image.open(path) as img:
+            self.assertEqual(img.size, (40, 80))
+            self.assertEqual(img.getexif().get(0x0132), "2024:01:01 10:00:00")
+            self.assertIn(img.getexif().get(0x0112), (None, 1))
+            self.assertEqual(img.info.get('icc_profile'), self.icc)
+
+    def test_metadata_kept_in_every_format(self):
+        """Test capture time and color profile survive, and rotation is applied once"""
+        for format in ('JPG', 'PNG', 'WEBP'):
+            result = converter.convert(self.src,
+                                       options=converter.ConversionOptions(format=format))
+            self.assert_tagged(result.dst)
+
+    def test_metadata_kept_on_other_paths(self):
+        """Test metadata through the memory-limited, thumbnail and in-memory paths"""
+        dst = os.path.join(self.test_dir, "bounded.jpg")
+        converter.convert(self.src, dst, converter.ConversionOptions(memory_limit=2**30))
+        self.assert_tagged(dst)
+
+        dst = os.path.join(self.test_dir, "frames.jpg")
+        converter.convert(self.src, dst, converter.ConversionOptions(frames=0))
+        self.assert_tagged(dst)
+
+        result = converter.convert(self.src,
+                                   options=converter.ConversionOptions(thumbnail_sizes=(40,)))
+        with Image.open(result.dst) as img:
+            self.assertEqual(img.size, (20, 40))
+            self.assertEqual(img.getexif().get(0x0132), "2024:01:01 10:00:00")
+
+        with open(self.src, 'rb') as f:
+            data = converter.convert_bytes(f.read())
+        self.assert_tagged(io.BytesIO(data))
+
+    def test_strip_metadata(self):
+        """Test that strip_metadata writes no EXIF or color profile"""
+        options = converter.ConversionOptions(strip_metadata=True)
+        result = converter.convert(self.src, options=options)
+        with Image.open(result.dst) as img:
+            self.assertEqual(img.size, (40, 80))
+            self.assertEqual(len(img.getexif()), 0)
+            self.assertNotIn('icc_profile', img.info)
+
+    def test_oversized_exif_dropped_for_jpeg(self):
+        """Test that EXIF too large for a JPEG marker is left out instead of failing"""
+        buffer = io.BytesIO()
+        image = Image.new('RGB', (8, 8))
+        converter.save_image(image, buffer, converter.ConversionOptions(),
+                             {'exif': b'Exif\x00\x00' + bytes(70000)})
+        buffer.seek(0)
+        with Image.open(buffer) as img:
+            self.assertNotIn('exif', img.info)
+
+
+class TestConvertBytes(unittest.TestCase):
+    """Test converting images held in memory"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        with open(create_heic(os.path.join(self.test_dir, "photo.heic"), size=(64, 48),
+                              mode='RGBA', color=(255, 0, 0, 128)), 'rb') as f:
+            self.heic = f.read()
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def test_formats_and_max_edge(self):
+        """Test that JPG is flattened, WebP keeps alpha and max_edge bounds the long edge"""
+        jpg = converter.convert_bytes(self.heic)
+        webp = converter.convert_bytes(self.heic,
+                                       converter.ConversionOptions(format='WEBP', max_edge=32))
+        with Image.open(io.BytesIO(jpg)) as img:
+            self.assertEqual((img.format, img.mode, img.size), ('JPEG', 'RGB', (64, 48)))
+        with Image.open(io.BytesIO(webp)) as img:
+            self.assertEqual((img.format, img.mode, img.size), ('WEBP', 'RGBA', (32, 24)))
+
+    def test_buffer_and_file_inputs(self):
+        """Test that buffers and file objects convert like bytes"""
+        expected = converter.convert_bytes(self.heic)
+        for data in (bytearray(self.heic), memoryview(self.heic), io.BytesIO(self.heic)):
+            with self.subTest(input=type(data).__name__):
+                self.assertEqual(converter.convert_bytes(data), expected)
+        with self.assertRaises(converter.ConversionError):
+            converter.convert_bytes(io.StringIO("text"))
+
+    def test_bytes_are_not_copied(self):
+        """Test that bytes, and memoryviews of whole bytes, reach the decoder as is"""
+        self.assertIs(converter.read_input(self.heic), self.heic)
+        self.assertIs(converter.read_input(memoryview(self.heic)), self.heic)
+        self.assertEqual(converter.read_input(memoryview(self.heic)[4:]), self.heic[4:])
+
+    def test_output_into_caller_buffer(self):
+        """Test writing the output into a file object or a preallocated buffer"""
+        expected = converter.convert_bytes(self.heic)
+        stream = io.BytesIO(b"header")
+        stream.seek(0, io.SEEK_END)
+        self.assertEqual(converter.convert_bytes(self.heic, out=stream), len(expected))
+        self.assertEqual(stream.getvalue(), b"header" + expected)
+
+        buffer = bytearray(len(expected) + 10)
+        self.assertEqual(converter.convert_bytes(self.heic, out=memoryview(buffer)),
+                         len(expected))
+        self.assertEqual(bytes(buffer[:len(expected)]), expected)
+
+        with self.assertRaises(converter.ConversionError):
+            converter.convert_bytes(self.heic, out=bytearray(16))
+
+    def test_errors_wrapped(self):
+        """Test that bad input and running out of memory raise conversion errors"""
+        with self.assertRaises(converter.ConversionError):
+            converter.convert_bytes(b"not an image")
+        for name in ('decode_bytes', 'encode_bytes'):
+            with patch.object(converter, name, side_effect=MemoryError):
+                with self.assertRaises(converter.MemoryLimitError):
+                    converter.convert_bytes(self.heic)
+
+
+class TestMultiImage(unittest.TestCase):
+    """Test exporting bursts and image sequences"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.test_dir, "burst.heic")
+        frames = [Image.new('RGB', (40, 30), color) for color in ('red', 'green', 'blue')]
+        heif_file = pillow_heif.from_pillow(frames[0])
+        for frame in frames[1:]:
+            heif_file.add_from_pillow(frame)
+        heif_file.save(self.src, quality=90)
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def test_primary_only_by_default(self):
+        """Test that the default conversion writes only the primary image"""
+        converter.convert(self.src)
+        self.assertEqual(sorted(os.listdir(self.test_dir)), ["burst.heic", "burst.jpg"])
+
+    def test_export_all_frames(self):
+        """Test that every top-level image is written"""
+        options = converter.ConversionOptions(frames='all', format='PNG')
+        result = converter.convert(self.src, options=options)
+
+        self.assertEqual(result.dst, os.path.join(self.test_dir, "burst_frame0.png"))
+        self.assertEqual(converter.primary_output(converter.output_path(self.src, options),
+                                                  options), result.dst)
+        with Image.open(os.path.join(self.test_dir, "burst_frame2.png")) as img:
+            r, g, b = img.getpixel((5, 5))[:3]
+            self.assertGreater(b, max(r, g))
+
+    def test_export_chosen_index(self):
+        """Test that a chosen image is written to the normal output path"""
+        options = converter.ConversionOptions(frames=1, format='PNG')
+        result = converter.convert(self.src, options=options)
+
+        self.assertEqual(result.dst, os.path.join(self.test_dir, "burst.png"))
+        with Image.open(result.dst) as img:
+            r, g, b = img.getpixel((5, 5))[:3]
+            self.assertGreater(g, max(r, b))
+
+    def test_index_out_of_range(self):
+        """Test that a missing image index is a conversion error"""
+        options = converter.ConversionOptions(frames=5)
+        with self.assertRaises(converter.ConversionError):
+            converter.convert(self.src, options=options)
+
+    def test_frames_decoded_lazily(self):
+        """Test that frames are decoded one at a time as they are consumed"""
+        decoded = []
+        original_load = pillow_heif.HeifImage.load
+
+        def tracking_load(heif_image):
+            decoded.append(heif_image)
+            original_load(heif_image)
+
+        options = converter.ConversionOptions(frames='all')
+        with patch.object(pillow_heif.HeifImage, 'load', autospec=True,
+                          side_effect=tracking_load):
+            images = converter.iter_images(self.src, options)
+            suffix, first = next(images)
+            self.assertEqual(suffix, "_frame0")
+            self.assertEqual(len({id(i) for i in decoded}), 1)
+            rest = [s for s, _ in images]
+
+        self.assertEqual(rest, ["_frame1", "_frame2"])
+        self.assertEqual(len({id(i) for i in decoded}), 3)
+
+    def test_depth_requested_without_depth_map(self):
+        """Test that asking for depth on a file without one writes only the image"""
+        options = converter.ConversionOptions(depth_images=True, aux_images=True)
+        converter.convert(self.src, options=options)
+        self.assertEqual(sorted(os.listdir(self.test_dir)), ["burst.heic", "burst.jpg"])
+
+    def test_aux_name(self):
+        """Test naming of auxiliary image outputs"""
+        self.assertEqual(converter._aux_name("urn:com:apple:photo:2020:aux:hdrgainmap"),
+                         "hdrgainmap")
+
+    def test_thumbnails_reject_extra_images(self):
+        """Test that thumbnail mode cannot be combined with frame export"""
+        options = converter.ConversionOptions(frames='all', thumbnail_sizes=(64,))
+        with self.assertRaises(converter.ConversionError):
+            converter.convert(self.src, options=options)
+
+
+class TestHighBitDepth(unittest.TestCase):
+    """Test converting 10-bit images at full depth"""
+
+    PQ = {'color_primaries': 9, 'transfer_characteristics': 16, 'matrix_coefficients': 9,
+          'full_range_flag': 1}
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.src = create_deep_heic(os.path.join(self.test_dir, "deep.heic"))
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def test_png_keeps_16_bits(self):
+        """Test that PNG output of a 10-bit image is 16-bit with the samples stretched"""
+        result = converter.convert(self.src, options=converter.ConversionOptions(format='PNG'))
+
+        self.assertEqual((result.size, result.mode), ((64, 48), 'RGB;16'))
+        self.assertEqual(png_header(result.dst), (16, 2))
+        with Image.open(result.dst) as img:
+            img.load()
+            # Pillow reads 16-bit color as its top 8 bits: 700/1023 of 255 is 174
+            self.assertLessEqual(abs(img.getpixel((10, 10))[0] - 174), 1)
+
+    def test_8bit_png_option(self):
+        """Test that keep_bit_depth off writes 8-bit PNG through libheif"""
+        options = converter.ConversionOptions(format='PNG', keep_bit_depth=False)
+        with patch('converter._convert_high_bit_depth') as deep:
+            result = converter.convert(self.src, options=options)
+        deep.assert_not_called()
+        self.assertEqual(png_header(result.dst), (8, 2))
+
+    def test_sdr_jpg_stays_on_libheif(self):
+        """Test that SDR 10-bit images to 8-bit formats take libheif's faster 8-bit decode"""
+        with patch('converter._convert_high_bit_depth') as deep:
+            converter.convert(self.src)
+        deep.assert_not_called()
+
+    def test_pq_is_tone_mapped(self):
+        """Test that a PQ image at peak brightness comes out white instead of dimmed"""
+        src = create_deep_heic(os.path.join(self.test_dir, "pq.heic"), value=769, nclx=self.PQ)
+        for format in ('JPG', 'WEBP'):
+            with self.subTest(format=format):
+                options = converter.ConversionOptions(format=format)
+                result = converter.convert(src, options=options)
+                with Image.open(result.dst) as img:
+                    self.assertEqual(img.mode, 'RGB')
+                    self.assertGreater(min(img.getpixel((10, 10))), 245)
+
+    def test_resize_and_alpha(self):
+        """Test that 16-bit PNG output is resized and keeps its alpha band"""
+        src = create_deep_heic(os.path.join(self.test_dir, "alpha.heic"), alpha=1023)
+        options = converter.ConversionOptions(format='PNG', max_edge=32)
+        result = converter.convert(src, options=options)
+
+        self.assertEqual((result.size, result.mode), ((32, 24), 'RGBA;16'))
+        self.assertEqual(png_header(result.dst), (16, 6))
+
+    def test_without_numpy(self):
+        """Test that every image goes through libheif when numpy is missing"""
+        with patch('converter._high_bit_depth', False):
+            result = converter.convert(self.src, options=converter.ConversionOptions(format='PNG'))
+        self.assertEqual(png_header(result.dst), (8, 2))
+
+    def test_metrics_stages(self):
+        """Test that the high bit depth path reports its stages and output size"""
+        metrics = FileMetrics(self.src)
+        result = converter.convert(self.src, options=converter.ConversionOptions(format='PNG'),
+                                   metrics=metrics)
+        self.assertEqual(metrics.output_bytes, os.path.getsize(result.dst))
+        self.assertTrue({'decode', 'encode'} <= set(metrics.stages))
+
+
+if __name__ == '__main__':
+    unittest.main()
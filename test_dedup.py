@@ -0,0 +1,173 @@
+import unittest
+import os
+import tempfile
+import shutil
+from contextlib import redirect_stdout, redirect_stderr
+from io import StringIO
+from unittest.mock import patch
+from PIL import Image
+
+import dedup
+import heic2img
+from cache import file_digest
+from test_converter import create_heic
+
+
+class TestDedupHelpers(unittest.TestCase):
+    """Test duplicate detection and output placement"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def write(self, name, data):
+        path = os.path.join(self.test_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_only_same_size_files_are_hashed(self):
+        """Test that a file with a unique size is never read"""
+        a = self.write("a.heic", b"x" * 10)
+        b = self.write("b.heic", b"y" * 10)
+        c = self.write("c.heic", b"z" * 20)
+        d = self.write("d.heic", b"w" * 30)
+
+        with patch('dedup.file_digest', side_effect=file_digest) as digest:
+            hashed = dedup.hash_candidates([a, b, c, d], sizes={30})
+        self.assertEqual(set(hashed), {a, b, d})
+        self.assertEqual(digest.call_count, 3)
+
+    def test_split_duplicates(self):
+        """Test that later inputs with the same content are set aside for the first"""
+        planned = [("a", "a.jpg"), ("b", "b.jpg"), ("c", "c.jpg"), ("d", "d.jpg")]
+        unique, duplicates = dedup.split_duplicates(planned, {"a": "1", "b": "2", "c": "1"})
+
+        self.assertEqual(unique, [("a", "a.jpg"), ("b", "b.jpg"), ("d", "d.jpg")])
+        self.assertEqual(duplicates, {"a": [("c", "c.jpg")]})
+
+    def test_place(self):
+        """Test copies and hard links, made without leaving temporary files behind"""
+        existing = self.write("out.jpg", b"converted")
+        copy = os.path.join(self.test_dir, "copy.jpg")
+        link = os.path.join(self.test_dir, "link.jpg")
+        dedup.place(existing, copy, 'copy')
+        dedup.place(existing, link, 'link')
+
+        self.assertEqual(os.stat(copy).st_nlink, 1)
+        self.assertEqual(os.stat(link).st_ino, os.stat(existing).st_ino)
+        self.assertEqual(sorted(os.listdir(self.test_dir)), ["copy.jpg", "link.jpg", "out.jpg"])
+
+    def test_output_store_evicts_least_recently_used(self):
+        """Test that the store stays within its byte budget"""
+        store = dedup.OutputStore(max_bytes=10)
+        store.put("a", b"aaaa")
+        store.put("b", b"bbbb")
+        store.get("a")
+        store.put("c", b"cccc")
+        store.put("huge", b"h" * 11)
+
+        self.assertEqual((store.get("a"), store.get("b"), store.get("c")),
+                         (b"aaaa", None, b"cccc"))
+        self.assertIsNone(store.get("huge"))
+        self.assertEqual(store.size, 8)
+
+
+class TestBatchDedup(unittest.TestCase):
+    """Test that batch runs convert identical inputs once"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.in_dir = os.path.join(self.test_dir, "in")
+        self.out_dir = os.path.join(self.test_dir, "out")
+        os.makedirs(os.path.join(self.in_dir, "sub"))
+        original = create_heic(os.path.join(self.in_dir, "a.heic"), color='red')
+        shutil.copy(original, os.path.join(self.in_dir, "b.heic"))
+        shutil.copy(original, os.path.join(self.in_dir, "sub", "c.heic"))
+        create_heic(os.path.join(self.in_dir, "d.heic"), color='blue')
+        # Failed files are retried; do not wait between rounds
+        retry_delay = patch.object(heic2img, 'RETRY_DELAY', 0)
+        retry_delay.start()
+        self.addCleanup(retry_delay.stop)
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def run_cli(self, *args):
+        output = StringIO()
+        with redirect_stdout(output), redirect_stderr(StringIO()):
+            code = heic2img.main([self.in_dir, self.out_dir, "-j", "1"] + list(args))
+        return code, output.getvalue()
+
+    def out(self, name):
+        return os.path.join(self.out_dir, name)
+
+    def test_identical_inputs_convert_once(self):
+        """Test that copies are filled in from one conversion and the hit rate is reported"""
+        for mode in ([], ["--pipeline"]):
+            with self.subTest(mode=mode):
+                shutil.rmtree(self.out_dir, ignore_errors=True)
+                with patch('converter.convert', wraps=heic2img.converter.convert) as convert:
+                    code, output = self.run_cli("--no-cache", *mode)
+
+                self.assertEqual(code, 0)
+                self.assertIn("Converted 4 of 4", output)
+                self.assertIn("Deduplicated 2 of 4 files (50% hit rate)", output)
+                if not mode:
+                    self.assertEqual(convert.call_count, 2)
+                for name in ("b.jpg", os.path.join("sub", "c.jpg")):
+                    with open(self.out("a.jpg"), 'rb') as f, open(self.out(name), 'rb') as g:
+                        self.assertEqual(f.read(), g.read())
+                    self.assertEqual(os.stat(self.out(name)).st_nlink, 1)
+
+    def test_link_mode_and_rewrite(self):
+        """Test hard links, and that reconverting one name leaves the others alone"""
+        self.run_cli("--no-cache", "--dedup", "link")
+        self.assertEqual(os.stat(self.out("a.jpg")).st_nlink, 3)
+
+        create_heic(os.path.join(self.in_dir, "a.heic"), color='green')
+        self.run_cli("--no-cache", "--dedup", "link")
+        with Image.open(self.out("a.jpg")) as a, Image.open(self.out("b.jpg")) as b:
+            self.assertGreater(a.getpixel((0, 0))[1], 100)
+            self.assertGreater(b.getpixel((0, 0))[0], 200)
+
+    def test_reuses_outputs_from_earlier_runs(self):
+        """Test that a new copy of converted content is filled in from the manifest"""
+        self.run_cli()
+        shutil.copy(os.path.join(self.in_dir, "d.heic"), os.path.join(self.in_dir, "e.heic"))
+        with patch('converter.convert') as convert:
+            code, output = self.run_cli()
+
+        convert.assert_not_called()
+        self.assertEqual(code, 0)
+        self.assertIn("Deduplicated 1 of 1 files (100% hit rate)", output)
+        self.assertIn("1 from earlier runs", output)
+        with open(self.out("d.jpg"), 'rb') as f, open(self.out("e.jpg"), 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+        _, output = self.run_cli()
+        self.assertIn("Skipped 5 unchanged files", output)
+
+    def test_failed_original_fails_its_duplicates(self):
+        """Test that duplicates of a file that cannot be converted are reported as failed"""
+        for name in ("x.heic", "y.heic"):
+            with open(os.path.join(self.in_dir, name), 'w') as f:
+                f.write("not an image")
+        code, output = self.run_cli("--no-cache")
+
+        self.assertEqual(code, 1)
+        self.assertIn("Converted 4 of 6", output)
+
+    def test_dedup_off(self):
+        """Test that --dedup off converts every file"""
+        with patch('converter.convert', wraps=heic2img.converter.convert) as convert:
+            _, output = self.run_cli("--no-cache", "--dedup", "off")
+        self.assertEqual(convert.call_count, 4)
+        self.assertNotIn("Deduplicated", output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import unittest
+import io
+import os
+import struct
+import tempfile
+import shutil
+import zlib
+
+import numpy as np
+import pillow_heif
+from PIL import Image
+
+import hdr
+
+
+def read_chunks(data):
+    """Return the (type, data) chunks of a PNG file's bytes"""
+    chunks = []
+    position = 8
+    while position < len(data):
+        length, = struct.unpack('>I', data[position:position + 4])
+        chunks.append((data[position + 4:position + 8], data[position + 8:position + 8 + length]))
+        position += length + 12
+    return chunks
+
+
+def read_png_samples(data):
+    """Decode a 16-bit PNG written with the Up filter back to uint16 samples"""
+    chunks = read_chunks(data)
+    width, height, depth, color_type = struct.unpack('>IIBB', chunks[0][1][:10])
+    bands = {0: 1, 4: 2, 2: 3, 6: 4}[color_type]
+    raw = zlib.decompress(b''.join(body for kind, body in chunks if kind == b'IDAT'))
+    raw = np.frombuffer(raw, np.uint8).reshape(height, 1 + width * bands * 2)
+    assert (raw[:, 0] == 2).all()
+    # Undoing Up is a running sum down each column, modulo 256
+    rows = np.cumsum(raw[:, 1:], axis=0, dtype=np.uint8)
+    return np.frombuffer(rows.tobytes(), '>u2').reshape(height, width, bands)
+
+
+class TestToneMap(unittest.TestCase):
+    """Test the tables that map decoded samples to 8 bits"""
+
+    def test_sdr_rounds(self):
+        """Test that SDR samples are rescaled with rounding rather than shifted"""
+        lut = hdr.tone_map_lut(10)
+        self.assertEqual(lut[0], 0)
+        self.assertEqual(lut[1023 << 6], 255)
+        self.assertEqual(lut[512 << 6], 128)
+        self.assertEqual(hdr.tone_map_lut(12)[4095 << 4], 255)
+
+    def test_pq_rolls_off_highlights(self):
+        """Test that PQ is monotonic, keeps reference white bright and reaches white at the peak"""
+        lut = hdr.tone_map_lut(10, hdr.TRANSFER_PQ)
+        self.assertTrue((np.diff(lut.astype(int)) >= 0).all())
+        self.assertEqual(lut[0], 0)
+        # 769 is 1000 cd/m² and 593 is 203 cd/m² in 10-bit PQ
+        self.assertEqual(lut[769 << 6], 255)
+        self.assertGreater(lut[593 << 6], 160)
+        self.assertLess(lut[593 << 6], 255)
+
+    def test_hlg_is_monotonic(self):
+        """Test that HLG maps black to black and the top code to white"""
+        lut = hdr.tone_map_lut(10, hdr.TRANSFER_HLG)
+        self.assertTrue((np.diff(lut.astype(int)) >= 0).all())
+        self.assertEqual((lut[0], lut[1023 << 6]), (0, 255))
+
+    def test_other_transfers_are_sdr(self):
+        """Test that transfers other than PQ and HLG share the SDR table"""
+        self.assertIs(hdr.tone_map_lut(10, 1), hdr.tone_map_lut(10))
+        self.assertTrue(hdr.is_hdr({'transfer_characteristics': 16}))
+        self.assertFalse(hdr.is_hdr({'transfer_characteristics': 13}))
+        self.assertFalse(hdr.is_hdr(None))
+
+    def test_alpha_is_only_rescaled(self):
+        """Test that alpha skips the PQ curve"""
+        samples = np.full((2, 2, 4), 593 << 6, np.uint16)
+        image = hdr.to_8bit(samples, 10, hdr.TRANSFER_PQ)
+        self.assertEqual(image.mode, 'RGBA')
+        red, _, _, alpha = image.getpixel((0, 0))
+        self.assertEqual(alpha, 148)
+        self.assertNotEqual(red, alpha)
+
+
+class TestSamples(unittest.TestCase):
+    """Test decoding, stretching and resizing 16-bit samples"""
+
+    def test_decode_real_file(self):
+        """Test that a 10-bit HEIC decodes to samples holding the coded values at the top"""
+        buffer = io.BytesIO()
+        source = np.full((32, 48, 3), 700, np.uint16) << 6
+        pillow_heif.from_bytes(mode='RGB;16', size=(48, 32), data=source.tobytes()).save(
+            buffer, quality=90)
+
+        heif_file = pillow_heif.open_heif(buffer, convert_hdr_to_8bit=False)
+        samples = hdr.decode(heif_file[0])
+
+        self.assertEqual((samples.shape, samples.dtype), ((32, 48, 3), np.uint16))
+        self.assertLessEqual(np.abs((samples >> 6).astype(int) - 700).max(), 4)
+
+    def test_to_16bit_fills_the_range(self):
+        """Test that the top code becomes 65535 and the input is left alone"""
+        samples = np.array([[[0, 512 << 6, 1023 << 6]]], np.uint16)
+        stretched = hdr.to_16bit(samples, 10)
+        self.assertEqual(stretched.tolist(), [[[0, 32800, 65535]]])
+        self.assertEqual(samples[0, 0, 2], 1023 << 6)
+
+    def test_resize(self):
+        """Test that every band is resized and flat areas keep their value"""
+        samples = np.full((30, 40, 4), 40000, np.uint16)
+        resized = hdr.resize(samples, (20, 15))
+        self.assertEqual(resized.shape, (15, 20, 4))
+        self.assertTrue((resized == 40000).all())
+
+
+class TestWritePng(unittest.TestCase):
+    """Test the 16-bit PNG writer"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def write(self, samples, **kwargs):
+        buffer = io.BytesIO()
+        hdr.write_png(buffer, samples, **kwargs)
+        return buffer.getvalue()
+
+    def test_round_trip(self):
+        """Test that samples survive across several strips, with and without alpha"""
+        rng = np.random.default_rng(0)
+        for bands in (1, 3, 4):
+            with self.subTest(bands=bands):
+                samples = rng.integers(0, 65536, (hdr.PNG_STRIP_ROWS + 17, 9, bands), np.uint16)
+                data = self.write(samples, compress_level=1)
+                self.assertTrue(np.array_equal(read_png_samples(data), samples))
+
+    def test_pillow_reads_output(self):
+        """Test that Pillow accepts the file, checksums included"""
+        path = os.path.join(self.test_dir, "out.png")
+        with open(path, 'wb') as f:
+            hdr.write_png(f, np.full((12, 16, 3), 65535, np.uint16))
+        with Image.open(path) as image:
+            image.load()
+            self.assertEqual(image.size, (16, 12))
+            self.assertEqual(image.getpixel((0, 0)), (255, 255, 255))
+
+    def test_metadata_chunks(self):
+        """Test that EXIF, XMP and the profile are written, with cICP in place of ICC for HDR"""
+        samples = np.zeros((2, 2, 3), np.uint16)
+        metadata = {'exif': b'Exif\0\0II*\0', 'icc_profile': b'profile', 'xmp': '<x:xmpmeta/>'}
+        chunks = dict(read_chunks(self.write(samples, metadata=metadata)))
+        self.assertEqual(chunks[b'eXIf'], b'II*\0')
+        self.assertTrue(chunks[b'iTXt'].endswith(b'<x:xmpmeta/>'))
+        self.assertEqual(zlib.decompress(chunks[b'iCCP'].split(b'\0\0', 1)[1]), b'profile')
+
+        nclx = {'color_primaries': 9, 'transfer_characteristics': 16,
+                'matrix_coefficients': 9, 'full_range_flag': 1}
+        chunks = dict(read_chunks(self.write(samples, metadata=metadata, nclx=nclx)))
+        self.assertEqual(chunks[b'cICP'], bytes([9, 16, 0, 1]))
+        self.assertNotIn(b'iCCP', chunks)
+
+
+if __name__ == '__main__':
+    unittest.main()
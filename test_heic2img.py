@@ -0,0 +1,274 @@
+import unittest
+import json
+import argparse
+import os
+import tempfile
+import shutil
+import threading
+import time
+from contextlib import redirect_stdout, redirect_stderr
+from io import StringIO
+from unittest.mock import patch
+from PIL import Image
+
+import converter
+import heic2img
+from test_converter import create_deep_heic, create_heic, png_header
+from watcher import FolderWatcher
+
+
+class TestBatchCLI(unittest.TestCase):
+    """Test the headless batch command line"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.in_dir = os.path.join(self.test_dir, "in")
+        self.out_dir = os.path.join(self.test_dir, "out")
+        os.makedirs(os.path.join(self.in_dir, "sub"))
+        create_heic(os.path.join(self.in_dir, "a.heic"))
+        create_heic(os.path.join(self.in_dir, "sub", "b.HEIC"), mode='RGBA')
+        with open(os.path.join(self.in_dir, "notes.txt"), 'w') as f:
+            f.write("ignored")
+        # Failed files are retried; do not wait between rounds
+        retry_delay = patch.object(heic2img, 'RETRY_DELAY', 0)
+        retry_delay.start()
+        self.addCleanup(retry_delay.stop)
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def run_cli(self, *args):
+        with redirect_stdout(StringIO()), redirect_stderr(StringIO()):
+            return heic2img.main(list(args))
+
+    def test_find_heic_files(self):
+        """Test that only HEIC files are found, recursively"""
+        files = heic2img.find_heic_files(self.in_dir)
+        names = [os.path.relpath(f, self.in_dir) for f in files]
+        self.assertEqual(names, ["a.heic", os.path.join("sub", "b.HEIC")])
+
+    def test_find_heif_family_by_name_and_content(self):
+        """Test that other HEIF extensions and mislabeled HEIC files are found, outputs are not"""
+        create_heic(os.path.join(self.in_dir, "c.heif"))
+        create_heic(os.path.join(self.in_dir, "IMG_0001.JPG"))
+        Image.new('RGB', (8, 8)).save(os.path.join(self.in_dir, "real.jpg"))
+        os.makedirs(os.path.join(self.in_dir, "out"))
+        Image.new('RGB', (8, 8)).save(os.path.join(self.in_dir, "out", "a.avif"))
+
+        files = heic2img.find_heic_files(self.in_dir, skip_dir=os.path.join(self.in_dir, "out"))
+
+        self.assertEqual([os.path.relpath(f, self.in_dir) for f in files],
+                         ["IMG_0001.JPG", "a.heic", "c.heif", os.path.join("sub", "b.HEIC")])
+        code = self.run_cli(self.in_dir, self.out_dir, "-j", "1")
+        self.assertEqual(code, 0)
+        with Image.open(os.path.join(self.out_dir, "IMG_0001.jpg")) as img:
+            self.assertEqual(img.format, 'JPEG')
+
+    def test_batch_mirrors_tree(self):
+        """Test that outputs mirror the input directory structure"""
+        code = self.run_cli(self.in_dir, self.out_dir, "--jobs", "2")
+
+        self.assertEqual(code, 0)
+        self.assertTrue(os.path.exists(os.path.join(self.out_dir, "a.jpg")))
+        with Image.open(os.path.join(self.out_dir, "sub", "b.jpg")) as img:
+            self.assertEqual(img.format, 'JPEG')
+            self.assertEqual(img.mode, 'RGB')
+
+    def test_batch_png_single_job(self):
+        """Test PNG output with an in-process run"""
+        code = self.run_cli(self.in_dir, self.out_dir, "-j", "1", "-f", "png")
+
+        self.assertEqual(code, 0)
+        with Image.open(os.path.join(self.out_dir, "sub", "b.png")) as img:
+            self.assertEqual(img.mode, 'RGBA')
+
+    def test_batch_webp_keeps_alpha(self):
+        """Test WebP output, which keeps transparency like PNG"""
+        create_heic(os.path.join(self.in_dir, "sub", "b.HEIC"), mode='RGBA',
+                    color=(255, 0, 0, 128))
+        code = self.run_cli(self.in_dir, self.out_dir, "-j", "1", "-f", "webp", "-q", "80")
+
+        self.assertEqual(code, 0)
+        with Image.open(os.path.join(self.out_dir, "sub", "b.webp")) as img:
+            self.assertEqual(img.format, 'WEBP')
+            self.assertEqual(img.mode, 'RGBA')
+
+    def test_failures_set_exit_code(self):
+        """Test that a corrupted file is reported without stopping the batch"""
+        with open(os.path.join(self.in_dir, "broken.heic"), 'w') as f:
+            f.write("not an image")
+        code = self.run_cli(self.in_dir, self.out_dir, "-j", "2")
+
+        self.assertEqual(code, 1)
+        self.assertTrue(os.path.exists(os.path.join(self.out_dir, "a.jpg")))
+
+    def test_thumbnail_mode(self):
+        """Test writing previews instead of full-size images"""
+        code = self.run_cli(self.in_dir, self.out_dir, "-j", "1", "--thumbnails", "16,32")
+
+        self.assertEqual(code, 0)
+        for name in ("a_16.jpg", "a_32.jpg", os.path.join("sub", "b_32.jpg")):
+            self.assertTrue(os.path.exists(os.path.join(self.out_dir, name)))
+        self.assertFalse(os.path.exists(os.path.join(self.out_dir, "a.jpg")))
+
+    def test_resize_options(self):
+        """Test --max-edge and --fit fill, and that they cannot be combined with --thumbnails"""
+        code = self.run_cli(self.in_dir, self.out_dir, "-j", "1", "--max-edge", "32")
+        self.assertEqual(code, 0)
+        with Image.open(os.path.join(self.out_dir, "a.jpg")) as img:
+            self.assertEqual(img.size, (32, 24))
+
+        self.run_cli(self.in_dir, self.out_dir, "-j", "1", "--no-cache", "--max-edge", "16",
+                     "--fit", "fill", "--pipeline")
+        with Image.open(os.path.join(self.out_dir, "sub", "b.jpg")) as img:
+            self.assertEqual(img.size, (16, 16))
+        for args in (["--thumbnails", "16", "--max-edge", "32"], ["--fit", "fill"]):
+            with self.subTest(args=args), redirect_stderr(StringIO()), \
+                    self.assertRaises(SystemExit):
+                heic2img.parse_args([self.in_dir, self.out_dir] + args)
+
+    def test_16bit_png(self):
+        """Test that 10-bit files become 16-bit PNG unless --8bit-png is given"""
+        create_deep_heic(os.path.join(self.in_dir, "deep.heic"))
+        code = self.run_cli(self.in_dir, self.out_dir, "-j", "1", "-f", "png")
+        self.assertEqual(code, 0)
+        self.assertEqual(png_header(os.path.join(self.out_dir, "deep.png")), (16, 2))
+        self.assertEqual(png_header(os.path.join(self.out_dir, "a.png"))[0], 8)
+
+        code = self.run_cli(self.in_dir, self.out_dir, "-j", "1", "-f", "png", "--8bit-png")
+        self.assertEqual(code, 0)
+        self.assertEqual(png_header(os.path.join(self.out_dir, "deep.png")), (8, 2))
+
+    def test_memory_budget(self):
+        """Test that a budget smaller than any one file still converts the batch one at a time"""
+        with patch('heic2img.run_batch', wraps=heic2img.run_batch) as run_batch:
+            code = self.run_cli(self.in_dir, self.out_dir, "-j", "2", "--memory-budget", "1")
+
+        self.assertEqual(code, 0)
+        self.assertTrue(os.path.exists(os.path.join(self.out_dir, "sub", "b.jpg")))
+        infos, budget = run_batch.call_args[0][6:8]
+        self.assertEqual(budget, 1)
+        self.assertEqual(sorted(os.path.basename(src) for src in infos), ["a.heic", "b.HEIC"])
+
+    def test_target_size(self):
+        """Test that --target-size keeps outputs in budget and records each file's search"""
+        jsonl = os.path.join(self.test_dir, "metrics.jsonl")
+        code = self.run_cli(self.in_dir, self.out_dir, "-j", "1", "--target-size", "1K",
+                            "--metrics-jsonl", jsonl)
+
+        self.assertEqual(code, 0)
+        self.assertLessEqual(os.path.getsize(os.path.join(self.out_dir, "a.jpg")), 1024)
+        with open(jsonl) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(len(records), 2)
+        for record in records:
+            self.assertGreater(record['encode_attempts'], 0)
+            self.assertIsNotNone(record['quality'])
+            self.assertIn('encode', record['stages'])
+        with redirect_stderr(StringIO()), self.assertRaises(SystemExit):
+            heic2img.parse_args([self.in_dir, self.out_dir, "-f", "png", "--target-size", "1K"])
+
+    def test_parse_frames(self):
+        """Test the --frames selection parser"""
+        self.assertEqual(heic2img.parse_frames("ALL"), "all")
+        self.assertEqual(heic2img.parse_frames("2"), 2)
+        with self.assertRaises(argparse.ArgumentTypeError):
+            heic2img.parse_frames("-1")
+
+    def test_background_color(self):
+        """Test that --background sets the matte behind transparent areas"""
+        create_heic(os.path.join(self.in_dir, "clear.heic"), mode='RGBA', color=(255, 0, 0, 0))
+        code = self.run_cli(self.in_dir, self.out_dir, "-j", "1", "--background", "blue")
+
+        self.assertEqual(code, 0)
+        with Image.open(os.path.join(self.out_dir, "clear.jpg")) as img:
+            red, green, blue = img.getpixel((0, 0))
+            self.assertLess(red, 20)
+            self.assertGreater(blue, 230)
+        self.assertEqual(heic2img.parse_color("red"), (255, 0, 0))
+        with self.assertRaises(argparse.ArgumentTypeError):
+            heic2img.parse_color("not-a-color")
+
+    def test_memory_limit(self):
+        """Test that files over --memory-limit fail without stopping the batch"""
+        code = self.run_cli(self.in_dir, self.out_dir, "-j", "1", "--memory-limit", "1K")
+
+        self.assertEqual(code, 1)
+        self.assertFalse(os.path.exists(os.path.join(self.out_dir, "a.jpg")))
+        self.assertEqual(self.run_cli(self.in_dir, self.out_dir, "-j", "1",
+                                      "--memory-limit", "1G"), 0)
+        self.assertTrue(os.path.exists(os.path.join(self.out_dir, "a.jpg")))
+
+    def test_parse_bytes(self):
+        """Test the --memory-limit size parser"""
+        self.assertEqual(heic2img.parse_bytes("512M"), 512 * 2**20)
+        self.assertEqual(heic2img.parse_bytes("1.5g"), 3 * 2**29)
+        self.assertEqual(heic2img.parse_bytes("4096"), 4096)
+        with self.assertRaises(argparse.ArgumentTypeError):
+            heic2img.parse_bytes("lots")
+
+    def test_parse_sizes(self):
+        """Test the --thumbnails size list parser"""
+        self.assertEqual(heic2img.parse_sizes("1024, 256,256"), (256, 1024))
+        with self.assertRaises(argparse.ArgumentTypeError):
+            heic2img.parse_sizes("big")
+
+    def test_run_batch_reports_each_file(self):
+        """Test that run_batch reports every file once"""
+        options = converter.ConversionOptions()
+        files = heic2img.find_heic_files(self.in_dir)
+        planned = heic2img.plan_outputs(self.in_dir, self.out_dir, files, options)
+        heic2img.create_output_dirs(planned)
+        seen = []
+        results = heic2img.run_batch(planned, options, jobs=2,
+                                     report=lambda *r: seen.append(r))
+
+        self.assertEqual(len(results), 2)
+        self.assertEqual(sorted(seen), sorted(results))
+
+    def test_watch_converts_new_files(self):
+        """Test that watch mode converts files that arrive after it starts, then stops"""
+        args = heic2img.parse_args([self.in_dir, self.out_dir, "--watch", "-j", "1"])
+        options = converter.ConversionOptions()
+        stop = threading.Event()
+        watcher = FolderWatcher(self.in_dir, settle=0.1)
+        self.addCleanup(watcher.close)
+        outcome = []
+
+        def watch():
+            with redirect_stdout(StringIO()), redirect_stderr(StringIO()):
+                outcome.append(heic2img.watch_folder(watcher, options, args, None, stop=stop))
+        thread = threading.Thread(target=watch)
+        thread.start()
+        try:
+            os.makedirs(os.path.join(self.in_dir, "new"))
+            with open(os.path.join(self.in_dir, "new", "notes.txt"), 'w') as f:
+                f.write("not an image")
+            create_heic(os.path.join(self.in_dir, "new", "c.heic"))
+            # Saved with the wrong extension; found by its content once it settles
+            create_heic(os.path.join(self.in_dir, "new", "d.png"))
+            dsts = [os.path.join(self.out_dir, "new", name) for name in ("c.jpg", "d.jpg")]
+            deadline = time.monotonic() + 30
+            while not all(map(os.path.exists, dsts)) and time.monotonic() < deadline:
+                time.sleep(0.05)
+        finally:
+            stop.set()
+            thread.join(timeout=30)
+
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(all(map(os.path.exists, dsts)))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.out_dir, "new"))),
+                         ["c.jpg", "d.jpg"])
+        self.assertEqual(outcome, [0])
+        # Files that were there before watching started are left to the normal batch
+        self.assertFalse(os.path.exists(os.path.join(self.out_dir, "a.jpg")))
+
+    def test_watch_rejects_pipeline(self):
+        """Test that --watch cannot be combined with --pipeline"""
+        with redirect_stderr(StringIO()), self.assertRaises(SystemExit):
+            heic2img.parse_args([self.in_dir, self.out_dir, "--watch", "--pipeline"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+import unittest
+import json
+import os
+import tempfile
+import shutil
+from contextlib import redirect_stdout, redirect_stderr
+from io import StringIO
+from unittest.mock import patch
+
+import converter
+import heic2img
+from journal import JOURNAL_NAME, Journal, JournalError
+from test_converter import create_heic
+
+
+class TestJournal(unittest.TestCase):
+    """Test the append-only checkpoint journal"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.test_dir, "journal.jsonl")
+        self.planned = [(f"{n}.heic", f"{n}.jpg") for n in "abcd"]
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def test_resume_sees_every_outcome(self):
+        """Test that done, failed and dead files are read back, and the rest are pending"""
+        with Journal.create(self.path, "opts", self.planned) as journal:
+            journal.record_done("a.heic")
+            journal.record_failed("b.heic", "flaky")
+            journal.record_dead("c.heic", "corrupt")
+        # A crash can leave half a line at the end
+        with open(self.path, 'a') as f:
+            f.write('{"event": "done", "sr')
+
+        with Journal.resume(self.path, "opts") as journal:
+            self.assertEqual(journal.pending(), [("b.heic", "b.jpg"), ("d.heic", "d.jpg")])
+            self.assertEqual(journal.failures, {"b.heic": 1, "c.heic": 1})
+            self.assertEqual(journal.dead, {"c.heic": "corrupt"})
+
+            dead_letter = os.path.join(self.test_dir, "failed.jsonl")
+            self.assertEqual(journal.write_dead_letters(dead_letter), 1)
+        with open(dead_letter) as f:
+            self.assertEqual(json.loads(f.read()), {"src": "c.heic", "dst": "c.jpg",
+                                                    "error": "corrupt", "attempts": 1})
+
+    def test_resume_needs_matching_journal(self):
+        """Test that a missing journal or different settings cannot be resumed"""
+        with self.assertRaisesRegex(JournalError, "no journal"):
+            Journal.resume(self.path, "opts")
+        Journal.create(self.path, "opts", self.planned).close()
+        with self.assertRaisesRegex(JournalError, "different conversion settings"):
+            Journal.resume(self.path, "other")
+
+
+class TestResumableBatch(unittest.TestCase):
+    """Test resuming batch runs and retrying failed files"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.in_dir = os.path.join(self.test_dir, "in")
+        self.out_dir = os.path.join(self.test_dir, "out")
+        os.makedirs(self.in_dir)
+        for name, color in (("a.heic", 'red'), ("b.heic", 'green'), ("c.heic", 'blue')):
+            create_heic(os.path.join(self.in_dir, name), color=color)
+        retry_delay = patch.object(heic2img, 'RETRY_DELAY', 0)
+        retry_delay.start()
+        self.addCleanup(retry_delay.stop)
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def run_cli(self, *args):
+        output = StringIO()
+        with redirect_stdout(output), redirect_stderr(output):
+            code = heic2img.main([self.in_dir, self.out_dir, "-j", "1"] + list(args))
+        return code, output.getvalue()
+
+    def test_resume_after_crash(self):
+        """Test that a resumed run converts only what is left, without scanning the tree"""
+        real_convert = converter.convert
+        calls = []
+
+        def crash_on_third(src, *args, **kwargs):
+            calls.append(src)
+            if len(calls) == 3:
+                raise KeyboardInterrupt
+            return real_convert(src, *args, **kwargs)
+
+        with patch('converter.convert', side_effect=crash_on_third), \
+                self.assertRaises(KeyboardInterrupt):
+            self.run_cli("--no-cache")
+
+        with patch('heic2img.find_heic_files') as scan, \
+                patch('converter.convert', wraps=real_convert) as convert:
+            code, output = self.run_cli("--no-cache", "--resume")
+
+        scan.assert_not_called()
+        self.assertEqual(code, 0)
+        self.assertIn("Resuming: 1 of 3 files left", output)
+        self.assertEqual([call.args[0] for call in convert.call_args_list], [calls[2]])
+        self.assertEqual(sorted(os.listdir(self.out_dir)),
+                         [JOURNAL_NAME, "a.jpg", "b.jpg", "c.jpg"])
+
+    def test_resume_requires_same_options(self):
+        """Test that resuming with other settings is refused"""
+        self.run_cli("--no-cache")
+        code, output = self.run_cli("--no-cache", "--resume", "--format", "PNG")
+        self.assertEqual(code, 2)
+        self.assertIn("different conversion settings", output)
+
+    def test_transient_failure_is_retried(self):
+        """Test that a file that fails once converts on the retry"""
+        real_convert = converter.convert
+        failed = []
+
+        def fail_once(src, *args, **kwargs):
+            if src.endswith("b.heic") and not failed:
+                failed.append(src)
+                raise converter.ConversionError("network blip")
+            return real_convert(src, *args, **kwargs)
+
+        with patch('converter.convert', side_effect=fail_once):
+            code, output = self.run_cli()
+
+        self.assertEqual(code, 0)
+        self.assertIn("RETRY", output)
+        self.assertIn("Converted 3 of 3", output)
+        self.assertTrue(os.path.exists(os.path.join(self.out_dir, "b.jpg")))
+
+    def test_dead_letter_after_retry_budget(self):
+        """Test that a file failing every attempt is listed once and not retried on resume"""
+        real_convert = converter.convert
+        create_heic(os.path.join(self.in_dir, "bad.heic"), color="white")
+
+        def fail_bad(src, *args, **kwargs):
+            if src.endswith("bad.heic"):
+                raise converter.ConversionError("decoder crashed")
+            return real_convert(src, *args, **kwargs)
+
+        with patch('converter.convert', side_effect=fail_bad) as convert:
+            code, output = self.run_cli("--no-cache", "--retries", "1")
+
+        self.assertEqual(code, 1)
+        self.assertEqual(convert.call_count, 5)
+        self.assertIn("Converted 3 of 4", output)
+        dead_letter = os.path.join(self.out_dir, "heic2img-failed.jsonl")
+        with open(dead_letter) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([(os.path.basename(r['src']), r['attempts']) for r in records],
+                         [("bad.heic", 2)])
+
+        with patch('converter.convert') as convert:
+            _, output = self.run_cli("--no-cache", "--retries", "1", "--resume")
+        convert.assert_not_called()
+        self.assertIn("Resuming: 0 of 4 files left", output)
+
+    def test_unreadable_file_is_not_retried(self):
+        """Test that a file the pre-flight scan rejects goes straight to the dead letters"""
+        with open(os.path.join(self.in_dir, "bad.heic"), 'w') as f:
+            f.write("not an image")
+        with patch('converter.convert', wraps=converter.convert) as convert:
+            code, output = self.run_cli("--no-cache", "--retries", "1")
+
+        self.assertEqual(code, 1)
+        self.assertEqual(convert.call_count, 3)
+        self.assertNotIn("RETRY", output)
+        self.assertIn("bad.heic is not a HEIF image", output)
+        with open(os.path.join(self.out_dir, "heic2img-failed.jsonl")) as f:
+            self.assertEqual([os.path.basename(json.loads(line)['src']) for line in f],
+                             ["bad.heic"])
+
+
+if __name__ == '__main__':
+    unittest.main()
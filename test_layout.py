@@ -0,0 +1,186 @@
+import unittest
+import os
+import tempfile
+import shutil
+from contextlib import redirect_stdout, redirect_stderr
+from io import StringIO
+from unittest.mock import patch
+
+import converter
+import heic2img
+import layout
+from cache import ConversionCache
+from metrics import FileMetrics
+from test_converter import create_heic
+
+
+class TestOutputLayout(unittest.TestCase):
+    """Test output folders, name templates and collision policies"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.in_dir = os.path.join(self.test_dir, "in")
+        self.out_dir = os.path.join(self.test_dir, "out")
+        self.files = [os.path.join(self.in_dir, "trip", "IMG_1.heic"),
+                      os.path.join(self.in_dir, "home", "IMG_1.heic")]
+        self.options = converter.ConversionOptions()
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def plan(self, **kwargs):
+        outputs = layout.OutputLayout(self.in_dir, self.out_dir, **kwargs)
+        planned, taken = outputs.plan(self.files, self.options)
+        return [os.path.relpath(dst, self.out_dir) for _, dst in planned], taken
+
+    def test_mirror_and_template(self):
+        """Test that outputs mirror the input folders and take their name from the template"""
+        self.assertEqual(self.plan()[0], [os.path.join("trip", "IMG_1.jpg"),
+                                          os.path.join("home", "IMG_1.jpg")])
+        self.assertEqual(self.plan(template="{parent}-{stem}", mirror=False)[0],
+                         ["trip-IMG_1.jpg", "home-IMG_1.jpg"])
+        self.assertEqual(self.plan(template="{format}/{stem}", mirror=False)[0][0],
+                         os.path.join("jpg", "IMG_1.jpg"))
+
+    def test_collisions_within_a_batch(self):
+        """Test the policies when two inputs map to the same flat name"""
+        self.assertEqual(self.plan(mirror=False)[0], ["IMG_1.jpg", "IMG_1.jpg"])
+        self.assertEqual(self.plan(mirror=False, collision='suffix')[0],
+                         ["IMG_1.jpg", "IMG_1_1.jpg"])
+        names, taken = self.plan(mirror=False, collision='skip')
+        self.assertEqual((names, taken), (["IMG_1.jpg"], [self.files[1]]))
+
+    def test_collisions_with_existing_files(self):
+        """Test that existing outputs are skipped or kept, except an input's own earlier output"""
+        os.makedirs(self.out_dir)
+        for name in ("IMG_1.jpg", "IMG_1_1.jpg"):
+            open(os.path.join(self.out_dir, name), 'w').close()
+        self.assertEqual(self.plan(mirror=False, collision='suffix')[0],
+                         ["IMG_1_2.jpg", "IMG_1_3.jpg"])
+
+        with ConversionCache(self.out_dir) as cache:
+            src = os.path.join(self.in_dir, "IMG_1.heic")
+            create_heic(os.path.join(self.test_dir, "x.heic"))
+            os.makedirs(self.in_dir)
+            shutil.copy(os.path.join(self.test_dir, "x.heic"), src)
+            cache.record(src, os.path.join(self.out_dir, "IMG_1_1.jpg"), self.options)
+            outputs = layout.OutputLayout(self.in_dir, self.out_dir, collision='suffix')
+            planned, _ = outputs.plan([src], self.options, cache)
+        self.assertEqual(planned, [(src, os.path.join(self.out_dir, "IMG_1_1.jpg"))])
+
+    def test_invalid_templates(self):
+        """Test that unknown fields and names outside the output folder are refused"""
+        for template in ("{name}", "{stem", "../{stem}", "/tmp/{stem}", ""):
+            with self.subTest(template=template), self.assertRaises(ValueError):
+                layout.check_template(template)
+        with self.assertRaises(ValueError):
+            layout.OutputLayout(self.in_dir, self.out_dir, collision='rename')
+
+    def test_make_dirs_once_per_leaf(self):
+        """Test that only leaf folders reach makedirs, and each only once"""
+        paths = [os.path.join(self.out_dir, *parts, f"{n}.jpg")
+                 for parts in (("a",), ("a", "b"), ("a", "b", "c"), ("d",)) for n in range(50)]
+        outputs = layout.OutputLayout(self.in_dir, self.out_dir)
+        # With the parents in place, makedirs does not call itself for them
+        os.makedirs(os.path.join(self.out_dir, "a", "b"))
+        with patch('layout.os.makedirs', wraps=os.makedirs) as makedirs:
+            outputs.make_dirs(paths)
+            outputs.make_dirs(paths[:10])
+        self.assertEqual(sorted(call.args[0] for call in makedirs.call_args_list),
+                         [os.path.join(self.out_dir, "a", "b", "c"),
+                          os.path.join(self.out_dir, "d")])
+        self.assertTrue(os.path.isdir(os.path.join(self.out_dir, "a", "b", "c")))
+        self.assertTrue(os.path.isdir(os.path.join(self.out_dir, "d")))
+
+
+class TestAtomicWrites(unittest.TestCase):
+    """Test that outputs appear whole or not at all"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.src = create_heic(os.path.join(self.test_dir, "photo.heic"))
+        self.dst = os.path.join(self.test_dir, "photo.jpg")
+        with open(self.dst, 'wb') as f:
+            f.write(b"previous output")
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def test_failed_write_keeps_previous_output(self):
+        """Test that an encoder failure leaves the old file and no temporary file"""
+        for metrics in (None, FileMetrics(self.src)):
+            with self.subTest(metrics=metrics), \
+                    patch('PIL.Image.Image.save', side_effect=OSError("disk full")):
+                with self.assertRaises(converter.ConversionError):
+                    converter.convert(self.src, self.dst, metrics=metrics)
+            with open(self.dst, 'rb') as f:
+                self.assertEqual(f.read(), b"previous output")
+            self.assertEqual(sorted(os.listdir(self.test_dir)), ["photo.heic", "photo.jpg"])
+
+    def test_output_replaces_file_instead_of_writing_through_it(self):
+        """Test that a hard link to the old output keeps the old content"""
+        link = os.path.join(self.test_dir, "link.jpg")
+        os.link(self.dst, link)
+        converter.convert(self.src, self.dst)
+
+        with open(link, 'rb') as f:
+            self.assertEqual(f.read(), b"previous output")
+        self.assertNotEqual(os.stat(link).st_ino, os.stat(self.dst).st_ino)
+
+
+class TestLayoutCLI(unittest.TestCase):
+    """Test the layout options of the batch command line"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.in_dir = os.path.join(self.test_dir, "in")
+        self.out_dir = os.path.join(self.test_dir, "out")
+        for folder, color in (("trip", 'red'), ("home", 'blue')):
+            os.makedirs(os.path.join(self.in_dir, folder))
+            create_heic(os.path.join(self.in_dir, folder, "IMG_1.heic"), color=color)
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def run_cli(self, *args):
+        output = StringIO()
+        with redirect_stdout(output), redirect_stderr(StringIO()):
+            code = heic2img.main([self.in_dir, self.out_dir, "-j", "1"] + list(args))
+        return code, output.getvalue()
+
+    def test_flat_layout_with_suffixes(self):
+        """Test a flat layout that keeps both same-named photos, and a rerun that adds nothing"""
+        code, _ = self.run_cli("--layout", "flat", "--on-collision", "suffix")
+        self.assertEqual(code, 0)
+        self.assertEqual(sorted(n for n in os.listdir(self.out_dir) if n.endswith(".jpg")),
+                         ["IMG_1.jpg", "IMG_1_1.jpg"])
+
+        _, output = self.run_cli("--layout", "flat", "--on-collision", "suffix")
+        self.assertIn("Skipped 2 unchanged files", output)
+        self.assertEqual(len([n for n in os.listdir(self.out_dir) if n.endswith(".jpg")]), 2)
+
+    def test_skip_existing_outputs(self):
+        """Test that --on-collision skip leaves outputs it did not make alone"""
+        os.makedirs(os.path.join(self.out_dir, "trip"))
+        with open(os.path.join(self.out_dir, "trip", "IMG_1.jpg"), 'w') as f:
+            f.write("keep me")
+        _, output = self.run_cli("--on-collision", "skip")
+
+        self.assertIn("Converted 1 of 1", output)
+        self.assertIn("Skipped 1 files whose output name is already taken", output)
+        with open(os.path.join(self.out_dir, "trip", "IMG_1.jpg")) as f:
+            self.assertEqual(f.read(), "keep me")
+
+    def test_name_template(self):
+        """Test templated names, and that bad templates are refused up front"""
+        self.run_cli("--layout", "flat", "--name-template", "{parent}_{stem}")
+        self.assertTrue(os.path.exists(os.path.join(self.out_dir, "home_IMG_1.jpg")))
+        with redirect_stderr(StringIO()), self.assertRaises(SystemExit):
+            heic2img.parse_args([self.in_dir, self.out_dir, "--name-template", "{date}"])
+
+
+if __name__ == '__main__':
+    unittest.main()
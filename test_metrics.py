@@ -0,0 +1,194 @@
+import unittest
+import os
+import json
+import tempfile
+import shutil
+from contextlib import redirect_stdout, redirect_stderr
+from io import StringIO
+from unittest.mock import patch
+
+import converter
+import heic2img
+from metrics import RESERVOIR_SIZE, FileMetrics, MetricsCollector, current_rss_bytes
+from test_converter import create_heic
+
+
+class TestFileMetrics(unittest.TestCase):
+    """Test per-file stage instrumentation"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.src = create_heic(os.path.join(self.test_dir, "photo.heic"), mode='RGBA')
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def test_convert_records_every_stage(self):
+        """Test that decode, flatten, encode and write are timed separately"""
+        file_metrics = FileMetrics(self.src)
+        result = converter.convert(self.src, metrics=file_metrics)
+
+        self.assertEqual(set(file_metrics.stages), {'decode', 'flatten', 'encode', 'write'})
+        for totals in file_metrics.stages.values():
+            self.assertGreaterEqual(totals['wall_s'], 0)
+            self.assertGreaterEqual(totals['cpu_s'], 0)
+        self.assertEqual(file_metrics.input_bytes, os.path.getsize(self.src))
+        self.assertEqual(file_metrics.output_bytes, os.path.getsize(result.dst))
+
+    def test_encode_streams_to_disk(self):
+        """Test that timing encode and write separately does not buffer the output"""
+        file_metrics = FileMetrics(self.src)
+        with patch('converter.encode_bytes') as encode_bytes:
+            result = converter.convert(self.src, metrics=file_metrics)
+        encode_bytes.assert_not_called()
+
+        plain = converter.convert(self.src, os.path.join(self.test_dir, "plain.jpg"))
+        with open(result.dst, 'rb') as timed, open(plain.dst, 'rb') as untimed:
+            self.assertEqual(timed.read(), untimed.read())
+
+    @unittest.skipUnless(current_rss_bytes(), "current RSS is not readable on this platform")
+    def test_stages_record_rss_delta(self):
+        """Test that each stage records its own resident memory growth"""
+        file_metrics = FileMetrics(self.src)
+        converter.convert(self.src, metrics=file_metrics)
+
+        for name in ('decode', 'flatten', 'encode'):
+            self.assertIsInstance(file_metrics.stages[name]['rss_delta_bytes'], int)
+
+    def test_round_trip_dict(self):
+        """Test that metrics survive the trip back from a worker process"""
+        file_metrics = FileMetrics(self.src)
+        converter.convert(self.src, metrics=file_metrics)
+        copy = FileMetrics.from_dict(json.loads(json.dumps(file_metrics.to_dict())))
+
+        self.assertEqual(copy.to_dict(), file_metrics.to_dict())
+
+
+class TestMetricsCollector(unittest.TestCase):
+    """Test aggregation and export formats"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def make_metrics(self, decode_s, error=None):
+        file_metrics = FileMetrics("photo.heic")
+        file_metrics.stages = {'decode': {'wall_s': decode_s, 'cpu_s': decode_s / 2}}
+        file_metrics.input_bytes = 1000
+        file_metrics.output_bytes = 2000
+        file_metrics.error = error
+        return file_metrics
+
+    def test_prometheus_text(self):
+        """Test counters and histogram buckets in the exposition format"""
+        collector = MetricsCollector()
+        collector.add(self.make_metrics(0.02))
+        collector.add(self.make_metrics(0.3, error="bad"))
+        text = collector.prometheus_text()
+
+        self.assertIn('heic2img_files_total{status="ok"} 1', text)
+        self.assertIn('heic2img_files_total{status="failed"} 1', text)
+        self.assertIn('heic2img_input_bytes_total 2000', text)
+        self.assertIn('heic2img_stage_seconds_bucket{stage="decode",le="0.025"} 1', text)
+        self.assertIn('heic2img_stage_seconds_bucket{stage="decode",le="0.5"} 2', text)
+        self.assertIn('heic2img_stage_seconds_bucket{stage="decode",le="+Inf"} 2', text)
+        self.assertIn('heic2img_stage_seconds_count{stage="decode"} 2', text)
+
+    def test_files_written_on_close(self):
+        """Test the JSON lines and Prometheus outputs"""
+        jsonl = os.path.join(self.test_dir, "metrics.jsonl")
+        prom = os.path.join(self.test_dir, "metrics.prom")
+        with MetricsCollector(jsonl, prom) as collector:
+            collector.add(self.make_metrics(0.1))
+            collector.add(self.make_metrics(0.2))
+
+        with open(jsonl) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[1]['stages']['decode']['wall_s'], 0.2)
+        with open(prom) as f:
+            self.assertIn('heic2img_files_total{status="ok"} 2', f.read())
+
+    def test_summary(self):
+        """Test the human-readable batch summary"""
+        collector = MetricsCollector()
+        collector.add(self.make_metrics(0.1))
+        summary = collector.summary()
+
+        self.assertIn("1 files (0 failed)", summary)
+        self.assertIn("decode", summary)
+
+    def test_quality_search_totals(self):
+        """Test that searched files report their encodes in the summary and Prometheus text"""
+        collector = MetricsCollector()
+        for quality, attempts in ((80, 2), (70, 4)):
+            file_metrics = self.make_metrics(0.1)
+            file_metrics.quality, file_metrics.encode_attempts = quality, attempts
+            collector.add(file_metrics)
+        collector.add(self.make_metrics(0.1))
+
+        self.assertIn("quality search: 3.0 encodes per file, mean quality 75",
+                      collector.summary())
+        self.assertIn("heic2img_encode_attempts_total 6", collector.prometheus_text())
+
+    def test_samples_are_bounded(self):
+        """Test that a long batch keeps a fixed-size sample while the histogram stays exact"""
+        collector = MetricsCollector()
+        for i in range(RESERVOIR_SIZE + 500):
+            collector.add(self.make_metrics(0.001 if i % 2 else 1.5))
+
+        self.assertEqual(len(collector.stage_samples['decode']), RESERVOIR_SIZE)
+        text = collector.prometheus_text()
+        self.assertIn(f'heic2img_stage_seconds_count{{stage="decode"}} {RESERVOIR_SIZE + 500}',
+                      text)
+        self.assertIn('heic2img_stage_seconds_bucket{stage="decode",le="1"} '
+                      f'{(RESERVOIR_SIZE + 500) // 2}', text)
+        self.assertIn("p95 1500 ms", collector.summary())
+
+
+class TestBatchMetrics(unittest.TestCase):
+    """Test metrics collection from batch runs"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.in_dir = os.path.join(self.test_dir, "in")
+        os.makedirs(self.in_dir)
+        # Distinct content, so none of them is skipped as a duplicate
+        for name, color in (("a.heic", 'red'), ("b.heic", 'green'), ("c.heic", 'blue')):
+            create_heic(os.path.join(self.in_dir, name), color=color)
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def run_cli(self, *args):
+        jsonl = os.path.join(self.test_dir, "metrics.jsonl")
+        output = StringIO()
+        with redirect_stdout(output), redirect_stderr(StringIO()):
+            heic2img.main([self.in_dir, os.path.join(self.test_dir, "out"), "--no-cache",
+                           "--metrics-jsonl", jsonl, "--stats"] + list(args))
+        with open(jsonl) as f:
+            return [json.loads(line) for line in f], output.getvalue()
+
+    def test_process_pool_metrics(self):
+        """Test that worker processes send metrics back to the parent"""
+        records, output = self.run_cli("-j", "2")
+
+        self.assertEqual(len(records), 3)
+        self.assertIn('encode', records[0]['stages'])
+        self.assertIn("3 files (0 failed)", output)
+
+    def test_pipeline_metrics(self):
+        """Test that pipeline stages are recorded, including reads"""
+        records, _ = self.run_cli("--pipeline", "-j", "2")
+
+        self.assertEqual(len(records), 3)
+        self.assertEqual(set(records[0]['stages']), {'read', 'decode', 'flatten', 'encode', 'write'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+import os
+import tempfile
+import shutil
+import threading
+from contextlib import redirect_stdout, redirect_stderr
+from io import StringIO
+from unittest.mock import patch
+from PIL import Image
+
+import converter
+import heic2img
+import pipeline
+from pipeline import Pipeline
+from test_converter import create_heic, create_tagged_heic
+
+
+class TestPipeline(unittest.TestCase):
+    """Test the staged streaming pipeline"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.planned = []
+        for i in range(12):
+            src = create_heic(os.path.join(self.test_dir, f"img{i}.heic"),
+                              mode='RGBA' if i % 2 else 'RGB')
+            self.planned.append((src, src[:-5] + ".jpg"))
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def test_converts_every_file(self):
+        """Test that every planned file is converted exactly once"""
+        results = Pipeline(converter.ConversionOptions(), decoders=3, encoders=2).run(self.planned)
+
+        self.assertEqual(sorted(results), sorted((s, d, None) for s, d in self.planned))
+        for _, dst in self.planned:
+            with Image.open(dst) as img:
+                self.assertEqual(img.format, 'JPEG')
+                self.assertEqual(img.mode, 'RGB')
+
+    def test_metadata_carried_through(self):
+        """Test that the EXIF and color profile reach outputs written by the pipeline"""
+        src, icc = create_tagged_heic(os.path.join(self.test_dir, "tagged.heic"))
+        Pipeline(converter.ConversionOptions()).run([(src, src[:-5] + ".jpg")])
+
+        with Image.open(src[:-5] + ".jpg") as img:
+            self.assertEqual(img.getexif().get(0x0132), "2024:01:01 10:00:00")
+            self.assertEqual(img.info.get('icc_profile'), icc)
+
+    def test_errors_do_not_stop_the_stream(self):
+        """Test that unreadable and undecodable files are reported"""
+        broken = os.path.join(self.test_dir, "broken.heic")
+        with open(broken, 'w') as f:
+            f.write("not an image")
+        missing = os.path.join(self.test_dir, "missing.heic")
+        planned = self.planned[:2] + [(broken, broken + ".jpg"), (missing, missing + ".jpg")]
+
+        results = Pipeline(converter.ConversionOptions()).run(planned)
+        errors = {src: error for src, _, error in results}
+
+        self.assertEqual(len(results), 4)
+        self.assertIsNotNone(errors[broken])
+        self.assertIsNotNone(errors[missing])
+        self.assertIsNone(errors[self.planned[0][0]])
+
+    def test_unexpected_errors_do_not_hang(self):
+        """Test that any exception, even MemoryError, fails the file and the run still finishes"""
+        for error in (MemoryError, RuntimeError("decoder crashed"), EOFError):
+            with patch.object(converter, 'prepare_image', side_effect=error):
+                pipe = Pipeline(converter.ConversionOptions(), decoders=1, encoders=1,
+                                queue_size=1)
+                results = []
+                runner = threading.Thread(target=lambda: results.append(pipe.run(self.planned)),
+                                          daemon=True)
+                runner.start()
+                runner.join(timeout=30)
+
+            self.assertFalse(runner.is_alive(), f"pipeline hung after {error!r}")
+            self.assertEqual(len(results[0]), len(self.planned))
+            self.assertTrue(all(e for _, _, e in results[0]))
+
+    def test_queues_are_bounded(self):
+        """Test backpressure: no more than queue_size jobs wait between stages"""
+        depths = []
+        original_put = pipeline.queue.Queue.put
+        lock = threading.Lock()
+
+        def tracking_put(q, item, *args, **kwargs):
+            original_put(q, item, *args, **kwargs)
+            with lock:
+                depths.append((q.maxsize, q.qsize()))
+
+        with patch.object(pipeline.queue.Queue, 'put', autospec=True, side_effect=tracking_put):
+            Pipeline(converter.ConversionOptions(), decoders=1, encoders=1,
+                     queue_size=2).run(self.planned)
+
+        self.assertTrue(depths)
+        self.assertTrue(all(maxsize == 2 and size <= 2 for maxsize, size in depths))
+
+    def test_cli_pipeline_mode(self):
+        """Test the --pipeline option of the batch command line"""
+        out_dir = os.path.join(self.test_dir, "out")
+        with redirect_stdout(StringIO()), redirect_stderr(StringIO()):
+            code = heic2img.main([self.test_dir, out_dir, "--pipeline", "-j", "2",
+                                  "-f", "PNG", "--no-cache"])
+
+        self.assertEqual(code, 0)
+        self.assertEqual(len([n for n in os.listdir(out_dir) if n.endswith(".png")]), 12)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+import unittest
+import os
+import tempfile
+import shutil
+from unittest.mock import patch
+
+import numpy as np
+import pillow_heif
+from PIL import Image
+
+import converter
+import heic2img
+import preflight
+from test_converter import create_heic
+
+
+class TestInspect(unittest.TestCase):
+    """Test reading image facts from HEIC headers"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def test_header_facts(self):
+        """Test that size, alpha and bit depth come from the header without decoding"""
+        src = create_heic(os.path.join(self.test_dir, "alpha.heic"), size=(80, 40), mode='RGBA')
+        with patch.object(pillow_heif.HeifImage, 'load') as load:
+            info = preflight.inspect(src)
+        load.assert_not_called()
+        self.assertEqual(info, preflight.ImageInfo(src, (80, 40), 1, 8, True))
+        self.assertEqual(info.pixels, 3200)
+
+    def test_high_bit_depth_and_frames(self):
+        """Test that 10-bit files and extra top-level images are reported"""
+        src = os.path.join(self.test_dir, "deep.heic")
+        samples = np.full((32, 48, 3), 700, np.uint16)
+        heif_file = pillow_heif.from_bytes(mode='RGB;16', size=(48, 32), data=samples.tobytes())
+        heif_file.add_from_pillow(Image.new('RGB', (16, 16)))
+        heif_file.save(src, quality=90)
+
+        info = preflight.inspect(src)
+
+        self.assertEqual((info.size, info.frames, info.bit_depth, info.has_alpha),
+                         ((48, 32), 2, 10, False))
+
+    def test_memory_matches_estimate(self):
+        """Test that the memory figure is the converter's estimate for the header"""
+        info = preflight.ImageInfo("x.heic", (4000, 3000), 1, 10, True)
+        options = converter.ConversionOptions(max_edge=1000)
+        self.assertEqual(info.memory(options),
+                         converter.estimate_memory((4000, 3000), 'RGBA', 10, options)[1])
+
+    def test_bad_files_are_rejected(self):
+        """Test that missing, mislabeled and truncated files raise ConversionError"""
+        good = create_heic(os.path.join(self.test_dir, "good.heic"))
+        text = os.path.join(self.test_dir, "text.heic")
+        with open(text, 'w') as f:
+            f.write("not an image")
+        truncated = os.path.join(self.test_dir, "truncated.heic")
+        with open(good, 'rb') as f, open(truncated, 'wb') as out:
+            out.write(f.read(100))
+
+        for path, message in ((os.path.join(self.test_dir, "gone.heic"), "does not exist"),
+                              (text, "not a HEIF image"),
+                              (truncated, "not a readable HEIC image")):
+            with self.subTest(path=os.path.basename(path)):
+                with self.assertRaisesRegex(converter.ConversionError, message):
+                    preflight.inspect(path)
+
+    def test_undecodable_codec_rejected_by_brand(self):
+        """Test that a HEIF file with a codec no decoder handles is refused before parsing"""
+        src = os.path.join(self.test_dir, "photo.avif")
+        Image.new('RGB', (8, 8)).save(src, 'AVIF')
+        self.assertEqual(preflight.inspect(src).size, (8, 8))
+
+        with patch('sniff.decodable_codecs', return_value={'HEIF', 'HEVC'}), \
+                patch('pillow_heif.open_heif') as open_heif:
+            with self.assertRaisesRegex(converter.ConversionError, "AV1 images"):
+                preflight.inspect(src)
+        open_heif.assert_not_called()
+
+    def test_scan_splits_good_and_bad(self):
+        """Test that scan() returns infos for good files and errors for the rest, in order"""
+        paths = []
+        for name in ("a.heic", "b.heic"):
+            paths.append(create_heic(os.path.join(self.test_dir, name)))
+        bad = os.path.join(self.test_dir, "bad.heic")
+        with open(bad, 'w') as f:
+            f.write("nope")
+        paths.insert(1, bad)
+
+        infos, rejected = preflight.scan(paths, workers=2)
+
+        self.assertEqual(sorted(infos), sorted(paths[::2]))
+        self.assertEqual([path for path, _ in rejected], [bad])
+        self.assertEqual(preflight.scan([]), ({}, []))
+
+
+class TestScheduling(unittest.TestCase):
+    """Test largest-first ordering and the memory budget"""
+
+    def test_largest_first(self):
+        """Test that pairs are ordered by pixels, with unknown files last in their order"""
+        infos = {src: preflight.ImageInfo(src, size, 1, 8, False)
+                 for src, size in (("small", (10, 10)), ("big", (100, 100)),
+                                   ("mid", (50, 50)))}
+        planned = [(src, src + ".jpg") for src in ("small", "x", "big", "y", "mid")]
+        self.assertEqual([src for src, _ in preflight.largest_first(planned, infos)],
+                         ["big", "mid", "small", "x", "y"])
+
+    def test_scheduler_holds_back_jobs_over_budget(self):
+        """Test that a job waits for memory while smaller ones run in its place"""
+        scheduler = preflight.MemoryScheduler([("huge", 8), ("big", 6), ("small", 1)],
+                                              cost=lambda job: job[1], budget=10)
+        self.assertEqual(scheduler.next(), ("huge", 8))
+        self.assertEqual(scheduler.next(), ("small", 1))
+        self.assertIsNone(scheduler.next())
+        self.assertTrue(scheduler)
+
+        scheduler.finished(("huge", 8))
+        self.assertEqual(scheduler.next(), ("big", 6))
+        self.assertFalse(scheduler)
+
+    def test_oversized_job_runs_alone(self):
+        """Test that a job bigger than the whole budget still starts once nothing runs"""
+        scheduler = preflight.MemoryScheduler([("a", 2), ("giant", 50)],
+                                              cost=lambda job: job[1], budget=10)
+        self.assertEqual(scheduler.next(), ("a", 2))
+        self.assertIsNone(scheduler.next())
+        scheduler.finished(("a", 2))
+        self.assertEqual(scheduler.next(), ("giant", 50))
+
+    def test_default_budget(self):
+        """Test that the default budget is a share of physical memory"""
+        with patch('os.sysconf', side_effect=lambda name: {'SC_PHYS_PAGES': 1000,
+                                                           'SC_PAGE_SIZE': 4096}[name]):
+            self.assertEqual(preflight.default_budget(), 3072000)
+        with patch('os.sysconf', side_effect=ValueError):
+            self.assertEqual(preflight.default_budget(), 0)
+
+
+class TestBudgetedBatch(unittest.TestCase):
+    """Test run_batch() with pre-flight infos"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.planned = []
+        for name, size in (("small.heic", (32, 24)), ("big.heic", (128, 96)),
+                           ("mid.heic", (64, 48))):
+            src = create_heic(os.path.join(self.test_dir, name), size=size)
+            self.planned.append((src, os.path.splitext(src)[0] + ".jpg"))
+        self.infos, _ = preflight.scan([src for src, _ in self.planned])
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def test_serial_batch_runs_largest_first(self):
+        """Test that a single-worker batch converts the largest file first"""
+        results = heic2img.run_batch(self.planned, converter.ConversionOptions(), jobs=1,
+                                     infos=self.infos)
+        self.assertEqual([os.path.basename(src) for src, _, _ in results],
+                         ["big.heic", "mid.heic", "small.heic"])
+
+    def test_parallel_batch_within_budget(self):
+        """Test that a budget too small for two files at once still converts them all"""
+        options = converter.ConversionOptions()
+        budget = heic2img.job_memory(self.infos[self.planned[1][0]], options)
+        results = heic2img.run_batch(self.planned, options, jobs=3, infos=self.infos,
+                                     memory_budget=budget)
+        self.assertEqual(sorted(os.path.basename(src) for src, _, error in results if not error),
+                         ["big.heic", "mid.heic", "small.heic"])
+
+    def test_job_memory_capped_by_bounded_conversion(self):
+        """Test that files downscaled to fit a memory limit are counted at the limit"""
+        info = self.infos[self.planned[1][0]]
+        options = converter.ConversionOptions(memory_limit=1000, downscale_to_fit=True)
+        self.assertEqual(heic2img.job_memory(info, options), 1000)
+        self.assertEqual(heic2img.job_memory(info, converter.ConversionOptions()),
+                         info.memory())
+
+
+if __name__ == '__main__':
+    unittest.main()
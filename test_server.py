@@ -0,0 +1,227 @@
+import unittest
+import io
+import http.client
+import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import Future
+from unittest.mock import patch
+from PIL import Image
+
+import converter
+import server
+from test_converter import create_heic
+
+
+class TestConversionServer(unittest.TestCase):
+    """Test the HTTP conversion service on localhost"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_dir = tempfile.mkdtemp()
+        with open(create_heic(os.path.join(cls.test_dir, "photo.heic"), size=(64, 48),
+                              mode='RGBA', color=(0, 0, 255, 128)), 'rb') as f:
+            cls.heic = f.read()
+        cls.service = server.ConversionService(workers=1, queue_size=4)
+        cls.server = server.ConversionServer(('127.0.0.1', 0), cls.service, quiet=True)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.base = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.test_dir)
+
+    def post(self, query="", body=None):
+        request = urllib.request.Request(f"{self.base}/convert{query}",
+                                         data=self.heic if body is None else body)
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                return response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, e.read()
+
+    def test_convert_to_jpeg(self):
+        """Test that HEIC bytes come back as a flattened JPEG"""
+        status, headers, body = self.post()
+
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-Type'], 'image/jpeg')
+        with Image.open(io.BytesIO(body)) as img:
+            self.assertEqual(img.format, 'JPEG')
+            self.assertEqual(img.size, (64, 48))
+
+    def test_format_and_max_size(self):
+        """Test the format, quality and max_size query parameters"""
+        for format, pil_format in (("png", 'PNG'), ("webp", 'WEBP')):
+            status, headers, body = self.post(f"?format={format}&quality=80&max_size=32")
+
+            self.assertEqual(status, 200)
+            with Image.open(io.BytesIO(body)) as img:
+                self.assertEqual(img.format, pil_format)
+                self.assertEqual(img.size, (32, 24))
+                self.assertEqual(img.mode, 'RGBA')
+
+    def test_resize_parameters(self):
+        """Test max_edge with both fits, and a megapixel limit"""
+        for query, size in (("?max_edge=32&fit=fill", (32, 32)),
+                            ("?max_megapixels=0.0012", (40, 30))):
+            status, _, body = self.post(query)
+            self.assertEqual(status, 200)
+            with Image.open(io.BytesIO(body)) as img:
+                self.assertEqual(img.size, size)
+
+    def test_target_bytes(self):
+        """Test that target_bytes searches the quality down to the budget"""
+        budget = len(self.post("?quality=50")[2])
+        status, _, body = self.post(f"?quality=100&target_bytes={budget}")
+        self.assertEqual(status, 200)
+        self.assertLessEqual(len(body), budget)
+        self.assertLess(len(body), len(self.post("?quality=100")[2]))
+        self.assertEqual(self.post("?format=png&target_bytes=1000")[0], 400)
+
+    def test_bad_requests(self):
+        """Test that invalid options and undecodable bodies are client errors"""
+        self.assertEqual(self.post("?format=gif")[0], 400)
+        self.assertEqual(self.post("?quality=0")[0], 400)
+        self.assertEqual(self.post("?fit=stretch&max_edge=32")[0], 400)
+        self.assertEqual(self.post("?max_edge=-1")[0], 400)
+        self.assertEqual(self.post("?preset=tiny")[0], 400)
+        self.assertEqual(self.post("?strip_metadata=maybe")[0], 400)
+        status, _, body = self.post(body=b"not an image")
+        self.assertEqual(status, 422)
+        self.assertIn('error', json.loads(body))
+
+    def test_full_queue_returns_503(self):
+        """Test that requests are refused with Retry-After when the queue is full"""
+        with patch.object(self.service, 'submit', side_effect=queue.Full):
+            status, headers, _ = self.post()
+        self.assertEqual(status, 503)
+        self.assertEqual(headers['Retry-After'], str(server.RETRY_AFTER))
+
+    def test_invalid_content_length(self):
+        """Test that a malformed Content-Length is rejected instead of dropping the connection"""
+        for value in ("abc", "-5"):
+            connection = http.client.HTTPConnection('127.0.0.1', self.server.server_port,
+                                                    timeout=10)
+            connection.putrequest('POST', '/convert')
+            connection.putheader('Content-Length', value)
+            connection.endheaders()
+            response = connection.getresponse()
+            self.assertEqual(response.status, 400)
+            connection.close()
+
+    def test_timeout_returns_504(self):
+        """Test that a conversion outliving REQUEST_TIMEOUT is reported as a gateway timeout"""
+        with patch.object(self.service, 'submit', return_value=Future()), \
+                patch.object(server, 'REQUEST_TIMEOUT', 0.05):
+            status, _, _ = self.post()
+        self.assertEqual(status, 504)
+
+    def test_health(self):
+        """Test that the health endpoint reports queue statistics"""
+        with urllib.request.urlopen(f"{self.base}/health", timeout=10) as response:
+            stats = json.loads(response.read())
+        self.assertEqual(stats['workers'], 1)
+        self.assertEqual(stats['queue_size'], 4)
+
+
+class TestConversionService(unittest.TestCase):
+    """Test queueing, batching and backpressure in the worker pool front end"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        with open(create_heic(os.path.join(self.test_dir, "photo.heic")), 'rb') as f:
+            self.heic = f.read()
+        # Identical uploads would be deduplicated; these tests need each one queued
+        self.service = server.ConversionService(workers=1, queue_size=1, batch_size=4,
+                                                store_bytes=0)
+        self.options = converter.ConversionOptions()
+
+    def tearDown(self):
+        self.service.close()
+        shutil.rmtree(self.test_dir)
+
+    def block_workers(self):
+        """Take every in-flight slot so the dispatcher stops handing out work"""
+        for _ in range(2 * self.service.workers):
+            self.service._in_flight.acquire()
+
+    def release_workers(self):
+        for _ in range(2 * self.service.workers):
+            self.service._in_flight.release()
+
+    def test_rejects_when_queue_full(self):
+        """Test that submit raises queue.Full instead of queueing without limit"""
+        self.block_workers()
+        accepted = []
+        with self.assertRaises(queue.Full):
+            for _ in range(3):
+                accepted.append(self.service.submit(self.heic, self.options))
+        self.assertEqual(self.service.stats()['rejected'], 1)
+        self.release_workers()
+
+        for future in accepted:
+            self.assertTrue(future.result(timeout=60).startswith(b'\xff\xd8'))
+
+    def test_waiting_requests_share_a_batch(self):
+        """Test that requests queued behind a busy pool go to a worker together"""
+        self.service.close()
+        self.service = server.ConversionService(workers=1, queue_size=8, batch_size=4,
+                                                store_bytes=0)
+        self.block_workers()
+        futures = [self.service.submit(self.heic, self.options) for _ in range(3)]
+        self.release_workers()
+
+        for future in futures:
+            future.result(timeout=60)
+        self.assertEqual(self.service.stats()['batches'], 1)
+
+    def test_conversion_errors_reach_the_caller(self):
+        """Test that a bad image fails only its own request"""
+        self.service.close()
+        self.service = server.ConversionService(workers=1, queue_size=4)
+        bad = self.service.submit(b"garbage", self.options)
+        good = self.service.submit(self.heic, self.options)
+
+        with self.assertRaises(converter.ConversionError):
+            bad.result(timeout=60)
+        self.assertTrue(good.result(timeout=60))
+
+    def test_identical_uploads_convert_once(self):
+        """Test that repeats share a running conversion or come from the output store"""
+        self.service.close()
+        self.service = server.ConversionService(workers=1, queue_size=4)
+        self.block_workers()
+        first = self.service.submit(self.heic, self.options)
+        waiting = self.service.submit(self.heic, self.options)
+        self.assertIs(waiting, first)
+        self.release_workers()
+        output = first.result(timeout=60)
+
+        self.assertEqual(self.service.submit(self.heic, self.options).result(timeout=1), output)
+        png = self.service.submit(self.heic, converter.ConversionOptions(format='PNG'))
+        self.assertTrue(png.result(timeout=60).startswith(b'\x89PNG'))
+        stats = self.service.stats()
+        self.assertEqual((stats['requests'], stats['batches'], stats['dedup_hits']), (4, 2, 2))
+        self.assertEqual(stats['dedup_hit_rate'], 0.5)
+
+    def test_failed_conversions_are_not_stored(self):
+        """Test that a failed upload is converted again when it is sent again"""
+        self.service.close()
+        self.service = server.ConversionService(workers=1, queue_size=4)
+        for _ in range(2):
+            with self.assertRaises(converter.ConversionError):
+                self.service.submit(b"garbage", self.options).result(timeout=60)
+        self.assertEqual(self.service.stats()['dedup_hits'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
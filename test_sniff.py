@@ -0,0 +1,110 @@
+import unittest
+import os
+import tempfile
+import shutil
+from unittest.mock import patch
+
+from PIL import Image
+
+import sniff
+from test_converter import create_heic
+
+
+def ftyp(major, *compatible, size=None):
+    """Return an ftyp box with the given brands"""
+    brands = b''.join(brand.encode() for brand in compatible)
+    size = 16 + len(brands) if size is None else size
+    return size.to_bytes(4, 'big') + b'ftyp' + major.encode() + bytes(4) + brands
+
+
+class TestBrands(unittest.TestCase):
+    """Test reading brands from the ftyp box"""
+
+    def test_read_brands(self):
+        """Test that the major and compatible brands are read, and only from an ftyp box"""
+        self.assertEqual(sniff.read_brands(ftyp('heic', 'mif1', 'heic') + b'\0\0\0\x08meta'),
+                         ['heic', 'mif1', 'heic'])
+        self.assertEqual(sniff.read_brands(b'\x89PNG\r\n\x1a\n' + bytes(24)), [])
+        self.assertEqual(sniff.read_brands(b''), [])
+        # A size that runs past what was read, or to the end of the file
+        self.assertEqual(sniff.read_brands(ftyp('mif1', 'avif', size=4096)), ['mif1', 'avif'])
+        self.assertEqual(sniff.read_brands(ftyp('mif1', 'heic', size=0)), ['mif1', 'heic'])
+
+    def test_heif_codec(self):
+        """Test that the codec comes from the first coded brand, structural brands or not"""
+        cases = [
+            (ftyp('heic', 'mif1'), 'HEVC'),
+            (ftyp('mif1', 'miaf', 'heic'), 'HEVC'),
+            (ftyp('avif', 'mif1', 'miaf'), 'AV1'),
+            (ftyp('msf1', 'avis'), 'AV1'),
+            (ftyp('mif1', 'miaf'), 'HEIF'),
+            (ftyp('isom', 'mp41'), None),
+            (ftyp('qt  '), None),
+            (b'\xff\xd8\xff\xe0' + bytes(28), None),
+        ]
+        for header, codec in cases:
+            with self.subTest(header=header[:20]):
+                self.assertEqual(sniff.heif_codec(header), codec)
+
+    def test_decodable_codecs(self):
+        """Test that decoders come from libheif's plugins plus Pillow's AVIF support"""
+        info = {'decoders': {'libde265': 'libde265 HEVC decoder'}}
+        with patch('pillow_heif.libheif_info', return_value=info), \
+                patch('PIL.features.check', return_value=False), \
+                patch.object(sniff, '_decodable', None):
+            self.assertEqual(sniff.decodable_codecs(), {'HEIF', 'HEVC'})
+        with patch('pillow_heif.libheif_info', return_value=info), \
+                patch('PIL.features.check', return_value=True), \
+                patch.object(sniff, '_decodable', None):
+            self.assertEqual(sniff.decodable_codecs(), {'HEIF', 'HEVC', 'AV1'})
+
+
+class TestFiles(unittest.TestCase):
+    """Test recognizing files by name and content"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def test_is_heif_name(self):
+        """Test the HEIF-family extensions, in any case"""
+        for name in ("a.heic", "b.HEIF", "c.hif", "d.avif"):
+            self.assertTrue(sniff.is_heif_name(name))
+        for name in ("a.jpg", "heic", "a.heic.txt"):
+            self.assertFalse(sniff.is_heif_name(name))
+
+    def test_files_by_content(self):
+        """Test that real files are told apart from their first bytes"""
+        heic = create_heic(os.path.join(self.test_dir, "photo.jpg"))
+        avif = os.path.join(self.test_dir, "photo.bin")
+        Image.new('RGB', (8, 8)).save(avif, 'AVIF')
+        png = os.path.join(self.test_dir, "image.heic")
+        Image.new('RGB', (8, 8)).save(png, 'PNG')
+
+        self.assertEqual(sniff.sniff_file(heic), 'HEVC')
+        self.assertEqual(sniff.sniff_file(avif), 'AV1')
+        self.assertIsNone(sniff.sniff_file(png))
+        self.assertIsNone(sniff.sniff_file(os.path.join(self.test_dir, "missing")))
+        self.assertTrue(sniff.is_heif_file(heic))
+        self.assertFalse(sniff.is_heif_file(png))
+
+    def test_is_heif_input(self):
+        """Test that HEIF names are kept whatever they hold, and other names go by content"""
+        heic = create_heic(os.path.join(self.test_dir, "IMG_0001.JPG"))
+        text = os.path.join(self.test_dir, "notes.txt")
+        with open(text, 'w') as f:
+            f.write("hello")
+
+        self.assertTrue(sniff.is_heif_input(heic))
+        self.assertFalse(sniff.is_heif_input(text))
+        self.assertFalse(sniff.is_heif_input(self.test_dir))
+        with patch('builtins.open') as opened:
+            self.assertTrue(sniff.is_heif_input(os.path.join(self.test_dir, "any.heic")))
+        opened.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import unittest
+import os
+import sys
+import tempfile
+import shutil
+import threading
+import time
+
+from watcher import FolderWatcher
+
+
+def write_slowly(path, chunks=3, pause=0.1):
+    """Write a file in several chunks, as a sync client would"""
+    with open(path, 'wb') as f:
+        for _ in range(chunks):
+            f.write(b'x' * 1024)
+            f.flush()
+            time.sleep(pause)
+
+
+class WatcherTests:
+    """Behaviour shared by every watcher backend"""
+
+    backend = None
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.watcher = FolderWatcher(self.test_dir, accept=lambda p: p.endswith('.heic'),
+                                     backend=self.backend, settle=0.2, poll_interval=0.1)
+
+    def tearDown(self):
+        self.watcher.close()
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def in_background(self, func):
+        thread = threading.Thread(target=func)
+        thread.start()
+        self.addCleanup(thread.join)
+
+    def test_reports_new_file_once(self):
+        """Test that a new file is reported once it is complete, and only once"""
+        path = os.path.join(self.test_dir, "photo.heic")
+        self.in_background(lambda: write_slowly(path))
+
+        self.assertEqual(self.watcher.wait(timeout=5), [path])
+        self.assertEqual(self.watcher.wait(timeout=0.5), [])
+        self.assertEqual(os.path.getsize(path), 3 * 1024)
+
+    def test_ignores_rejected_names(self):
+        """Test that files the accept filter rejects are not reported"""
+        with open(os.path.join(self.test_dir, "notes.txt"), 'w') as f:
+            f.write("not a photo")
+        self.assertEqual(self.watcher.wait(timeout=0.6), [])
+
+    def test_new_subdirectory(self):
+        """Test that files in folders created after the watch started are reported"""
+        path = os.path.join(self.test_dir, "2024", "june", "photo.heic")
+
+        def create():
+            os.makedirs(os.path.dirname(path))
+            write_slowly(path, chunks=1)
+        self.in_background(create)
+
+        self.assertEqual(self.watcher.wait(timeout=5), [path])
+
+    def test_existing_files_are_not_reported(self):
+        """Test that only changes after the watch started are reported"""
+        watched = tempfile.mkdtemp(dir=self.test_dir)
+        with open(os.path.join(watched, "old.heic"), 'wb') as f:
+            f.write(b'x')
+        with FolderWatcher(watched, backend=self.backend, settle=0.1,
+                           poll_interval=0.1) as watcher:
+            self.assertEqual(watcher.wait(timeout=0.5), [])
+
+
+class TestPollingWatcher(WatcherTests, unittest.TestCase):
+    """Test the portable polling watcher"""
+
+    backend = 'poll'
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), "inotify is Linux only")
+class TestInotifyWatcher(WatcherTests, unittest.TestCase):
+    """Test the inotify watcher"""
+
+    backend = 'inotify'
+
+    def test_reported_soon_after_close(self):
+        """Test that a finished file is reported within the settle time, well under a second"""
+        path = os.path.join(self.test_dir, "photo.heic")
+        with open(path, 'wb') as f:
+            f.write(b'x' * 1024)
+        closed = time.monotonic()
+
+        self.assertEqual(self.watcher.wait(timeout=5), [path])
+        self.assertLess(time.monotonic() - closed, 1.0)
+
+    def test_idle_wait_uses_no_cpu(self):
+        """Test that waiting with nothing changing sleeps in the kernel"""
+        cpu = time.process_time()
+        self.assertEqual(self.watcher.wait(timeout=0.5), [])
+        self.assertLess(time.process_time() - cpu, 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
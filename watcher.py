@@ -0,0 +1,258 @@
+"""
+Folder watcher for HEIC to JPG/PNG Converter
+Reports new or modified files below a directory once they have stopped changing
+
+On Linux the watcher uses inotify (through ctypes, with no extra packages) and
+sleeps until the kernel reports a change. Elsewhere, or when inotify is not
+available, it rescans the tree at a fixed interval.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+# A file is reported once it has had no write events for this long
+SETTLE_SECONDS = 0.25
+
+# How often the polling fallback rescans the tree
+POLL_INTERVAL = 1.0
+
+# inotify event bits, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+_EVENT_HEADER = struct.Struct('iIII')
+_READ_SIZE = 64 * 1024
+
+
+def _walk_files(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            yield os.path.join(dirpath, name)
+
+
+def _stat_key(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class _InotifyBackend:
+    """Recursive inotify watch; read() blocks in select() until something changes"""
+
+    def __init__(self, root):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "libc has no inotify")
+        self._libc = libc
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self._dirs = {}
+        self.root = root
+        self._add_tree(root)
+
+    def _add_dir(self, path):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), _WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(error, f"Cannot watch {path}: {os.strerror(error)}")
+        self._dirs[wd] = path
+
+    def _add_tree(self, root):
+        """Watch root and every directory below it; returns the files already there"""
+        found = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            self._add_dir(dirpath)
+            found.extend(os.path.join(dirpath, name) for name in filenames)
+        return found
+
+    def fileno(self):
+        return self._fd
+
+    def read(self, timeout):
+        """Wait up to timeout seconds and return the file paths that changed"""
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self._fd, _READ_SIZE)
+        except BlockingIOError:
+            return []
+
+        changed = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped; fall back to looking at everything
+                changed.extend(_walk_files(self.root))
+                continue
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            directory = self._dirs.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files can land in a new folder before its watch exists
+                    changed.extend(self._add_tree(path))
+                continue
+            changed.append(path)
+        return changed
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class _PollingBackend:
+    """Portable fallback that compares size and modification time on every scan"""
+
+    def __init__(self, root, interval=POLL_INTERVAL):
+        self.root = root
+        self.interval = interval
+        self._seen = {path: _stat_key(path) for path in _walk_files(root)}
+        self._next_scan = time.monotonic() + interval
+
+    def read(self, timeout):
+        delay = self._next_scan - time.monotonic()
+        if timeout is not None and delay > timeout:
+            time.sleep(max(timeout, 0))
+            return []
+        time.sleep(max(delay, 0))
+        self._next_scan = time.monotonic() + self.interval
+
+        changed = []
+        current = {}
+        for path in _walk_files(self.root):
+            key = _stat_key(path)
+            current[path] = key
+            if key is not None and self._seen.get(path) != key:
+                changed.append(path)
+        self._seen = current
+        return changed
+
+    def close(self):
+        pass
+
+
+class FolderWatcher:
+    """
+    Watch a directory tree and report files that are new or modified.
+
+    A file is only reported once it has gone settle seconds without another
+    write and its size and modification time have stopped changing, so files
+    that are still being copied or synced are not picked up half written.
+    Each change is reported once; writing the file again reports it again.
+
+    Args:
+        root (str): Directory to watch, including all its subdirectories
+        accept (callable): Called with each changed path; only paths it
+            returns True for are reported. Defaults to every file
+        settle (float): Seconds a file must be quiet before it is reported
+        backend (str): 'inotify', 'poll', or None to use inotify where
+            available and polling otherwise
+        poll_interval (float): Seconds between scans when polling
+    """
+
+    def __init__(self, root, accept=None, settle=SETTLE_SECONDS, backend=None,
+                 poll_interval=POLL_INTERVAL):
+        self.root = os.path.abspath(root)
+        self.accept = accept or (lambda path: True)
+        self.settle = settle
+        self._pending = {}
+        self._backend = None
+        if backend in (None, 'inotify'):
+            try:
+                self._backend = _InotifyBackend(self.root)
+            except OSError:
+                if backend == 'inotify':
+                    raise
+        if self._backend is None:
+            self._backend = _PollingBackend(self.root, poll_interval)
+            # A change is only visible at the next scan, so wait at least one interval
+            self.settle = max(settle, poll_interval)
+        self.backend = 'inotify' if isinstance(self._backend, _InotifyBackend) else 'poll'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self._backend.close()
+
+    def wait(self, timeout=None):
+        """
+        Block until at least one file is ready, or until timeout.
+
+        Args:
+            timeout (float): Most seconds to wait; None waits indefinitely
+
+        Returns:
+            list: Paths of files that are ready, sorted; empty on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            ready = self._collect_ready(now)
+            if ready:
+                return ready
+            waits = []
+            if deadline is not None:
+                waits.append(deadline - now)
+            if self._pending:
+                waits.append(min(t for t, _ in self._pending.values()) + self.settle - now)
+            if deadline is not None and now >= deadline:
+                return []
+            for path in self._backend.read(max(min(waits), 0) if waits else None):
+                if self.accept(path):
+                    self._pending[path] = (time.monotonic(), _stat_key(path))
+
+    def _collect_ready(self, now):
+        ready = []
+        for path, (changed_at, key) in list(self._pending.items()):
+            if now - changed_at < self.settle:
+                continue
+            current = _stat_key(path)
+            if current is None:
+                # Deleted or renamed away before it settled
+                del self._pending[path]
+            elif current != key:
+                # Still being written without events we saw (e.g. over a network mount)
+                self._pending[path] = (now, current)
+            else:
+                del self._pending[path]
+                ready.append(path)
+        return sorted(ready)